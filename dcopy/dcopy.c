@@ -2,10 +2,14 @@
  *
  * Direct copy a file, avoiding buffer caches and preserving sparseness.
  *
+ * The holes of a source file (as found with SEEK_DATA/SEEK_HOLE) are not
+ * read: they are skipped in the destination with --sparse and written as
+ * zeros without it. With --async, the next chunk is read while the current
+ * one is written.
  *
  * Usage:
  * 
- * dcopy [-sparse] [-chunksize N] <src> <dest>
+ * dcopy [-sparse] [-async] [-full-read] [-chunksize N] <src> <dest>
  */
 
 #include <stdio.h>
@@ -19,6 +23,7 @@
 #include <string.h>
 #include <err.h>
 #include <inttypes.h>
+#include <aio.h>
 #include "atomicio.h"
 
 #define SECT_SIZE 512
@@ -29,14 +34,195 @@ static char zero_sect[PAGE_SIZE];
 static int verbose = 0;
 #define VPRINTF(_v, _a...) if (_v < verbose) printf(_a)
 
-void dcopy(int src, int dst, int sparse, int cs)
+/* Write the i bytes in buf at pos, the current position of dst, seeking
+ * over the all-zero pages if sparse. Returns the new position. */
+static off_t write_chunk(int dst, char *buf, long i, int sparse, off_t pos)
 {
-        struct stat stat;
-        char *buf;
+        long offset = 0;
+        long start = 0;
         int res;
+
+        while (1)
+        {
+                start = offset;
+                VPRINTF(2, "(o: %ld, i: %ld)\n", offset, i);
+                if ( offset >= i ) break;
+
+                /* Non-sparse region */
+                while ( ((!sparse) ||
+                         (memcmp(&buf[offset], zero_sect,
+                                 PAGE_SIZE) != 0 ))
+                        && (offset < i) )
+                        offset += PAGE_SIZE;
+                if (offset > i)
+                        offset = i;
+                if ((offset - start) > 0)
+                {
+                        res = atomicio(vwrite, dst, &buf[start],
+                                     offset - start);
+                        if (res != (offset - start))
+                                err(1, "Writing. (pos: %"PRId64")",
+                                    pos);
+                        VPRINTF(2, "(%"PRId64", %"PRId64") write.\n", pos,
+                                pos+res);
+                        pos += res;
+                }
+
+                start = offset;
+
+                /* Sparse region */
+                while ( (memcmp(&buf[offset], zero_sect,
+                               PAGE_SIZE) == 0)  && (offset < i) )
+                        offset += PAGE_SIZE;
+                if (offset > i)
+                        offset = i;
+                if ((offset - start) > 0)
+                {
+                        if (lseek(dst, offset - start, SEEK_CUR) ==
+                            (off_t)-1)
+                                err(1, "Seeking in dst (%ld)",
+                                    offset - start);
+                        VPRINTF(2, "(%"PRId64", %"PRId64") skip.\n", pos,
+                                pos+offset - start);
+                        pos += (offset - start);
+                }
+        }
+
+        return pos;
+}
+
+/* Fill the len bytes at pos, the current position of dst, with zeros: seek
+ * over them if sparse, or write them from zbuf (cs bytes of zeros). Returns
+ * the new position. */
+static off_t write_zeros(int dst, char *zbuf, int cs, off_t len, int sparse,
+                         off_t pos)
+{
+        off_t end = pos + len;
+        long n;
+
+        if (sparse)
+        {
+                if (lseek(dst, end, SEEK_SET) == (off_t)-1)
+                        err(1, "Seeking in dst (%"PRId64")", end);
+                VPRINTF(2, "(%"PRId64", %"PRId64") hole.\n", pos, end);
+                return end;
+        }
+
+        while (pos < end)
+        {
+                n = (end - pos > cs) ? cs : end - pos;
+                if (atomicio(vwrite, dst, zbuf, n) != n)
+                        err(1, "Writing. (pos: %"PRId64")", pos);
+                pos += n;
+        }
+        return pos;
+}
+
+static void submit_read(struct aiocb *cb, int src, char *buf, off_t off,
+                        long len)
+{
+        memset(cb, 0, sizeof(*cb));
+        cb->aio_fildes = src;
+        cb->aio_buf = buf;
+        cb->aio_nbytes = len;
+        cb->aio_offset = off;
+        if (aio_read(cb) != 0)
+                err(1, "Reading from source file. (pos: %"PRId64")", off);
+}
+
+static long wait_read(struct aiocb *cb)
+{
+        const struct aiocb *list[1] = { cb };
+        ssize_t res;
+
+        while ((res = aio_error(cb)) == EINPROGRESS)
+                aio_suspend(list, 1, NULL);
+        if (res != 0)
+        {
+                errno = res;
+                err(1, "Reading from source file. (pos: %"PRId64")",
+                    (int64_t)cb->aio_offset);
+        }
+        return aio_return(cb);
+}
+
+/* Read up to cs bytes of src into buf at its current position. A short read
+ * means the end of src: fail rather than take an error for it. */
+static long read_chunk(int src, char *buf, int cs, off_t pos)
+{
+        long i;
+
+        i = atomicio(read, src, buf, cs);
+        if (i == 0 && errno != EPIPE)
+                err(1, "Reading from source file. (pos: %"PRId64")", pos);
+        return i;
+}
+
+/* Copy the range [pos, end) of src, which dst is positioned at, reading it
+ * in whole chunks of cs bytes (O_DIRECT reads must stay aligned, so the last
+ * one may go past end), into buf[0] (and buf[1] if async, to read the next
+ * chunk while writing the current one). The range ends early at the end of
+ * src. Returns the position reached. */
+static off_t copy_range(int src, int dst, char *buf[2], int cs, int sparse,
+                        int async, off_t pos, off_t end)
+{
+        struct aiocb cb[2];
+        int cur = 0;
+        off_t next;
         long i;
+
+        if (!async)
+        {
+                if (lseek(src, pos, SEEK_SET) == (off_t)-1)
+                        err(1, "Seeking in src (%"PRId64")", pos);
+                while (pos < end)
+                {
+                        i = read_chunk(src, buf[0], cs, pos);
+                        if (i == 0)
+                                break;
+                        VPRINTF(2, "Read %ld bytes.\n", i);
+                        pos = write_chunk(dst, buf[0], i, sparse, pos);
+                        if (i < cs)
+                                break;
+                }
+                return pos;
+        }
+
+        if (pos >= end)
+                return pos;
+        submit_read(&cb[cur], src, buf[cur], pos, cs);
+        next = pos + cs;
+        while (1)
+        {
+                i = wait_read(&cb[cur]);
+                VPRINTF(2, "Read %ld bytes.\n", i);
+                if (i < cs)
+                        /* end of src: do not read any further */
+                        end = next;
+                if (next < end)
+                {
+                        submit_read(&cb[!cur], src, buf[!cur], next, cs);
+                        next += cs;
+                }
+                if (i > 0)
+                        pos = write_chunk(dst, buf[cur], i, sparse, pos);
+                if (i < cs || pos >= end)
+                        break;
+                cur = !cur;
+        }
+        return pos;
+}
+
+void dcopy(int src, int dst, int sparse, int cs, int async, int full_read)
+{
+        struct stat stat;
+        char *buf[2] = { NULL, NULL };
+        char *zbuf;
+        int res, i;
 	off_t pos = 0;
+        off_t size, data, hole, reached;
         int dst_is_file = 1;
+        int seek_data = !full_read;
 
         /* If we are writing to a block device, we won't truncate later. */
         res = fstat(dst, &stat);
@@ -45,74 +231,68 @@ void dcopy(int src, int dst, int sparse, int cs)
         if (S_ISBLK(stat.st_mode))
                 dst_is_file = 0;
 
-        res = posix_memalign((void **)&buf, 4096, cs);
-        if ( res != 0 )
+        res = fstat(src, &stat);
+        if (res != 0)
+                err(1, "stat()'ing source file.");
+        if (!S_ISREG(stat.st_mode))
+                seek_data = 0;
+        size = lseek(src, 0, SEEK_END);
+        if (size == (off_t)-1)
+                err(1, "Seeking to the end of source file.");
+
+        for (i = 0; i < (async ? 3 : 2); i++)
         {
-                errno = res;
-                err(1, "allocating copy buffer. (of %d bytes)\n", cs);
+                char **b = (i == 0) ? &zbuf : &buf[i - 1];
+                res = posix_memalign((void **)b, 4096, cs);
+                if ( res != 0 )
+                {
+                        errno = res;
+                        err(1, "allocating copy buffer. (of %d bytes)\n", cs);
+                }
         }
+        memset(zbuf, 0, cs);
 
-        while(1) 
+        while (pos < size)
         {
-                long offset = 0;
-                long start = 0;
-
-                i = atomicio(read, src, buf, cs);
-                if (i == -1)
-                        err(1, "Reading from source file.");
-                if (i == 0)
-                        break;
-                
-                VPRINTF(2, "Read %ld bytes.\n", i);
-
-                start = offset = 0;
-                while (1) 
+                data = pos;
+                hole = size;
+                if (seek_data)
                 {
-                        start = offset;
-                        VPRINTF(2, "(o: %ld, i: %ld)\n", offset, i); 
-                        if ( offset >= i ) break;
-
-                        /* Non-sparse region */
-                        while ( ((!sparse) || 
-                                 (memcmp(&buf[offset], zero_sect, 
-                                         PAGE_SIZE) != 0 )) 
-                                && (offset < i) )
-                                offset += PAGE_SIZE;
-                        if (offset > i) 
-                                offset = i;
-                        if ((offset - start) > 0)
+                        data = lseek(src, pos, SEEK_DATA);
+                        if (data == (off_t)-1 && errno == ENXIO)
+                                /* only a hole left */
+                                data = size;
+                        else if (data == (off_t)-1 && errno == EINVAL)
                         {
-                                res = atomicio(vwrite, dst, &buf[start], 
-                                             offset - start); 
-                                if (res != (offset - start))
-                                        err(1, "Writing. (pos: %ld)", start);
-                                VPRINTF(2, "(%"PRId64", %"PRId64") write.\n", pos, 
-                                        pos+res);
-                                pos += res;
+                                /* not supported by the file system */
+                                seek_data = 0;
+                                data = pos;
                         }
-
-                        start = offset;
-
-                        /* Sparse region */
-                        while ( (memcmp(&buf[offset], zero_sect, 
-                                       PAGE_SIZE) == 0)  && (offset < i) )
-                                offset += PAGE_SIZE;
-                        if (offset > i) 
-                                offset = i;
-                        if ((offset - start) > 0)
+                        else if (data == (off_t)-1)
+                                err(1, "Looking for data in source file.");
+                        else
                         {
-                                res = lseek(dst, offset - start, 
-                                            SEEK_CUR);
-                                if (res == (off_t)-1)
-                                        err(1, "Seeking in dst (%ld)", 
-                                            offset - start);
-                                VPRINTF(2, "(%"PRId64", %"PRId64") skip.\n", pos, 
-                                        pos+offset - start);
-                                pos += (offset - start);
+                                hole = lseek(src, data, SEEK_HOLE);
+                                if (hole == (off_t)-1)
+                                        err(1, "Looking for a hole in "
+                                            "source file.");
                         }
                 }
+
+                if (data > pos)
+                        pos = write_zeros(dst, zbuf, cs, data - pos, sparse,
+                                          pos);
+                if (data >= size)
+                        break;
+
+                reached = copy_range(src, dst, buf, cs, sparse, async, data,
+                                     hole);
+                if (reached == pos)
+                        /* src is shorter than it said */
+                        break;
+                pos = reached;
         }
-                
+
         if (dst_is_file && sparse)
         {
                 res = ftruncate(dst, pos);
@@ -121,7 +301,7 @@ void dcopy(int src, int dst, int sparse, int cs)
         }
 
         VPRINTF(2, "Done copying\n");
-        
+
         return;
 }
 
@@ -130,6 +310,8 @@ int main(int argc, char *argv[])
         int c;
         int cs = 2048;
         int sparse = 0;
+        int async = 0;
+        int full_read = 0;
         char *src, *dst;
         int srcfd, dstfd;
 
@@ -139,11 +321,13 @@ int main(int argc, char *argv[])
                 int idx = 0;
                 static struct option long_opts[] = {
                         {"sparse", 0, 0, 's'},
+                        {"async", 0, 0, 'a'},
+                        {"full-read", 0, 0, 'f'},
                         {"chunksize", 1, 0, 'c'},
                         {0, 0, 0, 0}
                 };
 
-                c = getopt_long (argc, argv, "+sc:v", long_opts, &idx);
+                c = getopt_long (argc, argv, "+safc:v", long_opts, &idx);
 
                 if (c == -1)
                         break;
@@ -158,6 +342,12 @@ int main(int argc, char *argv[])
                 case 's':
                          sparse = 1;
                          break;
+                case 'a':
+                         async = 1;
+                         break;
+                case 'f':
+                         full_read = 1;
+                         break;
                 case 'c':
                         cs = atoi(optarg);
                         break;
@@ -170,8 +360,8 @@ int main(int argc, char *argv[])
         }
 
         if (optind != ( argc - 2)) {
-                printf("usage: %s [--sparse] [--chunksize N(KB)] "
-                       "<src> <dest>\n", 
+                printf("usage: %s [--sparse] [--async] [--full-read] "
+                       "[--chunksize N(KB)] <src> <dest>\n", 
                        argv[0]);
                 return -1;
         }
@@ -190,7 +380,7 @@ int main(int argc, char *argv[])
         if (dstfd == -1)
                 err(1, "Opening destination file (%s).", dst);
 
-        dcopy(srcfd, dstfd, sparse, cs);
+        dcopy(srcfd, dstfd, sparse, cs, async, full_read);
         
         return 0; 
 }
@@ -35,3 +35,96 @@ do_test 1 1024 5 "--sparse"
 
 do_test 128 128 5 ""
 do_test 128 128 5 "--sparse"
+
+# Source images with holes (as made by truncate) are copied without reading
+# the holes, unless --full-read is given
+
+make_holey_img ()
+{
+        rm -f $1
+        truncate -s $2M $1
+        for mb in $3; do
+                dd if=/dev/urandom of=$1 bs=1M count=1 seek=$mb \
+                        conv=notrunc 2> /dev/null
+        done
+}
+
+do_hole_test ()
+{
+        size=$1
+        data=$2
+        opt=$3
+
+        echo -ne "${size}MB with data at MB ${data}. "
+        echo -ne "(opt:$opt)  "
+        rm -f dest_img
+        make_holey_img source_img $size "$data"
+        ./dcopy $opt source_img dest_img
+        cmp -s source_img dest_img
+        if [ $? -eq 0 ]; then
+             echo "[ PASS ]"
+        else
+             echo "[ FAIL ]"
+        fi
+        rm -f source_img dest_img
+}
+
+for opt in "" "--sparse" "--async" "--sparse --async" \
+        "--sparse --full-read" "--sparse --async --chunksize 64"; do
+        do_hole_test 64 "0 1 2 40" "$opt"
+        do_hole_test 64 "17 63" "$opt"
+        do_hole_test 64 "" "$opt"
+done
+
+# A source whose size is not a multiple of the sector size cannot be written
+# whole with O_DIRECT: dcopy must fail rather than leave out the tail
+
+do_unaligned_test ()
+{
+        opt=$1
+
+        echo -ne "10MB + 100B. "
+        echo -ne "(opt:$opt)  "
+        rm -f source_img dest_img
+        head -c $((10 * 1024 * 1024 + 100)) /dev/urandom > source_img
+        ./dcopy $opt source_img dest_img 2> /dev/null
+        if [ $? -ne 0 ] || cmp -s source_img dest_img; then
+             echo "[ PASS ]"
+        else
+             echo "[ FAIL ]"
+        fi
+        rm -f source_img dest_img
+}
+
+for opt in "" "--sparse" "--async" "--sparse --async" "--full-read"; do
+        do_unaligned_test "$opt"
+done
+
+# Throughput on a mostly empty image: "./test.sh bench [<size in MB>]"
+
+do_bench ()
+{
+        opt=$1
+
+        rm -f dest_img
+        start=$(date +%s.%N)
+        ./dcopy $opt bench_img dest_img
+        end=$(date +%s.%N)
+        echo "$bench_size $start $end" | awk '{ printf "%8.1f MB/s", \
+                $1 / ($3 - $2) }'
+        echo "  (opt:$opt)"
+        rm -f dest_img
+}
+
+if [ "$1" = "bench" ]; then
+        bench_size=${2:-4096}
+        # 1MB of data every 64MB
+        make_holey_img bench_img $bench_size "$(seq 0 64 $(($bench_size - 1)))"
+        echo "Copying ${bench_size}MB with 1MB of data every 64MB:"
+        do_bench "--sparse --full-read"
+        do_bench "--sparse"
+        do_bench "--sparse --async"
+        do_bench "--full-read"
+        do_bench ""
+        rm -f bench_img
+fi
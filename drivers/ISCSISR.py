@@ -19,7 +19,7 @@
 #
 
 import SR, VDI, SRCommand, util
-import statvfs, time, LUNperVDI
+import statvfs, LUNperVDI
 import os, socket, sys, re, glob
 import xml.dom.minidom
 import shutil, xmlrpclib
@@ -63,6 +63,11 @@ ISCSI_PROCNAME = "iscsi_tcp"
 class ISCSISR(SR.SR):
     """ISCSI storage repository"""
 
+    # portals probed and logged in to at once
+    LOGIN_WORKERS = 8
+    # the longest to wait for the LUNs of new sessions to show up (seconds)
+    SETTLE_TIMEOUT = 5
+
     @property
     def force_tapdisk(self):
         return self.dconf.get('force_tapdisk', 'false') == 'true'
@@ -271,19 +276,18 @@ class ISCSISR(SR.SR):
                 targetlist = self.dconf['multihomelist'].split(',')
             else:
                 targetlist = ['%s:%d' % (self.target,self.port)]
-            conn = False
-            for val in targetlist:
+            # probe them all at once, and use the first one in the list that
+            # answers as soon as it and those before it have been probed
+            def test(val):
                 (target, port) = iscsilib.parse_IP_port(val)
-                try:
-                    util._testHost(target, long(port), 'ISCSITarget')
-                    self.target = target
-                    self.port = long(port)
-                    conn = True
-                    break
-                except:
-                    pass
-            if not conn:
+                util._testHost(target, long(port), 'ISCSITarget')
+            val = util.run_parallel_first(test, targetlist,
+                    self.LOGIN_WORKERS)
+            if val is None:
                 raise xs_errors.XenError('ISCSITarget')
+            (target, port) = iscsilib.parse_IP_port(val)
+            self.target = target
+            self.port = long(port)
 
             # Test and set the initiatorname file
             iscsilib.ensure_daemon_running_ok(self.localIQN)
@@ -308,35 +312,50 @@ class ISCSISR(SR.SR):
                         self._scan_IQNs()
                         raise xs_errors.XenError('ISCSIDiscovery', 
                                                  opterr='check target settings')
+                    portals = []
                     for i in range(0,len(map)):
                         (portal,tpgt,iqn) = map[i]
-                        try:
-                            (ipaddr, port) = iscsilib.parse_IP_port(portal)
-                            if not self.multihomed and ipaddr != self.target:
-                                continue
-                            util._testHost(ipaddr, long(port), 'ISCSITarget')
-                            util.SMlog("Logging in to [%s:%s]" % (ipaddr,port))
-                            iscsilib.login(portal, iqn, self.chapuser,
-                                           self.chappassword,
-                                           self.incoming_chapuser,
-                                           self.incoming_chappassword,
-                                           self.mpath == "true")
+                        (ipaddr, port) = iscsilib.parse_IP_port(portal)
+                        if not self.multihomed and ipaddr != self.target:
+                            continue
+                        portals.append((portal, iqn))
+
+                    def login(node):
+                        (portal, iqn) = node
+                        (ipaddr, port) = iscsilib.parse_IP_port(portal)
+                        util._testHost(ipaddr, long(port), 'ISCSITarget')
+                        util.SMlog("Logging in to [%s:%s]" % (ipaddr,port))
+                        iscsilib.login(portal, iqn, self.chapuser,
+                                       self.chappassword,
+                                       self.incoming_chapuser,
+                                       self.incoming_chappassword,
+                                       self.mpath == "true")
+                    results = util.run_parallel(login, portals,
+                                                self.LOGIN_WORKERS)
+                    paths = []
+                    for (portal, iqn) in portals:
+                        (ok, e) = results[(portal, iqn)]
+                        if ok:
                             npaths = npaths + 1
-                        except Exception, e:
-                            # Exceptions thrown in login are acknowledged, 
-                            # the rest of exceptions are ignored since some of the
-                            # paths in multipath may not be reachable
-                            if str(e) == 'ISCSI login failed, verify CHAP credentials':
-                                raise
-                            else:
-                                pass
+                            paths.append(os.path.join("/dev/iscsi", iqn,
+                                    "%s:%s" % iscsilib.parse_IP_port(portal)))
+                        # Exceptions thrown in login are acknowledged, 
+                        # the rest of exceptions are ignored since some of the
+                        # paths in multipath may not be reachable
+                        elif str(e) == 'ISCSI login failed, verify CHAP credentials':
+                            raise e
 
                     if not iscsilib._checkTGT(self.targetIQN):
                         raise xs_errors.XenError('ISCSIDevice', \
                                                  opterr='during login')
                 
-                    # Allow the devices to settle
-                    time.sleep(5)
+                    # Allow the devices to settle: wait for the LUNs of the
+                    # new sessions to show up and for udev to be done with them
+                    missing = iscsilib.wait_for_luns(paths,
+                                                     self.SETTLE_TIMEOUT)
+                    if missing:
+                        util.SMlog("No LUNs showed up in %s" % missing)
+                    scsiutil.settle(self.SETTLE_TIMEOUT)
                 
                 except util.CommandException, inst:
                     raise xs_errors.XenError('ISCSILogin', \
@@ -470,7 +489,7 @@ class ISCSISR(SR.SR):
             if not self.attached:
                 raise xs_errors.XenError('SRUnavailable')
             self.refresh()
-            time.sleep(2) # it seems impossible to tell when a scan's finished
+            scsiutil.settle()
             self._loadvdis()
             self.physical_utilisation = self.physical_size
             for uuid, vdi in self.vdis.iteritems():
@@ -879,6 +879,127 @@ class LVHDSR(SR.SR):
                     (space_available, amount_needed))
             raise xs_errors.XenError('SRNoSpace')
 
+    def snapshotVDIs(self, vdiUuids, snapType = None):
+        """Snapshot several VDIs of this SR together, e.g. all the disks of a
+        VM, which is cheaper in LVM metadata operations than snapshotting
+        them one by one. Return a dict uuid -> params of the new snapshot.
+
+        No SMAPI command maps to this: it is for callers that load the SR
+        themselves (like a plugin would). It runs under the SR lock, as
+        vdi_snapshot does, taking it unless the caller holds it already; the
+        caller must call cleanup() on the SR afterwards"""
+        if snapType is None:
+            snapType = LVHDVDI.SNAPSHOT_DOUBLE
+        acquired = False
+        if not self.lock.held():
+            self.lock.acquire()
+            acquired = True
+        try:
+            return self._pauseAndSnapshotVDIs(vdiUuids, snapType)
+        finally:
+            if acquired:
+                self.lock.release()
+
+    def _pauseAndSnapshotVDIs(self, vdiUuids, snapType):
+        paused = []
+        try:
+            for uuid in vdiUuids:
+                if not blktap2.VDI.tap_pause(self.session, self.uuid, uuid):
+                    raise util.SMException("failed to pause VDI %s" % uuid)
+                paused.append(uuid)
+            snaps = self._snapshotVDIs(vdiUuids, snapType)
+        except Exception, e1:
+            for uuid in paused:
+                try:
+                    blktap2.VDI.tap_unpause(self.session, self.uuid, uuid,
+                            None)
+                except Exception, e2:
+                    util.SMlog('WARNING: failed to clean up failed snapshot: '
+                            '%s (error ignored)' % e2)
+            raise e1
+        for uuid in paused:
+            blktap2.VDI.tap_unpause(self.session, self.uuid, uuid, None)
+        return snaps
+
+    def _snapshotVDIs(self, vdiUuids, snapType):
+        """Each step of LVHDVDI._snapshot is done for all the VDIs before
+        moving on to the next one, and the steps that LVM can apply to several
+        LVs with one command (hiding the base copies and making them read-
+        only, removing the journals) are done once for the whole group. Each
+        VDI still gets its own clone journal, so an interrupted group snapshot
+        is rolled back or completed VDI by VDI by _handleInterruptedCloneOps.
+        The VDIs must be paused"""
+        util.SMlog("LVHDSR._snapshotVDIs for %s (type %s)" % \
+                (vdiUuids, snapType))
+        origVdiRef = self.srcmd.params.get('vdi_ref')
+        refs = {}
+        group = []
+        try:
+            sizeReq = 0
+            for uuid in vdiUuids:
+                # the VDI code works on the VDI in srcmd.params['vdi_ref']
+                refs[uuid] = self.session.xenapi.VDI.get_by_uuid(uuid)
+                self.srcmd.params['vdi_ref'] = refs[uuid]
+                vdi = self.vdi(uuid)
+                snap = vdi._prepareSnapshot(snapType)
+                sizeReq += snap["sizeReq"]
+                group.append((vdi, snap))
+            self._ensureSpaceAvailable(sizeReq)
+
+            started = []
+            try:
+                for vdi, snap in group:
+                    vdi._startSnapshot(snap)
+                    started.append((vdi, snap))
+                for vdi, snap in group:
+                    vdi._snapshotLVs(snap)
+
+                # the base copies must only be hidden once all the new leaves 
+                # referencing them have been created (see LVHDVDI._snapshot)
+                hiddenLVs = []
+                for vdi, snap in group:
+                    if vdi.vdi_type == vhdutil.VDI_TYPE_RAW:
+                        hiddenLVs.append(vdi.lvname)
+                    else:
+                        vhdutil.setHidden(vdi.path)
+                self.lvmCache.setHiddenMulti(hiddenLVs)
+                util.fistpoint.activate("LVHDRT_clone_vdi_after_parent_hidden", self.uuid)
+
+                self.lvmCache.setReadonlyMulti(
+                        [vdi.lvname for vdi, snap in group], True)
+                util.fistpoint.activate("LVHDRT_clone_vdi_after_parent_ro", self.uuid)
+
+                for vdi, snap in group:
+                    vdi._updateSlavesOnSnapshot(snap)
+            except (util.SMException, XenAPI.Failure), e:
+                util.logException("LVHDSR._snapshotVDIs")
+                for vdi, snap in started:
+                    try:
+                        self._handleInterruptedCloneOp(snap["origUuid"],
+                                snap["jval"], True)
+                        self.journaler.remove(LVHDVDI.JRN_CLONE,
+                                snap["origUuid"])
+                    except Exception, e2:
+                        util.SMlog('WARNING: failed to clean up failed '
+                                'snapshot of %s: %s (error ignored)' % \
+                                (snap["origUuid"], e2))
+                raise xs_errors.XenError('VDIClone', opterr=str(e))
+            util.fistpoint.activate("LVHDRT_clone_vdi_before_remove_journal",self.uuid)
+            self.journaler.removeMulti(LVHDVDI.JRN_CLONE,
+                    [snap["origUuid"] for vdi, snap in group])
+
+            snaps = {}
+            for vdi, snap in group:
+                self.srcmd.params['vdi_ref'] = refs[snap["origUuid"]]
+                snaps[snap["origUuid"]] = vdi._finishSnapshot(
+                        snap["snapVDI"], snap["snapVDI2"], False, snapType)
+            return snaps
+        finally:
+            if origVdiRef:
+                self.srcmd.params['vdi_ref'] = origVdiRef
+            elif self.srcmd.params.has_key('vdi_ref'):
+                del self.srcmd.params['vdi_ref']
+
     def _handleInterruptedCloneOps(self):
         entries = self.journaler.getAll(LVHDVDI.JRN_CLONE)
         for uuid, val in entries.iteritems():
@@ -1212,18 +1333,20 @@ class LVHDSR(SR.SR):
                 "lvName3": baseLV,
                 "uuid3"  : baseUuid}
 
-        masterRef = util.get_this_host_ref(self.session)
-        for hostRef in hostRefs:
-            if hostRef == masterRef:
-                continue
+        def update(session, hostRef):
             util.SMlog("Updating %s, %s, %s on slave %s" % \
                     (origOldLV, origLV, baseLV, hostRef))
-            rv = eval(self.session.xenapi.host.call_plugin(
+            rv = eval(session.xenapi.host.call_plugin(
                     hostRef, self.PLUGIN_ON_SLAVE, "multi", args))
-            util.SMlog("call-plugin returned: %s" % rv)
+            util.SMlog("call-plugin on %s returned: %s" % (hostRef, rv))
             if not rv:
                 raise Exception('plugin %s failed' % self.PLUGIN_ON_SLAVE)
 
+        masterRef = util.get_this_host_ref(self.session)
+        slaves = filter(lambda x: x != masterRef, hostRefs)
+        util.check_host_results(util.call_on_hosts(self.session, slaves,
+            update))
+
     def _cleanup(self, skipLockCleanup = False):
         """delete stale refcounter, flag, and lock files"""
         RefCounter.resetAll(lvhdutil.NS_PREFIX_LVM + self.uuid)
@@ -1636,6 +1759,42 @@ class LVHDVDI(VDI.VDI):
     def _snapshot(self, snapType, cloneOp = False):
         util.SMlog("LVHDVDI._snapshot for %s (type %s)" % (self.uuid, snapType))
 
+        snap = self._prepareSnapshot(snapType)
+        self.sr._ensureSpaceAvailable(snap["sizeReq"])
+
+        self._startSnapshot(snap)
+        try:
+            self._snapshotLVs(snap)
+
+            # note: it is important to mark the parent hidden only AFTER the 
+            # new VHD children have been created, which are referencing it; 
+            # otherwise we would introduce a race with GC that could reclaim 
+            # the parent before we snapshot it 
+            if self.vdi_type == vhdutil.VDI_TYPE_RAW:
+                self.sr.lvmCache.setHidden(self.lvname)
+            else:
+                vhdutil.setHidden(self.path)
+            util.fistpoint.activate("LVHDRT_clone_vdi_after_parent_hidden", self.sr.uuid)
+
+            # set the base copy to ReadOnly
+            self.sr.lvmCache.setReadonly(self.lvname, True)
+            util.fistpoint.activate("LVHDRT_clone_vdi_after_parent_ro", self.sr.uuid)
+
+            self._updateSlavesOnSnapshot(snap)
+
+        except (util.SMException, XenAPI.Failure), e:
+            util.logException("LVHDVDI._snapshot")
+            self._failClone(snap["origUuid"], snap["jval"], str(e))
+        util.fistpoint.activate("LVHDRT_clone_vdi_before_remove_journal",self.sr.uuid)
+        self.sr.journaler.remove(self.JRN_CLONE, snap["origUuid"])
+
+        return self._finishSnapshot(snap["snapVDI"], snap["snapVDI2"],
+                cloneOp, snapType)
+
+    def _prepareSnapshot(self, snapType):
+        """Check that self can be snapshotted and work out the sizes of the
+        new LVs. Return the state of the snapshot operation, to be passed on
+        to the following steps"""
         if not self.sr.isMaster:
             raise xs_errors.XenError('LVMMaster')
         if self.sr.legacyMode:
@@ -1699,72 +1858,63 @@ class LVHDVDI(VDI.VDI):
             lvSizeBase = util.roundup(lvutil.LVM_SIZE_INCREMENT,
                     vhdutil.getSizePhys(self.path))
             size_req -= (self.utilisation - lvSizeBase)
-        self.sr._ensureSpaceAvailable(size_req)
-
-        baseUuid = util.gen_uuid()
-        origUuid = self.uuid
-        clonUuid = ""
-        if snapType == self.SNAPSHOT_DOUBLE:
-            clonUuid = util.gen_uuid()
-        jval = "%s_%s" % (baseUuid, clonUuid)
-        self.sr.journaler.create(self.JRN_CLONE, origUuid, jval)
-        util.fistpoint.activate("LVHDRT_clone_vdi_after_create_journal",self.sr.uuid)
-
-        try:
-            # self becomes the "base vdi"
-            origOldLV = self.lvname
-            baseLV = lvhdutil.LV_PREFIX[self.vdi_type] + baseUuid
-            self.sr.lvmCache.rename(self.lvname, baseLV)
-            self.sr.lvActivator.replace(self.uuid, baseUuid, baseLV, False)
-            RefCounter.set(baseUuid, 1, 0, lvhdutil.NS_PREFIX_LVM + self.sr.uuid)
-            self.uuid = baseUuid
-            self.lvname = baseLV
-            self.path = os.path.join(self.sr.path, baseLV)
-            self.label = "base copy"
-            self.read_only = True
-            self.location = self.uuid
-            self.managed = False
-
-            # shrink the base copy to the minimum - we do it before creating 
-            # the snapshot volumes to avoid requiring double the space
-            if self.vdi_type == vhdutil.VDI_TYPE_VHD:
-                lvhdutil.deflate(self.sr.lvmCache, self.lvname, lvSizeBase)
-                self.utilisation = lvSizeBase
-            util.fistpoint.activate("LVHDRT_clone_vdi_after_shrink_parent", self.sr.uuid)
 
-            snapVDI = self._createSnap(origUuid, lvSizeOrig, False)
-            util.fistpoint.activate("LVHDRT_clone_vdi_after_first_snap", self.sr.uuid)
-            snapVDI2 = None
-            if snapType == self.SNAPSHOT_DOUBLE:
-                snapVDI2 = self._createSnap(clonUuid, lvSizeClon, True)
-            util.fistpoint.activate("LVHDRT_clone_vdi_after_second_snap", self.sr.uuid)
-
-            # note: it is important to mark the parent hidden only AFTER the 
-            # new VHD children have been created, which are referencing it; 
-            # otherwise we would introduce a race with GC that could reclaim 
-            # the parent before we snapshot it 
-            if self.vdi_type == vhdutil.VDI_TYPE_RAW:
-                self.sr.lvmCache.setHidden(self.lvname)
-            else:
-                vhdutil.setHidden(self.path)
-            util.fistpoint.activate("LVHDRT_clone_vdi_after_parent_hidden", self.sr.uuid)
-
-            # set the base copy to ReadOnly
-            self.sr.lvmCache.setReadonly(self.lvname, True)
-            util.fistpoint.activate("LVHDRT_clone_vdi_after_parent_ro", self.sr.uuid)
-
-            if hostRefs:
-                self.sr._updateSlavesOnClone(hostRefs, origOldLV,
-                        snapVDI.lvname, self.uuid, self.lvname)
-
-        except (util.SMException, XenAPI.Failure), e:
-            util.logException("LVHDVDI._snapshot")
-            self._failClone(origUuid, jval, str(e))
-        util.fistpoint.activate("LVHDRT_clone_vdi_before_remove_journal",self.sr.uuid)
-        self.sr.journaler.remove(self.JRN_CLONE, origUuid)
+        return {"snapType": snapType, "hostRefs": hostRefs,
+                "lvSizeOrig": lvSizeOrig, "lvSizeClon": lvSizeClon,
+                "lvSizeBase": lvSizeBase, "sizeReq": size_req}
+
+    def _startSnapshot(self, snap):
+        """Journal the snapshot operation, so that it gets rolled back or
+        completed by _handleInterruptedCloneOp if it gets interrupted"""
+        snap["baseUuid"] = util.gen_uuid()
+        snap["origUuid"] = self.uuid
+        snap["clonUuid"] = ""
+        if snap["snapType"] == self.SNAPSHOT_DOUBLE:
+            snap["clonUuid"] = util.gen_uuid()
+        snap["jval"] = "%s_%s" % (snap["baseUuid"], snap["clonUuid"])
+        self.sr.journaler.create(self.JRN_CLONE, snap["origUuid"],
+                snap["jval"])
+        util.fistpoint.activate("LVHDRT_clone_vdi_after_create_journal",self.sr.uuid)
 
-        return self._finishSnapshot(snapVDI, snapVDI2, cloneOp, snapType)
+    def _snapshotLVs(self, snap):
+        """Turn self into the base copy and create the new leaves on top of it.
+        The base copy is not hidden nor read-only yet"""
+        # self becomes the "base vdi"
+        baseUuid = snap["baseUuid"]
+        snap["origOldLV"] = self.lvname
+        baseLV = lvhdutil.LV_PREFIX[self.vdi_type] + baseUuid
+        self.sr.lvmCache.rename(self.lvname, baseLV)
+        self.sr.lvActivator.replace(self.uuid, baseUuid, baseLV, False)
+        RefCounter.set(baseUuid, 1, 0, lvhdutil.NS_PREFIX_LVM + self.sr.uuid)
+        self.uuid = baseUuid
+        self.lvname = baseLV
+        self.path = os.path.join(self.sr.path, baseLV)
+        self.label = "base copy"
+        self.read_only = True
+        self.location = self.uuid
+        self.managed = False
 
+        # shrink the base copy to the minimum - we do it before creating 
+        # the snapshot volumes to avoid requiring double the space
+        if self.vdi_type == vhdutil.VDI_TYPE_VHD:
+            lvhdutil.deflate(self.sr.lvmCache, self.lvname,
+                    snap["lvSizeBase"])
+            self.utilisation = snap["lvSizeBase"]
+        util.fistpoint.activate("LVHDRT_clone_vdi_after_shrink_parent", self.sr.uuid)
+
+        snap["snapVDI"] = self._createSnap(snap["origUuid"],
+                snap["lvSizeOrig"], False)
+        util.fistpoint.activate("LVHDRT_clone_vdi_after_first_snap", self.sr.uuid)
+        snap["snapVDI2"] = None
+        if snap["snapType"] == self.SNAPSHOT_DOUBLE:
+            snap["snapVDI2"] = self._createSnap(snap["clonUuid"],
+                    snap["lvSizeClon"], True)
+        util.fistpoint.activate("LVHDRT_clone_vdi_after_second_snap", self.sr.uuid)
+
+    def _updateSlavesOnSnapshot(self, snap):
+        if snap["hostRefs"]:
+            self.sr._updateSlavesOnClone(snap["hostRefs"], snap["origOldLV"],
+                    snap["snapVDI"].lvname, self.uuid, self.lvname)
 
     def _createSnap(self, snapUuid, snapSizeLV, isNew):
         """Snapshot self and return the snapshot VDI object"""
@@ -2043,18 +2193,21 @@ class LVHDVDI(VDI.VDI):
         if self.vdi_type == vhdutil.VDI_TYPE_VHD:
             vdiList = vhdutil.getParentChain(self.lvname,
                     lvhdutil.extractUuid, self.sr.vgname)
+        lvs = []
         for uuid, lvName in vdiList.iteritems():
             binaryParam = binary
             if uuid != self.uuid:
                 binaryParam = False # binary param only applies to leaf nodes
             if active:
-                self.sr.lvActivator.activate(uuid, lvName, binaryParam,
-                        persistent)
+                lvs.append((uuid, lvName, binaryParam))
             else:
                 # just add the LVs for deactivation in the final (cleanup) 
                 # step. The LVs must not have been activated during the current 
                 # operation
                 self.sr.lvActivator.add(uuid, lvName, binaryParam)
+        if lvs:
+            # the whole chain with one refcount update and one lvchange
+            self.sr.lvActivator.activateMulti(lvs, persistent)
 
     def _failClone(self, uuid, jval, msg):
         try:
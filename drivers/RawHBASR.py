@@ -86,6 +86,7 @@ class RawHBASR(HBASR.HBASR):
 
         xapi_session = self.session.xenapi
         known_scsid = {} # dict of ids processed within the following loop
+        pbds = util.PBDIndex(self.session)
 
         for key in self.hbadict.iterkeys():
 
@@ -115,7 +116,7 @@ class RawHBASR(HBASR.HBASR):
                 else:
                     # marked as known to avoid adding it again to sm_config
                     known_scsid[scsi_key] = ""
-            elif util.test_SCSIid(self.session, None, scsi_id):
+            elif util.test_SCSIid(self.session, None, scsi_id, pbds):
                 util.SMlog("This SCSI id (%s) is used by another SR" %scsi_id)
                 continue
 
@@ -23,8 +23,12 @@ import xml.dom.minidom
 import errno
 import xs_errors
 import XenAPI, xmlrpclib, util
-import copy, os
+import copy, os, sys
 import traceback
+import threading
+import Queue
+import time
+import smtrace
 
 MOUNT_BASE = '/var/run/sr-mount'
 DEFAULT_TAP = 'vhd'
@@ -94,7 +98,7 @@ class SR(object):
             self.dconf = srcmd.dconf
             if srcmd.params.has_key('session_ref'):
                 self.session_ref = srcmd.params['session_ref']
-                self.session = XenAPI.xapi_local()
+                self.session = smtrace.traceSession(XenAPI.xapi_local())
                 self.session._session = self.session_ref
                 if 'subtask_of' in self.srcmd.params:
                     self.session.transport.add_extra_header('Subtask-of', self.srcmd.params['subtask_of'])
@@ -507,6 +511,12 @@ class SR(object):
 
 
 class ScanRecord:
+    # Above this many VDIs to introduce or update, the XenAPI calls are
+    # spread over up to SYNC_SESSIONS sessions so that we do not wait for 
+    # each round trip in turn
+    PARALLEL_SYNC_MIN = 16
+    SYNC_SESSIONS = 4
+
     def __init__(self, sr):
         self.sr = sr
         self.__xenapi_locations = {}
@@ -566,15 +576,88 @@ class ScanRecord:
     def all_xenapi_locations(self):
 	return set(self.__xenapi_locations.keys())
 
+    def _open_sync_sessions(self, num):
+        sessions = []
+        try:
+            for i in range(num):
+                sessions.append(util.get_localAPI_session())
+        except Exception, e:
+            util.SMlog("Synchronising with %d extra sessions only: %s" % \
+                    (len(sessions), e))
+        return sessions
+
+    def _run_sync(self, phase, locations, func):
+        """Call func(session, location) for each location, spreading the 
+        calls over several XenAPI sessions if there are many, and log how
+        long the phase took"""
+        start = time.time()
+        sessions = [self.sr.session]
+        extra_sessions = []
+        if len(locations) >= self.PARALLEL_SYNC_MIN:
+            num = min(self.SYNC_SESSIONS, len(locations)) - 1
+            extra_sessions = self._open_sync_sessions(num)
+            sessions += extra_sessions
+        try:
+            if len(sessions) == 1:
+                for location in locations:
+                    func(self.sr.session, location)
+            else:
+                self._run_sync_parallel(sessions, locations, func)
+        finally:
+            for session in extra_sessions:
+                try:
+                    session.xenapi.session.logout()
+                except:
+                    pass
+            util.SMlog("ScanRecord: %s %d VDIs took %.3fs (%d sessions)" % \
+                    (phase, len(locations), time.time() - start,
+                        len(sessions)))
+
+    def _run_sync_parallel(self, sessions, locations, func):
+        queue = Queue.Queue()
+        for location in locations:
+            queue.put(location)
+        errors = []
+
+        def worker(session):
+            while not errors:
+                try:
+                    location = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    func(session, location)
+                except:
+                    errors.append(sys.exc_info())
+
+        threads = []
+        for session in sessions:
+            thread = threading.Thread(target = worker, args = (session,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _introduce(self, session, location):
+        vdi = self.get_sm_vdi(location)
+        util.SMlog("Introducing VDI with location=%s" % (vdi.location))
+        vdi._db_introduce(session)
+
+    def _update(self, session, location):
+        vdi = self.get_sm_vdi(location)
+        util.SMlog("Updating VDI with location=%s uuid=%s" % (vdi.location, vdi.uuid))
+        vdi._db_update(session, self.__xenapi_locations[location],
+                self.get_xenapi_vdi(location))
+
     def synchronise_new(self):
         """Add XenAPI records for new disks"""
-        for location in self.new:
-            vdi = self.get_sm_vdi(location)
-            util.SMlog("Introducing VDI with location=%s" % (vdi.location))
-            vdi._db_introduce()
+        self._run_sync("introduce", list(self.new), self._introduce)
             
     def synchronise_gone(self):
         """Delete XenAPI record for old disks"""
+        start = time.time()
         for location in self.gone:
             vdi = self.get_xenapi_vdi(location)
             util.SMlog("Forgetting VDI with location=%s uuid=%s" % (util.to_plain_string(vdi['location']), vdi['uuid']))
@@ -586,14 +669,13 @@ class ScanRecord:
                            % vdi['uuid'])
                 else:
                    raise
+        util.SMlog("ScanRecord: forget %d VDIs took %.3fs" % \
+                (len(self.gone), time.time() - start))
 
     def synchronise_existing(self):
-        """Update existing XenAPI records"""
-        for location in self.existing:
-            vdi = self.get_sm_vdi(location)
-            
-            util.SMlog("Updating VDI with location=%s uuid=%s" % (vdi.location, vdi.uuid))
-            vdi._db_update()
+        """Update existing XenAPI records, setting only the fields that have
+        changed"""
+        self._run_sync("update", list(self.existing), self._update)
             
     def synchronise(self):
         """Perform the default SM -> xenapi synchronisation; ought to be good enough
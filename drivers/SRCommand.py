@@ -27,6 +27,7 @@ import blktap2
 import resetvdis
 import os
 import copy
+import smtrace
 
 NEEDS_VDI_OBJECT = [
         "vdi_update", "vdi_create", "vdi_delete", "vdi_snapshot", "vdi_clone",
@@ -106,6 +107,7 @@ class SRCommand:
             sys.exit(0)
 
     def run(self, sr):
+        span = smtrace.Span(smtrace.TYPE_OP, self.cmd)
         try:
             return self._run_locked(sr)
         except (util.CommandException, util.SMException, XenAPI.Failure), e:
@@ -132,6 +134,9 @@ class SRCommand:
             util.logException('generic exception: %s' % self.cmd)
             raise
 
+        finally:
+            span.end()
+
     def _run_locked(self, sr):
         lockSR = False
         lockInitOnly = False
@@ -296,7 +296,9 @@ class VDI(object):
         """Post-init hook"""
         pass
 
-    def _db_introduce(self):
+    def _db_introduce(self, session = None):
+        if not session:
+            session = self.sr.session
         uuid = util.default(self, "uuid", lambda: util.gen_uuid())
         sm_config = util.default(self, "sm_config", lambda: {})
         if self.sr.srcmd.params.has_key("vdi_sm_config"):
@@ -309,7 +311,7 @@ class VDI(object):
         metadata_of_pool = util.default(self, "metadata_of_pool", lambda: "OpaqueRef:NULL")
         snapshot_time = util.default(self, "snapshot_time", lambda: "19700101T00:00:00Z")
         snapshot_of = util.default(self, "snapshot_of", lambda: "OpaqueRef:NULL")
-        vdi = self.sr.session.xenapi.VDI.db_introduce(uuid, self.label, self.description, self.sr.sr_ref, ty, self.shareable, self.read_only, {}, self.location, {}, sm_config, self.managed, str(self.size), str(self.utilisation), metadata_of_pool, is_a_snapshot, xmlrpclib.DateTime(snapshot_time), snapshot_of)
+        vdi = session.xenapi.VDI.db_introduce(uuid, self.label, self.description, self.sr.sr_ref, ty, self.shareable, self.read_only, {}, self.location, {}, sm_config, self.managed, str(self.size), str(self.utilisation), metadata_of_pool, is_a_snapshot, xmlrpclib.DateTime(snapshot_time), snapshot_of)
         return vdi
 
     def _db_forget(self):
@@ -327,9 +329,13 @@ class VDI(object):
                 util.SMlog("_override_sm_config: del %s" % key)
                 del sm_config[key]
 
-    def _db_update_sm_config(self, ref, sm_config):
+    def _db_update_sm_config(self, ref, sm_config, current_sm_config = None,
+            session = None):
         import cleanup
-        current_sm_config = self.sr.session.xenapi.VDI.get_sm_config(ref)
+        if not session:
+            session = self.sr.session
+        if current_sm_config is None:
+            current_sm_config = session.xenapi.VDI.get_sm_config(ref)
         for key, val in sm_config.iteritems():
             if key.startswith("host_") or \
                 key in ["paused", cleanup.VDI.DB_VHD_BLOCKS]:
@@ -337,8 +343,8 @@ class VDI(object):
             if sm_config.get(key) != current_sm_config.get(key):
                 util.SMlog("_db_update_sm_config: %s sm-config:%s %s->%s" % \
                         (self.uuid, key, current_sm_config.get(key), val))
-                self.sr.session.xenapi.VDI.remove_from_sm_config(ref, key)
-                self.sr.session.xenapi.VDI.add_to_sm_config(ref, key, val)
+                session.xenapi.VDI.remove_from_sm_config(ref, key)
+                session.xenapi.VDI.add_to_sm_config(ref, key, val)
 
         for key in current_sm_config.keys():
             if key.startswith("host_") or \
@@ -348,16 +354,28 @@ class VDI(object):
             if not sm_config.get(key):
                 util.SMlog("_db_update_sm_config: %s del sm-config:%s" % \
                         (self.uuid, key))
-                self.sr.session.xenapi.VDI.remove_from_sm_config(ref, key)
-
-    def _db_update(self):
-        vdi = self.sr.session.xenapi.VDI.get_by_uuid(self.uuid)
-        self.sr.session.xenapi.VDI.set_virtual_size(vdi, str(self.size))
-        self.sr.session.xenapi.VDI.set_physical_utilisation(vdi, str(self.utilisation))
-        self.sr.session.xenapi.VDI.set_read_only(vdi, self.read_only)
+                session.xenapi.VDI.remove_from_sm_config(ref, key)
+
+    def _db_update(self, session = None, vdi = None, record = None):
+        """Update the XenAPI record of this VDI. If the current XenAPI record
+        is supplied (as in SR.ScanRecord), only the fields that differ from
+        it are set"""
+        if not session:
+            session = self.sr.session
+        if not vdi:
+            vdi = session.xenapi.VDI.get_by_uuid(self.uuid)
+        if not record or str(self.size) != record['virtual_size']:
+            session.xenapi.VDI.set_virtual_size(vdi, str(self.size))
+        if not record or str(self.utilisation) != record['physical_utilisation']:
+            session.xenapi.VDI.set_physical_utilisation(vdi, str(self.utilisation))
+        if not record or self.read_only != record['read_only']:
+            session.xenapi.VDI.set_read_only(vdi, self.read_only)
         sm_config = util.default(self, "sm_config", lambda: {})
         self._override_sm_config(sm_config)
-        self._db_update_sm_config(vdi, sm_config)
+        current_sm_config = None
+        if record:
+            current_sm_config = record['sm_config']
+        self._db_update_sm_config(vdi, sm_config, current_sm_config, session)
         
     def in_sync_with_xenapi_record(self, x):
         """Returns true if this VDI is in sync with the supplied XenAPI record"""
@@ -41,6 +41,7 @@ from SR import SROSError
 
 import resetvdis
 import vhdutil
+import smtrace
 
 # For RRDD Plugin Registration
 from SocketServer import UnixStreamServer
@@ -137,6 +138,10 @@ class TapCtl(object):
 
     PATH = "/usr/sbin/tap-ctl"
 
+    # commands changing the tapdisks listed by tap-ctl list
+    MUTATORS = [ "spawn", "attach", "detach", "open", "close",
+                 "pause", "unpause" ]
+
     def __init__(self, cmd, p):
         self.cmd    = cmd
         self._p     = p
@@ -282,12 +287,20 @@ class TapCtl(object):
         """
         Spawn a tap-ctl invocation and read a single line.
         """
-        tapctl = cls._call(args, quiet)
+        span = smtrace.Span(smtrace.TYPE_TAPCTL, args[0])
+        try:
+            tapctl = cls._call(args, quiet)
+
+            output = tapctl.stdout.readline().rstrip()
 
-        output = tapctl.stdout.readline().rstrip()
+            tapctl._wait(quiet)
+            return output
 
-        tapctl._wait(quiet)
-        return output
+        finally:
+            # NB. even failed commands may have changed tapdisk state
+            if args[0] in cls.MUTATORS:
+                TapdiskRegistry.invalidate()
+            span.end()
 
     @staticmethod
     def _maybe(opt, parm):
@@ -340,6 +353,7 @@ class TapCtl(object):
         # with SM ops and a tapdisk shuts down under our feet. Should
         # be fixed in SM.
 
+        span = smtrace.Span(smtrace.TYPE_TAPCTL, "list")
         try:
             return list(cls.__list(**args))
 
@@ -349,6 +363,9 @@ class TapCtl(object):
                 raise RetryLoop.TransientFailure(e)
             raise
 
+        finally:
+            span.end()
+
     @classmethod
     def allocate(cls, devpath = None):
         args = [ "allocate" ]
@@ -431,6 +448,76 @@ class TapCtl(object):
         major = cls._pread(args)
         return int(major)
 
+class TapdiskRegistry(object):
+    """
+    The tapdisks on this host, as listed by tap-ctl. One listing is
+    shared by all lookups in this process, indexed by minor, pid and
+    path. Our own TapCtl.MUTATORS invalidate it; changes made by other
+    processes are picked up once the listing is older than MAX_AGE.
+    Lookups guarding tapdisk creation should invalidate() first.
+    """
+
+    MAX_AGE = 2.0
+
+    __rows    = None
+    __stamp   = 0
+    __index   = {}
+
+    @classmethod
+    def invalidate(cls):
+        cls.__rows = None
+
+    @classmethod
+    def __load(cls):
+        now = time.time()
+        if cls.__rows is not None and \
+                0 <= now - cls.__stamp < cls.MAX_AGE:
+            return
+
+        rows  = TapCtl.list()
+        index = { 'minor' : {}, 'pid' : {}, 'path' : {} }
+
+        for row in rows:
+            if 'args' in row:
+                try:
+                    image = Tapdisk.Arg.parse(row['args'])
+                    row['_type'] = image.type
+                    row['path']  = image.path
+                except (Tapdisk.Arg.InvalidArgument,
+                        Tapdisk.Arg.InvalidType):
+                    pass
+            for key, rows_by_key in index.iteritems():
+                if key in row:
+                    rows_by_key.setdefault(row[key], []).append(row)
+
+        cls.__rows  = rows
+        cls.__index = index
+        cls.__stamp = now
+
+    @classmethod
+    def list(cls, **args):
+        """
+        Return the tap-ctl list rows matching all of @args (minor,
+        pid, _type, path), like tap-ctl list with the corresponding
+        filters.
+        """
+        for key in ('minor', 'pid'):
+            if args.get(key) is not None:
+                args[key] = int(args[key])
+
+        cls.__load()
+
+        rows = cls.__rows
+        for key in ('minor', 'pid', 'path'):
+            if args.get(key) is not None:
+                rows = cls.__index[key].get(args[key], [])
+                break
+
+        return [ row for row in rows
+                 if all(row.get(key) == val
+                        for key, val in args.iteritems()
+                        if val is not None) ]
+
 class TapdiskExists(Exception):
     """Tapdisk already running."""
 
@@ -652,7 +739,7 @@ class Tapdisk(object):
     @classmethod
     def list(cls, **args):
 
-        for row in TapCtl.list(**args):
+        for row in TapdiskRegistry.list(**args):
 
             args =  { 'pid'     : None,
                       'minor'   : None,
@@ -664,11 +751,6 @@ class Tapdisk(object):
                 if key in args:
                     args[key] = val
 
-            if 'args' in row:
-                image = Tapdisk.Arg.parse(row['args'])
-                args['_type'] = image.type
-                args['path']  = image.path
-
             if None in args.values():
                 continue
 
@@ -860,8 +942,8 @@ class Tapdisk(object):
         self._set_dirty()
 
     def stats(self):
-        json = TapCtl.stats(self.pid, self.minor)
-        return json.loads(json)
+        data = TapCtl.stats(self.pid, self.minor)
+        return json.loads(data)
 
     #
     # NB. dirty/refresh: reload attributes on next access
@@ -1268,6 +1350,9 @@ class VDI(object):
     @staticmethod
     def _tap_activate(phy_path, vdi_type, sr_uuid, options, pool_size = None):
 
+        # NB. we are about to launch a tapdisk if there is none: make
+        # sure we see any launched by others since we last looked
+        TapdiskRegistry.invalidate()
         tapdisk = Tapdisk.find_by_path(phy_path)
         if not tapdisk:
             blktap = Blktap.allocate()
@@ -1327,14 +1412,14 @@ class VDI(object):
         vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
         session.xenapi.VDI.add_to_sm_config(vdi_ref, 'paused', 'true')
         sm_config = session.xenapi.VDI.get_sm_config(vdi_ref)
-        for key in filter(lambda x: x.startswith('host_'), sm_config.keys()):
-            host_ref = key[len('host_'):]
-            util.SMlog("Calling tap-pause on host %s" % host_ref)
-            if not cls.call_pluginhandler(session, host_ref,
-                    sr_uuid, vdi_uuid, "pause", failfast=failfast):
-                # Failed to pause node
-                session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
-                return False
+        # no time-out: a pause given up on could still go through after we
+        # dropped the paused flag
+        if not cls.call_pluginhandler_on_hosts(session, sm_config, sr_uuid,
+                vdi_uuid, "pause", failfast=failfast, timeout=None,
+                undo_action="unpause"):
+            # Failed to pause node
+            session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
+            return False
         return True
 
     @classmethod
@@ -1343,13 +1428,10 @@ class VDI(object):
         util.SMlog("Unpause request for %s secondary=%s" % (vdi_uuid, secondary))
         vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
         sm_config = session.xenapi.VDI.get_sm_config(vdi_ref)
-        for key in filter(lambda x: x.startswith('host_'), sm_config.keys()):
-            host_ref = key[len('host_'):]
-            util.SMlog("Calling tap-unpause on host %s" % host_ref)
-            if not cls.call_pluginhandler(session, host_ref,
-                    sr_uuid, vdi_uuid, "unpause", secondary, activate_parents):
-                # Failed to unpause node
-                return False
+        if not cls.call_pluginhandler_on_hosts(session, sm_config, sr_uuid,
+                vdi_uuid, "unpause", secondary, activate_parents):
+            # Failed to unpause node
+            return False
         session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
         return True
 
@@ -1358,14 +1440,44 @@ class VDI(object):
         util.SMlog("Refresh request for %s" % vdi_uuid)
         vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
         sm_config = session.xenapi.VDI.get_sm_config(vdi_ref)
+        return cls.call_pluginhandler_on_hosts(session, sm_config, sr_uuid,
+                vdi_uuid, "refresh", None, activate_parents)
+
+    @classmethod
+    def call_pluginhandler_on_hosts(cls, session, sm_config, sr_uuid,
+            vdi_uuid, action, secondary = None, activate_parents = False,
+            failfast = False, timeout = util.HOST_CALL_TIMEOUT,
+            undo_action = None):
+        """Call the tap-pause plugin action on all the hosts the VDI is
+        attached on (as per its sm_config) at once. Return True if it
+        succeeded on all of them. Otherwise, if undo_action is given, it is
+        called on the hosts the action succeeded on"""
+        host_refs = []
         for key in filter(lambda x: x.startswith('host_'), sm_config.keys()):
-            host_ref = key[len('host_'):]
-            util.SMlog("Calling tap-refresh on host %s" % host_ref)
-            if not cls.call_pluginhandler(session, host_ref,
-                    sr_uuid, vdi_uuid, "refresh", None, activate_parents):
-                # Failed to refresh node
-                return False
-        return True
+            host_refs.append(key[len('host_'):])
+            util.SMlog("Calling tap-%s on host %s" % (action, host_refs[-1]))
+        results = util.call_on_hosts(session, host_refs,
+                lambda session, host_ref: cls.call_pluginhandler(session,
+                    host_ref, sr_uuid, vdi_uuid, action, secondary,
+                    activate_parents, failfast), timeout)
+        done = []
+        for host_ref, (ok, ret) in results.iteritems():
+            if not ok:
+                util.SMlog("tap-%s on host %s failed: %s" % (action, host_ref,
+                    ret))
+            if ok and ret:
+                done.append(host_ref)
+        if len(done) == len(host_refs):
+            return True
+        if undo_action and done:
+            for host_ref in done:
+                util.SMlog("Calling tap-%s on host %s to undo tap-%s" % \
+                        (undo_action, host_ref, action))
+            util.call_on_hosts(session, done,
+                    lambda session, host_ref: cls.call_pluginhandler(session,
+                        host_ref, sr_uuid, vdi_uuid, undo_action),
+                    timeout)
+        return False
 
     @classmethod
     def call_pluginhandler(cls, session, host_ref, sr_uuid, vdi_uuid, action,
@@ -29,7 +29,10 @@ import exceptions
 import traceback
 import base64
 import zlib
+import binascii
 import errno
+import glob
+import json
 
 import XenAPI
 import util
@@ -40,6 +43,7 @@ import lvmcache
 import journaler
 import fjournaler
 import lock
+import smtrace
 import blktap2
 from refcounter import RefCounter
 from ipc import IPCFlag
@@ -55,6 +59,7 @@ from srmetadata import LVMMetadataHandler
 AUTO_ONLINE_LEAF_COALESCE_ENABLED = True
 
 FLAG_TYPE_ABORT = "abort"     # flag to request aborting of GC/coalesce
+FLAG_TYPE_WAKEUP = "wakeup"   # flag to kick the resident GC of an SR
 
 # process "lock", used simply as an indicator that a process already exists 
 # that is doing GC/coalesce on this SR (such a process holds the lock, and we 
@@ -62,6 +67,17 @@ FLAG_TYPE_ABORT = "abort"     # flag to request aborting of GC/coalesce
 LOCK_TYPE_RUNNING = "running" 
 lockRunning = None
 
+# held for as long as a GC process stays resident for an SR, waiting for kicks
+# instead of exiting when it runs out of work
+LOCK_TYPE_RESIDENT = "resident"
+lockResident = None
+
+# how long (in seconds) a background GC stays resident without being kicked
+# before it exits (0 makes it exit as soon as there is no work), and how often
+# it checks for kicks and abort requests meanwhile
+RESIDENT_IDLE_TIMEOUT = 300
+RESIDENT_POLL_INTERVAL = 1
+
 # Default coalesce error rate limit, in messages per minute. A zero value
 # disables throttling, and a negative value disables error reporting.
 DEFAULT_COALESCE_ERR_RATE = 1.0/60
@@ -69,6 +85,22 @@ DEFAULT_COALESCE_ERR_RATE = 1.0/60
 COALESCE_LAST_ERR_TAG = 'last-coalesce-error'
 COALESCE_ERR_RATE_TAG = 'coalesce-error-rate'
 
+# Maximum number of VHD chains (each in a different VHD tree) that are
+# coalesced concurrently, set in the SR other-config
+COALESCE_WORKERS_TAG = 'coalesce-workers'
+DEFAULT_COALESCE_WORKERS = 1
+
+# The most bandwidth (in MiB/s) and read/write calls per second that VHD
+# coalesce may use on the SR, set in the SR other-config (unlimited if unset).
+# The budget shrinks while the VMs on the SR are busy (see IOThrottle)
+COALESCE_BANDWIDTH_TAG = 'coalesce-bandwidth'
+COALESCE_IOPS_TAG = 'coalesce-iops'
+
+# the longest a VM may be paused for to leaf-coalesce one of its VDIs (in
+# seconds), overridable in the SR's other-config
+LEAF_COALESCE_MAX_PAUSE_TAG = 'leaf-coalesce-max-pause'
+DEFAULT_LEAF_COALESCE_MAX_PAUSE = 1.0
+
 class AbortException(util.SMException):
     pass
 
@@ -134,9 +166,11 @@ class Util:
         return stdout
     doexec = staticmethod(doexec)
 
-    def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut):
+    def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut,
+            throttle = None):
         """execute func in a separate thread and kill it if abortTest signals
-        so"""
+        so. If throttle (an IOThrottle) is given, the I/O of func is kept
+        within its budget"""
         abortSignaled = abortTest() # check now before we clear resultFlag
         resultFlag = IPCFlag(ns)
         resultFlag.clearAll()
@@ -158,9 +192,13 @@ class Util:
                     os.killpg(pid, signal.SIGKILL)
                     resultFlag.clearAll()
                     raise util.SMException("Timed out")
-                time.sleep(pollInterval)
+                if throttle:
+                    throttle.wait([pid], pollInterval)
+                else:
+                    time.sleep(pollInterval)
         else:
             os.setpgrp()
+            smtrace.reset()
             try:
                 if func() == ret:
                     resultFlag.set("success")
@@ -172,6 +210,72 @@ class Util:
             os._exit(0)
     runAbortable = staticmethod(runAbortable)
 
+    def runAbortableParallel(funcs, ret, ns, abortTest, pollInterval, timeOut,
+            throttle = None):
+        """execute each function in funcs (name -> func) in a separate
+        process, all of them concurrently, and kill them all if abortTest
+        signals so. Return a dict name -> True if the function returned 'ret'
+        and False if it failed or timed out. If throttle (an IOThrottle) is
+        given, the functions share its I/O budget"""
+        if abortTest():
+            raise AbortException("Aborting due to signal")
+        resultFlag = IPCFlag(ns)
+        for name in funcs.iterkeys():
+            resultFlag.clear("success-%s" % name)
+            resultFlag.clear("failure-%s" % name)
+        pids = dict()
+        for name, func in funcs.iteritems():
+            pid = os.fork()
+            if pid:
+                pids[name] = pid
+                continue
+            os.setpgrp()
+            smtrace.reset()
+            try:
+                if func() == ret:
+                    resultFlag.set("success-%s" % name)
+                else:
+                    resultFlag.set("failure-%s" % name)
+            except Exception, e:
+                resultFlag.set("failure-%s" % name)
+                Util.log("Child process %s failed with : (%s)" % (name, e))
+            os._exit(0)
+
+        results = dict()
+        startTime = time.time()
+        while pids:
+            for name in pids.keys():
+                for result in [True, False]:
+                    flag = "%s-%s" % (("failure", "success")[result], name)
+                    if resultFlag.test(flag):
+                        resultFlag.clear(flag)
+                        os.waitpid(pids[name], 0)
+                        del pids[name]
+                        results[name] = result
+                        Util.log("  Child process %s completed (%s)" % \
+                                (name, ("failed", "success")[result]))
+                        break
+            if not pids:
+                break
+            if abortTest():
+                for pid in pids.values():
+                    os.killpg(pid, signal.SIGKILL)
+                raise AbortException("Aborting due to signal")
+            if timeOut and time.time() - startTime > timeOut:
+                for name, pid in pids.iteritems():
+                    os.killpg(pid, signal.SIGKILL)
+                    resultFlag.clear("success-%s" % name)
+                    resultFlag.clear("failure-%s" % name)
+                    results[name] = False
+                Util.log("  Timed out waiting for %s" % pids.keys())
+                break
+            if throttle:
+                throttle.wait(pids.values(), pollInterval)
+            else:
+                time.sleep(pollInterval)
+        return results
+    runAbortableParallel = staticmethod(runAbortableParallel)
+
     def num2str(number):
         for prefix in ("G", "M", "K"):
             if number >= Util.PREFIX[prefix]:
@@ -179,35 +283,9 @@ class Util:
         return "%s" % number
     num2str = staticmethod(num2str)
 
-    def numBits(val):
-        count = 0
-        while val:
-            count += val & 1
-            val = val >> 1
-        return count
-    numBits = staticmethod(numBits)
-
     def countBits(bitmap1, bitmap2):
         """return bit count in the bitmap produced by ORing the two bitmaps"""
-        len1 = len(bitmap1)
-        len2 = len(bitmap2)
-        lenLong = len1
-        lenShort = len2
-        bitmapLong = bitmap1
-        if len2 > len1:
-            lenLong = len2
-            lenShort = len1
-            bitmapLong = bitmap2
-
-        count = 0
-        for i in range(lenShort):
-            val = ord(bitmap1[i]) | ord(bitmap2[i])
-            count += Util.numBits(val)
-
-        for i in range(i + 1, lenLong):
-            val = ord(bitmapLong[i])
-            count += Util.numBits(val)
-        return count
+        return (Bitmap(bitmap1) | bitmap2).count()
     countBits = staticmethod(countBits)
 
     def getThisScript():
@@ -218,6 +296,310 @@ class Util:
     getThisScript = staticmethod(getThisScript)
 
 
+class Bitmap:
+    """A VHD block allocation bitmap. The bitwise operations are done on the
+    whole bitmap at once as a long integer, and the bits are counted with a
+    per-byte lookup table, so that bitmaps of large VHDs (128KB for 2TB) do
+    not need to be walked bit by bit in Python. Bitmaps of different lengths
+    are aligned at the first byte, the missing bytes of the shorter one being
+    all zeros."""
+
+    POPCOUNT = "".join([chr(bin(i).count("1")) for i in range(256)])
+
+    def __init__(self, data = ""):
+        if isinstance(data, Bitmap):
+            data = data.data
+        self.data = bytearray(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        return str(self.data)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def count(self):
+        "Return the number of bits set"
+        return sum(self.data.translate(Bitmap.POPCOUNT))
+
+    def _toLong(self, length):
+        if not length:
+            return 0
+        return long(binascii.hexlify(self.data.ljust(length, "\0")), 16)
+
+    def _fromLong(val, length):
+        if not length:
+            return Bitmap()
+        return Bitmap(binascii.unhexlify("%0*x" % (length * 2, val)))
+    _fromLong = staticmethod(_fromLong)
+
+    def __or__(self, other):
+        other = Bitmap(other)
+        length = max(len(self), len(other))
+        return Bitmap._fromLong(self._toLong(length) | other._toLong(length),
+                length)
+
+    def __sub__(self, other):
+        "The bits set in self but not in other (AND-NOT)"
+        length = len(self)
+        other = Bitmap(Bitmap(other).data[:length])
+        return Bitmap._fromLong(self._toLong(length) & \
+                ~other._toLong(length), length)
+
+
+################################################################################
+#
+#  Coalesce I/O throttling
+#
+class IOThrottle:
+    """Rate limit the I/O of process groups (the coalesce children) by
+    stopping them whenever they get ahead of a bandwidth and/or IOPS budget.
+    The budget adapts to the VMs using the SR, as seen in the stats of their
+    tapdisks: it is halved whenever their request queues grow, and raised
+    back towards the configured maximum whenever they are idle"""
+
+    ADAPT_INTERVAL = 5 # seconds between looks at the VMs' tapdisk stats
+    MIN_FRACTION = 1.0 / 16 # of the configured budget
+    RAMP_STEP = 0.25 # of the configured budget
+
+    def __init__(self, srUuid, bandwidth, iops):
+        """bandwidth: the most bytes per second (0: unlimited)
+        iops: the most read/write calls per second (0: unlimited)"""
+        self.srUuid = srUuid
+        self.maxBandwidth = bandwidth
+        self.maxIops = iops
+        self.fraction = 1.0
+        self.debt = 0.0
+        self.last = None
+        self.lastAdapt = 0
+        self.lastLoad = None
+
+    def getBudget(self):
+        return (self.maxBandwidth * self.fraction, self.maxIops * self.fraction)
+
+    def getMinBudget(self):
+        """The lowest the budget may be lowered to"""
+        return (self.maxBandwidth * self.MIN_FRACTION,
+                self.maxIops * self.MIN_FRACTION)
+
+    def wait(self, pgids, interval):
+        """Sleep for interval seconds, keeping the process groups pgids
+        stopped for as much of it as it takes to stay within the budget"""
+        now = time.time()
+        if now - self.lastAdapt >= self.ADAPT_INTERVAL:
+            self.lastAdapt = now
+            self._adapt(self._getVMLoad())
+        done = IOThrottle._getIO(pgids)
+        if self.last:
+            lastTime, lastDone = self.last
+            bandwidth, iops = self.getBudget()
+            elapsed = now - lastTime
+            # how long the I/O done since the last call should have taken,
+            # beyond the time that has actually passed
+            ahead = -elapsed
+            if bandwidth:
+                ahead = max(ahead, (done[0] - lastDone[0]) / bandwidth - elapsed)
+            if iops:
+                ahead = max(ahead, (done[1] - lastDone[1]) / iops - elapsed)
+            self.debt = max(self.debt + ahead, 0)
+        self.last = (now, done)
+
+        stop = min(self.debt, interval)
+        if stop <= 0:
+            time.sleep(interval)
+            return
+        IOThrottle._signal(pgids, signal.SIGSTOP)
+        try:
+            time.sleep(stop)
+        finally:
+            IOThrottle._signal(pgids, signal.SIGCONT)
+        time.sleep(interval - stop)
+
+    def _adapt(self, load):
+        """Adjust the budget to the VM load (sectors, queued) on the SR"""
+        lastLoad = self.lastLoad
+        self.lastLoad = load
+        if not lastLoad or not load:
+            return
+        sectors, queued = load
+        fraction = self.fraction
+        if sectors == lastLoad[0] and not queued:
+            fraction = min(fraction + self.RAMP_STEP, 1.0)
+        elif queued > lastLoad[1]:
+            fraction = max(fraction / 2, self.MIN_FRACTION)
+        if fraction != self.fraction:
+            self.fraction = fraction
+            Util.log("  Coalesce I/O budget now %d%% (VM load %d sectors, "
+                    "%d requests queued)" % (fraction * 100,
+                        sectors - lastLoad[0], queued))
+
+    def _getVMLoad(self):
+        """Return the sectors transferred (ever) and the requests queued (now)
+        by the tapdisks of the SR"""
+        sectors = 0
+        queued = 0
+        try:
+            tapdisks = blktap2.Tapdisk.list()
+        except Exception, e:
+            Util.log("  Failed to list tapdisks: %s" % e)
+            return None
+        for tapdisk in tapdisks:
+            if not tapdisk.path or self.srUuid not in tapdisk.path:
+                continue
+            try:
+                stats = tapdisk.stats()
+            except Exception:
+                continue
+            sectors += sum(stats.get("secs", []))
+            queued += stats.get("reqs_outstanding", 0)
+        return (sectors, queued)
+
+    def _getIO(pgids):
+        """Return the bytes and the read/write calls done so far by the live
+        processes of the process groups pgids"""
+        total = [0, 0]
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                stat = open("/proc/%s/stat" % pid).read()
+                # the command name may contain spaces
+                if int(stat[stat.rindex(")") + 2:].split()[2]) not in pgids:
+                    continue
+                io = dict()
+                for line in open("/proc/%s/io" % pid):
+                    key, val = line.split(":")
+                    io[key] = int(val)
+            except (IOError, ValueError):
+                continue
+            total[0] += io.get("rchar", 0) + io.get("wchar", 0)
+            total[1] += io.get("syscr", 0) + io.get("syscw", 0)
+        return total
+    _getIO = staticmethod(_getIO)
+
+    def _signal(pgids, sig):
+        for pgid in pgids:
+            try:
+                os.killpg(pgid, sig)
+            except OSError:
+                pass
+    _signal = staticmethod(_signal)
+
+
+################################################################################
+#
+#  VHD metadata cache
+#
+class VHDInfoCache:
+    """Persistent cache of the VHD metadata of the VDIs in an SR, so that a
+    scan only needs to read the headers of VHDs that may have changed since
+    the previous scan. Each entry is stored along with a key chosen by the SR
+    type, which must change whenever the VHD metadata may have changed. The
+    SR type may also record a generation for the cache as a whole (e.g. the
+    VG seqno)."""
+
+    BASE_DIR = "/var/run/sm/vhdcache"
+
+    # above this many VHDs to re-read, one batch scan of all VHDs is cheaper
+    # than querying them one by one
+    MAX_SINGLE_QUERIES = 16
+
+    FIELDS = ["uuid", "path", "sizeVirt", "sizePhys", "hidden", "parentUuid",
+            "parentPath"]
+
+    def __init__(self, srUuid):
+        self.path = os.path.join(self.BASE_DIR, srUuid)
+        self.marker = None
+        self.generation = None
+        self.entries = dict()
+        self._load()
+
+    def lookup(self, keys):
+        """Return (vhds, stale): the cached VHDInfo of every uuid in 'keys'
+        whose entry matches the key, and the list of uuids that need to be
+        re-read"""
+        vhds = dict()
+        stale = []
+        for uuid, key in keys.iteritems():
+            entry = self.entries.get(uuid)
+            if entry and entry[0] == list(key):
+                vhds[uuid] = self._toVHDInfo(entry[1])
+            else:
+                stale.append(uuid)
+        return (vhds, stale)
+
+    def invalidate(self, uuids = None):
+        """Drop the entries for 'uuids', or all entries if None"""
+        if uuids is None:
+            self.entries.clear()
+            return
+        for uuid in uuids:
+            if self.entries.has_key(uuid):
+                del self.entries[uuid]
+
+    def update(self, vhds, keys):
+        """Replace the cache contents with 'vhds', keyed by 'keys'. VHDs with
+        scan errors are not cached"""
+        self.entries.clear()
+        for uuid, vhdInfo in vhds.iteritems():
+            if vhdInfo.error or not keys.has_key(uuid):
+                continue
+            self.entries[uuid] = [list(keys[uuid]), self._fromVHDInfo(vhdInfo)]
+
+    def save(self):
+        tmpPath = "%s.tmp" % self.path
+        try:
+            if not os.path.isdir(self.BASE_DIR):
+                os.makedirs(self.BASE_DIR)
+            f = open(tmpPath, 'w')
+            try:
+                json.dump({"marker": self.marker,
+                    "generation": self.generation, "entries": self.entries}, f)
+            finally:
+                f.close()
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            Util.log("Failed to save the VHD cache %s: %s" % (self.path, e))
+
+    def _load(self):
+        if not util.pathexists(self.path):
+            return
+        try:
+            f = open(self.path, 'r')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            self.marker = data["marker"]
+            self.generation = data["generation"]
+            self.entries = data["entries"]
+        except (IOError, ValueError, KeyError, TypeError), e:
+            Util.log("Ignoring unreadable VHD cache %s: %s" % (self.path, e))
+            self.marker = None
+            self.generation = None
+            self.entries = dict()
+
+    def _fromVHDInfo(self, vhdInfo):
+        fields = dict()
+        for field in self.FIELDS:
+            fields[field] = getattr(vhdInfo, field)
+        return fields
+
+    def _toVHDInfo(self, fields):
+        vhdInfo = vhdutil.VHDInfo(None)
+        for field in self.FIELDS:
+            val = fields[field]
+            if isinstance(val, unicode):
+                val = val.encode("utf-8")
+            setattr(vhdInfo, field, val)
+        return vhdInfo
+
+
 ################################################################################
 #
 #  XAPI
@@ -239,7 +621,7 @@ class XAPI:
         pass
     
     def getSession():
-        session = XenAPI.xapi_local()
+        session = smtrace.traceSession(XenAPI.xapi_local())
         session.xenapi.login_with_password(XAPI.USER, '')
         return session
     getSession = staticmethod(getSession)
@@ -299,10 +681,20 @@ class XAPI:
     def getOnlineHosts(self):
         return util.get_online_hosts(self.session)
 
-    def ensureInactive(self, hostRef, args):
-        text = self.session.xenapi.host.call_plugin( \
-                hostRef, self.PLUGIN_ON_SLAVE, "multi", args)
+    def ensureInactive(session, hostRef, args):
+        text = session.xenapi.host.call_plugin( \
+                hostRef, XAPI.PLUGIN_ON_SLAVE, "multi", args)
         Util.log("call-plugin returned: '%s'" % text)
+    ensureInactive = staticmethod(ensureInactive)
+
+    def callOnSlaves(session, slaves, args):
+        """Call the on-slave plugin with args on all slaves at once"""
+        def call(session, slave):
+            text = session.xenapi.host.call_plugin( \
+                    slave, XAPI.PLUGIN_ON_SLAVE, "multi", args)
+            Util.log("call-plugin on %s returned: '%s'" % (slave, text))
+        util.check_host_results(util.call_on_hosts(session, slaves, call))
+    callOnSlaves = staticmethod(callOnSlaves)
 
     def _getRefVDI(self, uuid):
         return self.session.xenapi.VDI.get_by_uuid(uuid)
@@ -434,6 +826,7 @@ class VDI:
 
     LIVE_LEAF_COALESCE_MAX_SIZE = 20 * 1024 * 1024 # bytes
     LIVE_LEAF_COALESCE_TIMEOUT = 10 # seconds
+    LIVE_LEAF_COALESCE_MAX_ROUNDS = 10 # of snapshot-coalesce
 
     JRN_RELINK = "relink" # journal entry type for relinking children
     JRN_COALESCE = "coalesce" # to communicate which VDI is being coalesced
@@ -545,7 +938,7 @@ class VDI:
             self.updateBlockInfo()
             val = self.getConfig(VDI.DB_VHD_BLOCKS)
         bitmap = zlib.decompress(base64.b64decode(val))
-        return bitmap
+        return Bitmap(bitmap)
 
     def isCoalesceable(self):
         """A VDI is coalesceable if it has no siblings and is not a leaf"""
@@ -563,11 +956,21 @@ class VDI:
                 not self.hidden and \
                 len(self.children) == 0
 
-    def canLiveCoalesce(self):
+    def canLiveCoalesce(self, speed = None):
         """Can we stop-and-leaf-coalesce this VDI? The VDI must be
-        isLeafCoalesceable() already"""
-        return self.getSizeVHD() <= self.LIVE_LEAF_COALESCE_MAX_SIZE or \
-                self.getConfig(self.DB_LEAFCLSC) == self.LEAFCLSC_FORCE
+        isLeafCoalesceable() already. If the coalesce speed (bytes/s) has
+        been measured, the VDI can be coalesced if that is expected to take
+        no longer than the maximum pause time of the SR"""
+        if self.getConfig(self.DB_LEAFCLSC) == self.LEAFCLSC_FORCE:
+            return True
+        if speed:
+            return self._estimatePause(speed) <= \
+                    self.sr.getLeafCoalesceMaxPause()
+        return self.getSizeVHD() <= self.LIVE_LEAF_COALESCE_MAX_SIZE
+
+    def _estimatePause(self, speed):
+        "How long leaf-coalescing this VDI should pause it for at 'speed'"
+        return self.getSizeVHD() / float(speed)
 
     def getAllPrunable(self):
         if len(self.children) == 0: # base case
@@ -596,6 +999,38 @@ class VDI:
     def getSizeVHD(self):
         return self._sizeVHD
 
+    def getSizePhys(self):
+        """The space taken up by this VDI in the SR"""
+        return self.getSizeVHD()
+
+    def _getCachedVHDBlocks(self):
+        """The block bitmap saved in the VDI record, or None. Unlike
+        getVHDBlocks(), never reads the VHD (so the bitmap of a writable VDI
+        may be out of date)"""
+        val = self.getConfig(VDI.DB_VHD_BLOCKS)
+        if not val:
+            return None
+        return Bitmap(zlib.decompress(base64.b64decode(val)))
+
+    def _estimateCoalesce(self):
+        """Estimate the extra space and the I/O (in bytes) of coalescing self
+        onto parent from the cached block bitmaps and sizes only, without
+        touching the VHDs: every block allocated in self is read and written
+        into the parent, which grows by the blocks it does not have yet. With
+        no cached bitmap, all of self is taken to be new data. Return
+        (spaceNeeded, ioSize)"""
+        blocks = self._getCachedVHDBlocks()
+        if blocks is None:
+            dataSize = self.getSizePhys()
+            return (dataSize, 2 * dataSize)
+        numBlocks = blocks.count()
+        numNew = numBlocks
+        parentBlocks = self.parent._getCachedVHDBlocks()
+        if parentBlocks is not None:
+            numNew = (blocks | parentBlocks).count() - parentBlocks.count()
+        return (numNew * vhdutil.VHD_BLOCK_SIZE,
+                2 * numBlocks * vhdutil.VHD_BLOCK_SIZE)
+
     def getTreeRoot(self):
         "Get the root of the tree that self belongs to"
         root = self
@@ -630,6 +1065,17 @@ class VDI:
         val = base64.b64encode(self._queryVHDBlocks())
         self.setConfig(VDI.DB_VHD_BLOCKS, val)
 
+    def mergeBlockInfo(self, child):
+        """Update the block info after child got coalesced onto self: the
+        blocks allocated in self are now those of both VHDs"""
+        if not self.getConfig(VDI.DB_VHD_BLOCKS) or \
+                not child.getConfig(VDI.DB_VHD_BLOCKS):
+            self.updateBlockInfo()
+            return
+        bitmap = self.getVHDBlocks() | child.getVHDBlocks()
+        val = base64.b64encode(zlib.compress(str(bitmap)))
+        self.setConfig(VDI.DB_VHD_BLOCKS, val)
+
     def rename(self, uuid):
         "Rename the VDI file"
         assert(not self.sr.vdis.get(uuid))
@@ -684,14 +1130,29 @@ class VDI:
         VHD, but not the subsequent relinking. We'll do that as the next step,
         after reloading the entire SR in case things have changed while we
         were coalescing"""
+        try:
+            self._prepareCoalesce()
+            self._coalesceVHD(0, self.sr.getCoalesceThrottle())
+            self._finishCoalesce()
+        finally:
+            self._cleanupCoalesce()
+
+    def _prepareCoalesce(self):
+        """Get self and parent ready for the VHD coalesce step"""
         self.validate()
         self.parent.validate(True)
         self.parent._increaseSizeVirt(self.sizeVirt)
         self.sr._updateSlavesOnResize(self.parent)
-        self._coalesceVHD(0)
+
+    def _finishCoalesce(self):
+        """Steps following a successful VHD coalesce"""
         self.parent.validate(True)
         #self._verifyContents(0)
-        self.parent.updateBlockInfo()
+        self.parent.mergeBlockInfo(self)
+
+    def _cleanupCoalesce(self):
+        """Steps following the VHD coalesce, whether it succeeded or not"""
+        pass
 
     def _verifyContents(self, timeOut):
         Util.log("  Coalesce verification on %s" % self)
@@ -778,31 +1239,39 @@ class VDI:
             raise
     _doCoalesceVHD = staticmethod(_doCoalesceVHD)
 
-    def _coalesceVHD(self, timeOut):
+    def _coalesceVHD(self, timeOut, throttle = None):
+        """Coalesce the VHD of self onto its parent. Pass a throttle (an
+        IOThrottle) only when no VM waits on the coalesce: slowing down an
+        offline leaf-coalesce would only lengthen the pause"""
         Util.log("  Running VHD coalesce on %s" % self)
         abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
         try:
             Util.runAbortable(lambda: VDI._doCoalesceVHD(self), None,
-                    self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
+                    self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut,
+                    throttle)
         except:
             #exception at this phase could indicate a failure in vhd coalesce
             # or a kill of vhd coalesce by runAbortable due to  timeOut
             # Try a repair and reraise the exception
-            parent = ""
-            try:
-                parent = vhdutil.getParent(self.path, lambda x: x.strip())
-                # Repair error is logged and ignored. Error reraised later
-                util.SMlog('Coalesce failed on %s, attempting repair on ' \
-                           'parent %s' % (self.uuid, parent))
-                vhdutil.repair(parent)
-            except Exception, e:
-                util.SMlog('(error ignored) Failed to repair parent %s ' \
-                           'after failed coalesce on %s, err: %s' % 
-                           (parent, self.path, e))
+            self._repairParent()
             raise
 
         util.fistpoint.activate("LVHDRT_coalescing_VHD_data",self.sr.uuid)
 
+    def _repairParent(self):
+        """Repair the parent after a failed or interrupted VHD coalesce"""
+        parent = ""
+        try:
+            parent = vhdutil.getParent(self.path, lambda x: x.strip())
+            # Repair error is logged and ignored. Error reraised later
+            util.SMlog('Coalesce failed on %s, attempting repair on ' \
+                       'parent %s' % (self.uuid, parent))
+            vhdutil.repair(parent)
+        except Exception, e:
+            util.SMlog('(error ignored) Failed to repair parent %s ' \
+                       'after failed coalesce on %s, err: %s' % 
+                       (parent, self.path, e))
+
     def _relinkSkip(self):
         """Relink children of this VDI to point to the parent of this VDI"""
         abortFlag = IPCFlag(self.sr.uuid)
@@ -914,7 +1383,7 @@ class VDI:
         self.delConfig(VDI.DB_VHD_BLOCKS)
         blocksChild = self.getVHDBlocks()
         blocksParent = self.parent.getVHDBlocks()
-        numBlocks = Util.countBits(blocksChild, blocksParent)
+        numBlocks = (blocksChild | blocksParent).count()
         Util.log("Num combined blocks = %d" % numBlocks)
         sizeData = numBlocks * vhdutil.VHD_BLOCK_SIZE
         assert(sizeData <= self.sizeVirt)
@@ -1119,6 +1588,9 @@ class LVHDVDI(VDI):
             self._loadInfoSizeVHD()
         return self._sizeVHD
 
+    def getSizePhys(self):
+        return self.sizeLV
+
     def _loadInfoSizeVHD(self):
         """Get the physical utilization of the VHD file. We do it individually
         (and not using the VHD batch scanner) as an optimization: this info is
@@ -1168,18 +1640,18 @@ class LVHDVDI(VDI):
         if not self.raw:
             VDI.validate(self, fast)
 
-    def _doCoalesce(self):
+    def _prepareCoalesce(self):
         """LVHD parents must first be activated, inflated, and made writable"""
-        try:
-            self._activateChain()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, False)
-            self.parent.validate()
-            self.inflateParentForCoalesce()
-            VDI._doCoalesce(self)
-        finally:
-            self.parent._loadInfoSizeVHD()
-            self.parent.deflate()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, True)
+        self._activateChain()
+        self.sr.lvmCache.setReadonly(self.parent.fileName, False)
+        self.parent.validate()
+        self.inflateParentForCoalesce()
+        VDI._prepareCoalesce(self)
+
+    def _cleanupCoalesce(self):
+        self.parent._loadInfoSizeVHD()
+        self.parent.deflate()
+        self.sr.lvmCache.setReadonly(self.parent.fileName, True)
 
     def _setParent(self, parent):
         self._activate()
@@ -1351,6 +1823,18 @@ class SR:
 
     SCAN_RETRY_ATTEMPTS = 3
 
+    # trees this tall are coalesced before any others, as a VHD chain that
+    # reaches vhdutil.MAX_CHAIN_SIZE can no longer be snapshotted
+    COALESCE_URGENT_HEIGHT = vhdutil.MAX_CHAIN_SIZE / 2
+
+    # a parallel VHD coalesce is taken to be hung (and killed) once it has
+    # taken longer than doing its I/O at this speed (or at the slowest the
+    # coalesce throttle allows, in bytes of at least COALESCE_MIN_IO_SIZE per
+    # I/O call), plus the margin
+    COALESCE_MIN_SPEED = 1024 * 1024 # bytes/s
+    COALESCE_MIN_IO_SIZE = 4096
+    COALESCE_TIMEOUT_MARGIN = 600 # seconds
+
     JRN_CLONE = "clone" # journal entry type for the clone operation (from SM)
     TMP_RENAME_PREFIX = "OLD_"
 
@@ -1375,6 +1859,7 @@ class SR:
         self.vdis = {}
         self.vdiTrees = []
         self.journaler = None
+        self.vhdCache = None
         self.xapi = xapi
         self._locked = 0
         self._srLock = None
@@ -1435,6 +1920,15 @@ class SR:
         """Find a coalesceable VDI. Return a vdi that should be coalesced
         (choosing one among all coalesceable candidates according to some
         criteria) or None if there is no VDI that could be coalesced"""
+        candidates = self.findCoalesceables(1)
+        if candidates:
+            return candidates[0]
+        return None
+
+    def findCoalesceables(self, maxNum):
+        """Find up to maxNum coalesceable VDIs, each in a different VHD tree,
+        that can be coalesced at the same time within the free space of the
+        SR"""
 
         candidates = []
 
@@ -1448,34 +1942,94 @@ class SR:
         for uuid in journals.iterkeys():
             vdi = self.getVDI(uuid)
             if vdi and vdi not in self._failedCoalesceTargets:
-                return vdi
+                return [vdi]
 
         for vdi in self.vdis.values():
             if vdi.isCoalesceable() and vdi not in self._failedCoalesceTargets:
                 candidates.append(vdi)
 
-        # pick one in the tallest tree
-        treeHeight = dict()
+        chosen = []
+        chosenTrees = []
+        freeSpace = self.getFreeSpace()
+        for c in self._planCoalesce(candidates):
+            root = c.getTreeRoot()
+            if root in chosenTrees:
+                continue
+            spaceNeeded = c._calcExtraSpaceForCoalescing()
+            if spaceNeeded <= freeSpace:
+                Util.log("Coalesce candidate: %s (tree height %d)" % \
+                        (c, root.getTreeHeight()))
+                chosen.append(c)
+                if len(chosen) == maxNum:
+                    return chosen
+                chosenTrees.append(root)
+                freeSpace -= max(spaceNeeded, 0)
+            else:
+                Util.log("No space to coalesce %s (free space: %d)" % \
+                        (c, freeSpace))
+        return chosen
+
+    def _planCoalesce(self, candidates):
+        """Order the coalesce candidates by the space reclaimed per byte of
+        I/O, so that cheap wins that free up space come before huge chains.
+        VHD trees getting close to the maximum chain depth come first
+        regardless, tallest first. The ranking only uses the estimates of
+        _estimateCoalesce(): the exact space needed, which means reading the
+        VHDs, is left to the caller for the candidates it gets to"""
+        plan = []
         for c in candidates:
+            spaceNeeded, ioSize = c._estimateCoalesce()
+            reclaimed = c.getSizePhys() - spaceNeeded
+            ioSize = max(ioSize, vhdutil.VHD_BLOCK_SIZE)
             height = c.getTreeRoot().getTreeHeight()
-            if treeHeight.get(height):
-                treeHeight[height].append(c)
+            urgent = (height >= self.COALESCE_URGENT_HEIGHT)
+            score = float(reclaimed) / ioSize
+            Util.log("Coalesce estimate for %s: reclaims %s for %s of I/O "
+                    "(tree height %d)" % (c, Util.num2str(reclaimed),
+                        Util.num2str(ioSize), height))
+            if urgent:
+                key = (0, -height, -score)
             else:
-                treeHeight[height] = [c]
+                key = (1, -score, -height)
+            plan.append((key, c))
+        plan.sort(key = lambda x: x[0])
+        return [c for key, c in plan]
+
+    def getCoalesceWorkers(self):
+        """The number of VHD trees to coalesce in concurrently"""
+        val = self.xapi.srRecord["other_config"].get(COALESCE_WORKERS_TAG)
+        try:
+            workers = int(val)
+        except (TypeError, ValueError):
+            return DEFAULT_COALESCE_WORKERS
+        return max(workers, 1)
+
+    def getCoalesceThrottle(self):
+        """An IOThrottle for VHD coalesce, or None if the SR other-config sets
+        no coalesce I/O budget"""
+        budget = []
+        for tag, unit in [(COALESCE_BANDWIDTH_TAG, 1024 * 1024),
+                (COALESCE_IOPS_TAG, 1)]:
+            val = self.xapi.srRecord["other_config"].get(tag)
+            try:
+                budget.append(max(float(val) * unit, 0))
+            except (TypeError, ValueError):
+                budget.append(0)
+        if not budget[0] and not budget[1]:
+            return None
+        return IOThrottle(self.uuid, budget[0], budget[1])
 
-        freeSpace = self.getFreeSpace()
-        heights = treeHeight.keys()
-        heights.sort(reverse=True)
-        for h in heights:
-            for c in treeHeight[h]:
-                spaceNeeded = c._calcExtraSpaceForCoalescing()
-                if spaceNeeded <= freeSpace:
-                    Util.log("Coalesce candidate: %s (tree height %d)" % (c, h))
-                    return c
-                else:
-                    Util.log("No space to coalesce %s (free space: %d)" % \
-                            (c, freeSpace))
-        return None
+    def getLeafCoalesceMaxPause(self):
+        """The longest a VDI may be paused for to leaf-coalesce it"""
+        val = self.xapi.srRecord["other_config"].get(
+                LEAF_COALESCE_MAX_PAUSE_TAG)
+        try:
+            maxPause = float(val)
+        except (TypeError, ValueError):
+            return DEFAULT_LEAF_COALESCE_MAX_PAUSE
+        if maxPause <= 0:
+            return DEFAULT_LEAF_COALESCE_MAX_PAUSE
+        return maxPause
 
     def findLeafCoalesceable(self):
         """Find leaf-coalesceable VDIs in each VHD tree"""
@@ -1506,7 +2060,7 @@ class SR:
             candidates.append(vdi)
 
         freeSpace = self.getFreeSpace()
-        for candidate in candidates:
+        for candidate in self._planCoalesce(candidates):
             # check the space constraints to see if leaf-coalesce is actually 
             # feasible for this candidate
             spaceNeeded = candidate._calcExtraSpaceForSnapshotCoalescing()
@@ -1546,6 +2100,22 @@ class SR:
                 Util.log("Coalesce failed, skipping")
         self.cleanup()
 
+    def coalesceParallel(self, vdiList, dryRun):
+        """Coalesce each VDI in vdiList (all in different VHD trees) onto its
+        parent. The VHD data is coalesced concurrently, while the steps that
+        modify the VHD trees are performed one VDI at a time"""
+        for vdi in vdiList:
+            Util.log("Coalescing %s -> %s" % (vdi, vdi.parent))
+        if dryRun:
+            return
+
+        try:
+            self._coalesceParallel(vdiList)
+        except AbortException:
+            self.cleanup()
+            raise
+        self.cleanup()
+
     def coalesceLeaf(self, vdi, dryRun):
         """Leaf-coalesce vdi onto parent"""
         Util.log("Leaf-coalescing %s -> %s" % (vdi, vdi.parent))
@@ -1746,14 +2316,135 @@ class SR:
         vdi.parent._reloadChildren(vdi)
         self.journaler.remove(vdi.JRN_RELINK, vdi.uuid)
 
+    def _coalesceParallel(self, vdiList):
+        prepared = []
+        for vdi in vdiList:
+            self.journaler.create(vdi.JRN_COALESCE, vdi.uuid, "1")
+            try:
+                vdi._prepareCoalesce()
+            except AbortException:
+                self._abortCoalesceParallel(prepared + [vdi])
+                raise
+            except util.SMException:
+                self._failedCoalesceTargets.append(vdi)
+                Util.logException("coalesce")
+                Util.log("Coalesce of %s failed, skipping" % vdi)
+                try:
+                    vdi._cleanupCoalesce()
+                finally:
+                    self.journaler.remove(vdi.JRN_COALESCE, vdi.uuid)
+                continue
+            prepared.append(vdi)
+
+        funcs = dict()
+        for vdi in prepared:
+            Util.log("  Running VHD coalesce on %s" % vdi)
+            funcs[vdi.uuid] = lambda vdi = vdi: VDI._doCoalesceVHD(vdi)
+        abortTest = lambda:IPCFlag(self.uuid).test(FLAG_TYPE_ABORT)
+        throttle = self.getCoalesceThrottle()
+        timeOut = self._getCoalesceTimeout(prepared, throttle)
+        Util.log("  Coalesce time-out: %ds" % timeOut)
+        try:
+            results = Util.runAbortableParallel(funcs, None, self.uuid,
+                    abortTest, VDI.POLL_INTERVAL, timeOut, throttle)
+        except AbortException:
+            self._abortCoalesceParallel(prepared)
+            raise
+
+        coalesced = []
+        for vdi in prepared:
+            try:
+                try:
+                    if not results.get(vdi.uuid):
+                        vdi._repairParent()
+                        raise util.SMException("VHD coalesce failed")
+                    util.fistpoint.activate("LVHDRT_coalescing_VHD_data",
+                            self.uuid)
+                    vdi._finishCoalesce()
+                finally:
+                    vdi._cleanupCoalesce()
+            except util.SMException:
+                self._failedCoalesceTargets.append(vdi)
+                Util.logException("coalesce")
+                Util.log("Coalesce of %s failed, skipping" % vdi)
+                self.journaler.remove(vdi.JRN_COALESCE, vdi.uuid)
+                continue
+            self.journaler.remove(vdi.JRN_COALESCE, vdi.uuid)
+            util.fistpoint.activate("LVHDRT_before_create_relink_journal",
+                    self.uuid)
+            self.journaler.create(vdi.JRN_RELINK, vdi.uuid, "1")
+            coalesced.append(vdi)
+
+        if not coalesced:
+            return
+        self.lock()
+        try:
+            self.scan()
+            for vdi in coalesced:
+                vdi._relinkSkip()
+        finally:
+            self.unlock()
+
+        for vdi in coalesced:
+            vdi.parent._reloadChildren(vdi)
+            self.journaler.remove(vdi.JRN_RELINK, vdi.uuid)
+
+    def _getCoalesceTimeout(self, vdiList, throttle):
+        """How long the VHD coalesce of all of vdiList at once may take before
+        it is considered hung"""
+        ioSize = 0
+        for vdi in vdiList:
+            ioSize += vdi._estimateCoalesce()[1]
+        speed = self.COALESCE_MIN_SPEED
+        if throttle:
+            bandwidth, iops = throttle.getMinBudget()
+            if bandwidth:
+                speed = min(speed, bandwidth)
+            if iops:
+                speed = min(speed, iops * self.COALESCE_MIN_IO_SIZE)
+        return self.COALESCE_TIMEOUT_MARGIN + int(ioSize / speed)
+
+    def _abortCoalesceParallel(self, vdiList):
+        for vdi in vdiList:
+            vdi._repairParent()
+            try:
+                vdi._cleanupCoalesce()
+            except Exception:
+                Util.logException("_abortCoalesceParallel")
+
     def _coalesceLeaf(self, vdi):
         """Leaf-coalesce VDI vdi. Return true if we succeed, false if we cannot
         complete due to external changes, namely vdi_delete and vdi_snapshot 
-        that alter leaf-coalescibility of vdi"""
-        while not vdi.canLiveCoalesce():
+        that alter leaf-coalescibility of vdi.
+
+        Like a live migration, the data is copied in rounds while the VM keeps
+        running: each round snapshots the leaf and coalesces the snapshot
+        (that is, the data written so far) onto the parent, leaving only the
+        data written meanwhile in the leaf. The speed of each round is used to
+        predict how long the final, paused, round will take, and we stop once
+        that is within the maximum pause time of the SR"""
+        speed = None
+        rounds = 0
+        while not vdi.canLiveCoalesce(speed):
+            if rounds == vdi.LIVE_LEAF_COALESCE_MAX_ROUNDS:
+                Util.log("Snapshot-coalesce not converging after %d rounds, "
+                        "abandoning attempts" % rounds)
+                vdi.setConfig(vdi.DB_LEAFCLSC, vdi.LEAFCLSC_OFFLINE)
+                break
+            rounds += 1
             prevSizeVHD = vdi.getSizeVHD()
+            startTime = time.time()
             if not self._snapshotCoalesce(vdi):
                 return False
+            # the round includes the snapshot & cleanup, so this speed (and
+            # hence the pause estimate) errs on the safe side
+            duration = max(time.time() - startTime, 0.001)
+            speed = prevSizeVHD / float(duration)
+            Util.log("Snapshot-coalesce round %d: %s in %.1fs (%s/s), %s "
+                    "left, estimated pause %.1fs" % (rounds,
+                        Util.num2str(prevSizeVHD), duration,
+                        Util.num2str(speed), Util.num2str(vdi.getSizeVHD()),
+                        vdi._estimatePause(speed)))
             if vdi.getSizeVHD() >= prevSizeVHD:
                 Util.log("Snapshot-coalesce did not help, abandoning attempts")
                 vdi.setConfig(vdi.DB_LEAFCLSC, vdi.LEAFCLSC_OFFLINE)
@@ -1803,6 +2494,7 @@ class SR:
 
             uuid = vdi.uuid
             vdi.pause(failfast=True)
+            pauseTime = time.time()
             try:
                 try:
                     # "vdi" object will no longer be valid after this call
@@ -1815,6 +2507,8 @@ class SR:
                 vdi = self.getVDI(uuid)
                 if vdi:
                     vdi.ensureUnpaused()
+                Util.log("Leaf-coalesce kept %s paused for %.1fs" % \
+                        (uuid, time.time() - pauseTime))
                 vdiOld = self.getVDI(self.TMP_RENAME_PREFIX + uuid)
                 if vdiOld:
                     util.fistpoint.activate("LVHDRT_coaleaf_before_delete", self.uuid)
@@ -1836,10 +2530,12 @@ class SR:
         vdi.validate(True)
         vdi.parent.validate(True)
         util.fistpoint.activate("LVHDRT_coaleaf_before_coalesce", self.uuid)
-        timeout = vdi.LIVE_LEAF_COALESCE_TIMEOUT
+        timeout = max(vdi.LIVE_LEAF_COALESCE_TIMEOUT,
+                self.getLeafCoalesceMaxPause())
         if vdi.getConfig(vdi.DB_LEAFCLSC) == vdi.LEAFCLSC_FORCE:
             Util.log("Leaf-coalesce forced, will not use timeout")
             timeout = 0
+        # not throttled: the VM is paused until this is done
         vdi._coalesceVHD(timeout)
         util.fistpoint.activate("LVHDRT_coaleaf_after_coalesce", self.uuid)
         vdi.parent.validate(True)
@@ -1921,6 +2617,27 @@ class SR:
                         self.vdis[uuid])
                 del self.vdis[uuid]
 
+    def _getVHDsCached(self, keys, queryAll, queryOne):
+        """Get the VHD info for all VHDs in 'keys' (uuid -> cache key), using
+        the VHD cache for the VHDs whose key has not changed. The others are
+        re-read with queryOne(uuid), or all VHDs are re-read with queryAll()
+        if there are too many of them"""
+        vhds, stale = self.vhdCache.lookup(keys)
+        if len(stale) > VHDInfoCache.MAX_SINGLE_QUERIES:
+            Util.log("VHD cache: %d VHDs changed, scanning all" % len(stale))
+            vhds = queryAll()
+        else:
+            if stale:
+                Util.log("VHD cache: re-reading %d of %d VHDs" % \
+                        (len(stale), len(keys)))
+            for uuid in stale:
+                vhdInfo = queryOne(uuid)
+                if vhdInfo:
+                    vhds[uuid] = vhdInfo
+        self.vhdCache.update(vhds, keys)
+        self.vhdCache.save()
+        return vhds
+
     def _handleInterruptedCoalesceLeaf(self):
         """An interrupted leaf-coalesce operation may leave the VHD tree in an 
         inconsistent state. If the old-leaf VDI is still present, we revert the 
@@ -1965,6 +2682,7 @@ class FileSR(SR):
         SR.__init__(self, uuid, xapi, createLock, force)
         self.path = "/var/run/sr-mount/%s" % self.uuid
         self.journaler = fjournaler.Journaler(self.path)
+        self.vhdCache = VHDInfoCache(self.uuid)
 
     def findLeafCoalesceable(self):
         """Disable leaf-coalesce for File-based SRs"""
@@ -2068,6 +2786,7 @@ class FileSR(SR):
             return False
 
         fullPath = os.path.join(self.path, uuid + self.CACHE_FILE_EXT)
+        blktap2.TapdiskRegistry.invalidate()
         tapdisk = blktap2.Tapdisk.find_by_path(fullPath)
         if tapdisk:
             if action == self.CACHE_ACTION_REMOVE_IF_INACTIVE:
@@ -2087,8 +2806,7 @@ class FileSR(SR):
     def _scan(self, force):
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
-            pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
-            vhds = vhdutil.getAllVHDs(pattern, FileVDI.extractUuid)
+            vhds = self._getVHDs()
             for uuid, vhdInfo in vhds.iteritems():
                 if vhdInfo.error:
                     error = True
@@ -2096,33 +2814,64 @@ class FileSR(SR):
             if not error:
                 return vhds
             Util.log("Scan error on attempt %d" % i)
+            self.vhdCache.invalidate()
         if force:
             return vhds
         raise util.SMException("Scan error")
 
+    def _getVHDs(self):
+        """Any write to a VHD file updates its mtime, so the file's inode, 
+        size and mtime tell us whether the VHD may have changed"""
+        pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
+        keys = dict()
+        paths = glob.glob(pattern)
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            keys[FileVDI.extractUuid(path)] = [st.st_ino, st.st_size,
+                    st.st_mtime]
+        queryAll = lambda: vhdutil.readVHDInfos(paths, FileVDI.extractUuid)
+        return self._getVHDsCached(keys, queryAll, self._queryVHD)
+
+    def _queryVHD(self, uuid):
+        path = os.path.join(self.path, "%s%s" % (uuid, vhdutil.FILE_EXTN_VHD))
+        try:
+            return vhdutil.getVHDInfo(path, FileVDI.extractUuid)
+        except util.CommandException, e:
+            if not util.pathexists(path):
+                return None
+            vhdInfo = vhdutil.VHDInfo(uuid)
+            vhdInfo.path = path
+            vhdInfo.error = str(e)
+            return vhdInfo
+
     def deleteVDI(self, vdi):
         self._checkSlaves(vdi)
         SR.deleteVDI(self, vdi)
 
     def _checkSlaves(self, vdi):
         onlineHosts = self.xapi.getOnlineHosts()
-        abortFlag = IPCFlag(self.uuid)
-        for pbdRecord in self.xapi.getAttachedPBDs():
-            hostRef = pbdRecord["host"]
-            if hostRef == self.xapi._hostRef:
-                continue
-            if abortFlag.test(FLAG_TYPE_ABORT):
-                raise AbortException("Aborting due to signal")
-            try:
-                self._checkSlave(hostRef, vdi)
-            except util.CommandException:
-                if hostRef in onlineHosts:
-                    raise
-
-    def _checkSlave(self, hostRef, vdi):
+        if IPCFlag(self.uuid).test(FLAG_TYPE_ABORT):
+            raise AbortException("Aborting due to signal")
+        hostRefs = [pbdRecord["host"] for pbdRecord in \
+                self.xapi.getAttachedPBDs() \
+                if pbdRecord["host"] != self.xapi._hostRef]
+        results = util.call_on_hosts(self.xapi.session, hostRefs,
+                lambda session, hostRef: self._checkSlave(session, hostRef,
+                    vdi))
+        offlineHosts = []
+        for hostRef, (ok, e) in results.iteritems():
+            if not ok and isinstance(e, util.CommandException) and \
+                    hostRef not in onlineHosts:
+                offlineHosts.append(hostRef)
+        util.check_host_results(results, offlineHosts)
+
+    def _checkSlave(self, session, hostRef, vdi):
         call  = (hostRef, "nfs-on-slave", "check", { 'path': vdi.path })
         Util.log("Checking with slave: %s" % repr(call))
-        _host = self.xapi.session.xenapi.host
+        _host = session.xenapi.host
         text  = _host.call_plugin(*call)
 
     def _handleInterruptedCoalesceLeaf(self):
@@ -2203,6 +2952,8 @@ class LVHDSR(SR):
         self.lvmCache = lvmcache.LVMCache(self.vgName)
         self.lvActivator = LVActivator(self.uuid, self.lvmCache)
         self.journaler = journaler.Journaler(self.lvmCache)
+        self.vhdCache = VHDInfoCache(self.uuid)
+        self._vhdCacheChecked = False
 
     def deleteVDI(self, vdi):
         if self.lvActivator.get(vdi.uuid, False):
@@ -2265,7 +3016,7 @@ class LVHDSR(SR):
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
             self.lvmCache.refresh()
-            vdis = lvhdutil.getVDIInfo(self.lvmCache)
+            vdis = lvhdutil.getVDIInfo(self.lvmCache, self._getVHDs())
             for uuid, vdiInfo in vdis.iteritems():
                 if vdiInfo.scanError:
                     error = True
@@ -2273,10 +3024,62 @@ class LVHDSR(SR):
             if not error:
                 return vdis
             Util.log("Scan error, retrying (%d)" % i)
+            self.vhdCache.invalidate()
         if force:
             return vdis
         raise util.SMException("Scan error")
 
+    def _getVHDs(self):
+        """Changes to the VHD metadata inside an LV do not show up in the LVM
+        metadata, so besides the LV name, size, hidden tag and permission,
+        rely on the vhdutil mutation log to find out which VHDs may have
+        changed. The log only covers this host, while another host may have
+        changed the VHDs as the pool master in the meantime. It could not do
+        so without updating the VG metadata as well (to inflate or tag the
+        LVs), so the cache saved by a previous run is only used if the VG
+        seqno (read by the lvmCache.refresh() of _scan) has not changed
+        since"""
+        vgId = self.lvmCache.vgId
+        if not self._vhdCacheChecked:
+            self._vhdCacheChecked = True
+            if vgId is None or vgId != self.vhdCache.generation:
+                self.vhdCache.invalidate()
+        self.vhdCache.generation = vgId
+
+        marker, mutated = vhdutil.getMutations(self.vhdCache.marker)
+        if mutated is None:
+            self.vhdCache.invalidate()
+        else:
+            uuids = []
+            for path in mutated:
+                if self.vgName in path or \
+                        self.vgName.replace("-", "--") in path:
+                    uuids.append(lvhdutil.extractUuid(path))
+            self.vhdCache.invalidate(uuids)
+        self.vhdCache.marker = marker
+
+        keys = dict()
+        lvNames = dict()
+        for uuid, lvInfo in lvhdutil.getLVInfo(self.lvmCache).iteritems():
+            if lvInfo.vdiType == vhdutil.VDI_TYPE_VHD:
+                keys[uuid] = [lvInfo.name, lvInfo.size, lvInfo.hidden,
+                        lvInfo.readonly]
+                lvNames[uuid] = lvInfo.name
+        pattern = "%s*" % lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD]
+        queryAll = lambda: vhdutil.getAllVHDs(pattern, lvhdutil.extractUuid,
+                self.vgName)
+        queryOne = lambda uuid: self._queryVHD(lvNames[uuid])
+        return self._getVHDsCached(keys, queryAll, queryOne)
+
+    def _queryVHD(self, lvName):
+        try:
+            return vhdutil.getVHDInfoLVM(lvName, lvhdutil.extractUuid,
+                    self.vgName)
+        except util.CommandException, e:
+            # a missing VHD is handled by lvhdutil.getVDIInfo
+            Util.log("Failed to read VHD %s: %s" % (lvName, e))
+            return None
+
     def _removeStaleVDIs(self, uuidsPresent):
         for uuid in self.vdis.keys():
             if not uuid in uuidsPresent:
@@ -2422,19 +3225,22 @@ class LVHDSR(SR):
                 "uuid2"  : vdi.uuid,
                 "ns2"    : lvhdutil.NS_PREFIX_LVM + self.uuid}
         onlineHosts = self.xapi.getOnlineHosts()
-        abortFlag = IPCFlag(self.uuid)
-        for pbdRecord in self.xapi.getAttachedPBDs():
-            hostRef = pbdRecord["host"]
-            if hostRef == self.xapi._hostRef:
-                continue
-            if abortFlag.test(FLAG_TYPE_ABORT):
-                raise AbortException("Aborting due to signal")
+        if IPCFlag(self.uuid).test(FLAG_TYPE_ABORT):
+            raise AbortException("Aborting due to signal")
+        hostRefs = [pbdRecord["host"] for pbdRecord in \
+                self.xapi.getAttachedPBDs() \
+                if pbdRecord["host"] != self.xapi._hostRef]
+        for hostRef in hostRefs:
             Util.log("Checking with slave %s (path %s)" % (hostRef, vdi.path))
-            try:
-                self.xapi.ensureInactive(hostRef, args)
-            except XenAPI.Failure:
-                if hostRef in onlineHosts:
-                    raise
+        results = util.call_on_hosts(self.xapi.session, hostRefs,
+                lambda session, hostRef: XAPI.ensureInactive(session, hostRef,
+                    args))
+        offlineHosts = []
+        for hostRef, (ok, e) in results.iteritems():
+            if not ok and isinstance(e, XenAPI.Failure) and \
+                    hostRef not in onlineHosts:
+                offlineHosts.append(hostRef)
+        util.check_host_results(results, offlineHosts)
 
     def _updateSlavesOnUndoLeafCoalesce(self, parent, child):
         slaves = util.get_slaves_attached_on(self.xapi.session, [child.uuid])
@@ -2457,9 +3263,7 @@ class LVHDSR(SR):
         for slave in slaves:
             Util.log("Updating %s, %s, %s on slave %s" % \
                     (tmpName, child.fileName, parent.fileName, slave))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
-            Util.log("call-plugin returned: '%s'" % text)
+        XAPI.callOnSlaves(self.xapi.session, slaves, args)
 
     def _updateSlavesOnRename(self, vdi, oldNameLV):
         slaves = util.get_slaves_attached_on(self.xapi.session, [vdi.uuid])
@@ -2475,9 +3279,7 @@ class LVHDSR(SR):
         for slave in slaves:
             Util.log("Updating %s to %s on slave %s" % \
                     (oldNameLV, vdi.fileName, slave))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
-            Util.log("call-plugin returned: '%s'" % text)
+        XAPI.callOnSlaves(self.xapi.session, slaves, args)
 
     def _updateSlavesOnResize(self, vdi):
         uuids = map(lambda x: x.uuid, vdi.getAllLeaves())
@@ -2505,6 +3307,8 @@ def daemonize():
     if pid:
         Util.log("Will finish as PID [%d]" % pid)
         os._exit(0)
+    # the spans open in the parent (such as the SM command's) never end here
+    smtrace.reset()
     for fd in [0, 1, 2]:
         try:
             os.close(fd)
@@ -2528,7 +3332,40 @@ def normalizeType(type):
         raise util.SMException("Unsupported SR type: %s" % type)
     return type
 
-def _gcLoop(sr, dryRun):
+def _waitForWakeup(srUuid, timeOut):
+    """Wait for a kick (see wake()) for up to timeOut seconds. Returns True if
+    kicked and False on time-out. Raises AbortException if an abort is
+    requested meanwhile"""
+    flag = IPCFlag(srUuid)
+    start = time.time()
+    while True:
+        if flag.test(FLAG_TYPE_ABORT):
+            raise AbortException("Aborting due to signal")
+        if flag.test(FLAG_TYPE_WAKEUP):
+            flag.clear(FLAG_TYPE_WAKEUP)
+            return True
+        if time.time() - start >= timeOut:
+            return False
+        time.sleep(RESIDENT_POLL_INTERVAL)
+
+def _idle(srUuid):
+    """Wait in a resident GC for more work. Returns False if the GC should
+    exit, in which case lockResident has been released"""
+    Util.log("No work, waiting up to %ds for a kick" % RESIDENT_IDLE_TIMEOUT)
+    if _waitForWakeup(srUuid, RESIDENT_IDLE_TIMEOUT):
+        Util.log("Kicked, rescanning")
+        return True
+    lockResident.release()
+    # a kick that came just before the release found us resident and did not
+    # start a new GC, so it is ours to serve
+    flag = IPCFlag(srUuid)
+    if flag.test(FLAG_TYPE_WAKEUP) and lockResident.acquireNoblock():
+        flag.clear(FLAG_TYPE_WAKEUP)
+        Util.log("Kicked, rescanning")
+        return True
+    return False
+
+def _gcLoop(sr, dryRun, resident=False):
     failedCandidates = []
     while True:
         if not sr.xapi.isPluggedHere():
@@ -2536,6 +3373,8 @@ def _gcLoop(sr, dryRun):
             break
         sr.scanLocked()
         if not sr.hasWork():
+            if resident and _idle(sr.uuid):
+                continue
             Util.log("No work, exiting")
             break
 
@@ -2554,10 +3393,13 @@ def _gcLoop(sr, dryRun):
                 sr.xapi.srUpdate()
                 continue
 
-            candidate = sr.findCoalesceable()
-            if candidate:
+            candidates = sr.findCoalesceables(sr.getCoalesceWorkers())
+            if candidates:
                 util.fistpoint.activate("LVHDRT_finding_a_suitable_pair",sr.uuid)
-                sr.coalesce(candidate, dryRun)
+                if len(candidates) == 1:
+                    sr.coalesce(candidates[0], dryRun)
+                else:
+                    sr.coalesceParallel(candidates, dryRun)
                 sr.xapi.srUpdate()
                 continue
 
@@ -2572,19 +3414,29 @@ def _gcLoop(sr, dryRun):
         finally:
             lockRunning.release()
 
-def _gc(session, srUuid, dryRun):
+def _gc(session, srUuid, dryRun, resident=False):
     init(srUuid)
-    sr = SR.getInstance(srUuid, session)
-    if not sr.gcEnabled(False):
-        return
-
-    sr.cleanupCache()
+    if resident:
+        if not lockResident.acquireNoblock():
+            Util.log("A resident GC is already running, kicking it")
+            IPCFlag(srUuid).set(FLAG_TYPE_WAKEUP)
+            return
+        IPCFlag(srUuid).clear(FLAG_TYPE_WAKEUP)
     try:
-        _gcLoop(sr, dryRun)
+        sr = SR.getInstance(srUuid, session)
+        if not sr.gcEnabled(False):
+            return
+
+        sr.cleanupCache()
+        try:
+            _gcLoop(sr, dryRun, resident)
+        finally:
+            sr.cleanup()
+            sr.logFilter.logState()
+            del sr.xapi
     finally:
-        sr.cleanup()
-        sr.logFilter.logState()
-        del sr.xapi
+        if lockResident.held():
+            lockResident.release()
 
 def _abort(srUuid, soft=False):
     """Aborts an GC/coalesce.
@@ -2613,12 +3465,40 @@ def _abort(srUuid, soft=False):
         if not gotLock:
             raise util.CommandException(code=errno.ETIMEDOUT,
                     reason="SR %s: error aborting existing process" % srUuid)
+    try:
+        _stopResident(srUuid)
+    except:
+        lockRunning.release()
+        raise
     return True
 
+def _stopResident(srUuid):
+    """Make an idle resident GC exit, if there is one"""
+    if lockResident.acquireNoblock():
+        lockResident.release()
+        return
+    Util.log("Stopping the resident GC (SR %s)" % srUuid)
+    abortFlag = IPCFlag(srUuid)
+    abortFlag.set(FLAG_TYPE_ABORT)
+    gotLock = False
+    for i in range(SR.LOCK_RETRY_ATTEMPTS):
+        gotLock = lockResident.acquireNoblock()
+        if gotLock:
+            lockResident.release()
+            break
+        time.sleep(SR.LOCK_RETRY_INTERVAL)
+    abortFlag.clear(FLAG_TYPE_ABORT)
+    if not gotLock:
+        raise util.CommandException(code=errno.ETIMEDOUT,
+                reason="SR %s: error stopping the resident GC" % srUuid)
+
 def init(srUuid):
     global lockRunning
+    global lockResident
     if not lockRunning:
         lockRunning = lock.Lock(LOCK_TYPE_RUNNING, srUuid) 
+    if not lockResident:
+        lockResident = lock.Lock(LOCK_TYPE_RESIDENT, srUuid)
 
 def usage():
     output = """Garbage collect and/or coalesce VHDs in a VHD-based SR
@@ -2636,7 +3516,8 @@ Parameters:
     -t --debug       see Debug below
 
 Options:
-    -b --background  run in background (return immediately) (valid for -g only)
+    -b --background  run in background (return immediately) and stay resident
+                     for a while when done (valid for -g only)
     -f --force       continue in the presence of VHDs with errors (when doing
                      GC, this might cause removal of any such VHDs) (only valid
                      for -G) (DANGEROUS)
@@ -2669,9 +3550,22 @@ def abort(srUuid, soft=False):
     else:
         return False
 
+def wake(srUuid):
+    """Kick the resident GC of SR "srUuid" into rescanning the SR. Returns
+    False if there is no resident GC to kick"""
+    init(srUuid)
+    IPCFlag(srUuid).set(FLAG_TYPE_WAKEUP)
+    if lockResident.acquireNoblock():
+        lockResident.release()
+        return False
+    Util.log("Kicked the resident GC")
+    return True
+
 def gc(session, srUuid, inBackground, dryRun = False):
     """Garbage collect all deleted VDIs in SR "srUuid". Fork & return 
-    immediately if inBackground=True. 
+    immediately if inBackground=True. A background GC stays resident for
+    RESIDENT_IDLE_TIMEOUT seconds once there is no work, keeping its view of
+    the SR, and later calls kick it instead of forking a new process.
     
     The following algorithm is used:
     1. If we are already GC'ing in this SR, return
@@ -2686,13 +3580,16 @@ def gc(session, srUuid, inBackground, dryRun = False):
     """
     Util.log("=== SR %s: gc ===" % srUuid)
     if inBackground:
+        resident = RESIDENT_IDLE_TIMEOUT > 0
+        if resident and wake(srUuid):
+            return
         if daemonize():
             # we are now running in the background. Catch & log any errors 
             # because there is no other way to propagate them back at this 
             # point
             
             try:
-                _gc(None, srUuid, dryRun)
+                _gc(None, srUuid, dryRun, resident)
             except AbortException:
                 Util.log("Aborted")
             except Exception:
@@ -2748,13 +3645,12 @@ def should_preempt(session, srUuid):
     entries = sr.journaler.getAll(VDI.JRN_COALESCE)
     if len(entries) == 0:
         return False
-    elif len(entries) > 1:
-        raise util.SMException("More than one coalesce entry: " + entries)
+    elif len(entries) > 1 and sr.getCoalesceWorkers() == 1:
+        raise util.SMException("More than one coalesce entry: %s" % entries)
     sr.scan()
-    coalescedUuid = entries.popitem()[0]
     garbage = sr.findGarbage()
     for vdi in garbage:
-        if vdi.uuid == coalescedUuid:
+        if entries.has_key(vdi.uuid):
             return True
     return False
 
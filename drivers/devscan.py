@@ -27,6 +27,8 @@ SYSFS_PATH1='/sys/class/scsi_host'
 SYSFS_PATH2='/sys/class/scsi_disk'
 SYSFS_PATH3='/sys/class/fc_transport'
 
+RESCAN_WORKERS = 16
+
 DRIVER_BLACKLIST = ['^(s|p|)ata_.*', '^ahci$', '^pdc_adma$', '^iscsi_tcp$']
 
 INVALID_DEVICE_NAME = ''
@@ -43,38 +45,78 @@ def update_devs_dict(devs, dev, entry):
         devs[dev] = entry
 
 
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+def _index_LUNs(names):
+    """Map the H, the H:C:T and the H:C:T:L of each of the H:C:T:L names to
+    the names they start"""
+    index = {}
+    for name in names:
+        ids = name.split(':')
+        if len(ids) != 4:
+            continue
+        for key in [ids[0], ':'.join(ids[:3]), name]:
+            index.setdefault(key, []).append(name)
+    return index
+
+def _rescan(ids):
+    """Rescan the SCSI hosts ids concurrently"""
+    results = util.run_parallel(lambda id: scsiutil.rescan([id]), ids,
+                                RESCAN_WORKERS)
+    for id in ids:
+        ok, result = results[id]
+        if not ok:
+            raise result
+
 def adapters(filterstr="any"):
     dict = {}
     devs = {}
     adt = {}
+    hosts = []
     for a in os.listdir(SYSFS_PATH1):
         proc = match_hbadevs(a, filterstr)
         if not proc:
             continue
         adt[a] = proc
+        hosts.append(a)
+    _rescan([a.replace("host","") for a in hosts])
+
+    # read once, after the rescans
+    disks = _index_LUNs(_listdir(SYSFS_PATH2))
+    for a in hosts:
+        proc = adt[a]
         id = a.replace("host","")
-        scsiutil.rescan([id])
         emulex = False
         paths = []
         if proc == "lpfc":
             emulex = True
             paths.append(SYSFS_PATH3)
         else:
-            for p in [os.path.join(SYSFS_PATH1,a,"device","session*"),os.path.join(SYSFS_PATH1,a,"device"),\
-                          os.path.join(SYSFS_PATH2,"%s:*"%id)]:
+            for p in [os.path.join(SYSFS_PATH1,a,"device","session*"),os.path.join(SYSFS_PATH1,a,"device")]:
                 paths += glob.glob(p)
+            paths += [os.path.join(SYSFS_PATH2, lun) for lun in
+                      disks.get(id, [])]
         if not len(paths):
             continue
         for path in paths:
-            for i in filter(match_targets,os.listdir(path)):
+            entries = []
+            if not path.startswith(SYSFS_PATH2):
+                entries = _listdir(path)
+            for i in filter(match_targets,entries):
                 tgt = i.replace('target','')
                 if emulex:
+                    if tgt.split(':')[0] != id:
+                        continue
                     sysfs = os.path.join(SYSFS_PATH3,i,"device")
+                    luns = _index_LUNs(_listdir(sysfs)).get(tgt, [])
                 else:
                     sysfs = SYSFS_PATH2
-                for lun in os.listdir(sysfs):
-                    if not match_LUNs(lun,tgt):
-                        continue
+                    luns = disks.get(tgt, [])
+                for lun in luns:
                     if emulex:
                         dir = os.path.join(sysfs,lun)
                     else:
@@ -82,31 +124,24 @@ def adapters(filterstr="any"):
                     (dev, entry) = _extract_dev(dir, proc, id, lun)
                     update_devs_dict(devs, dev, entry)
             # for new qlogic sysfs layout (rport under device, then target)
-            for i in filter(match_rport,os.listdir(path)):
+            for i in filter(match_rport,entries):
                 newpath = os.path.join(path, i)
-                for j in filter(match_targets,os.listdir(newpath)):
+                for j in filter(match_targets,_listdir(newpath)):
                     tgt = j.replace('target','')
-                    sysfs = SYSFS_PATH2
-                    for lun in os.listdir(sysfs):
-                        if not match_LUNs(lun,tgt):
-                            continue
-                        dir = os.path.join(sysfs,lun,"device")
+                    for lun in disks.get(tgt, []):
+                        dir = os.path.join(SYSFS_PATH2,lun,"device")
                         (dev, entry) = _extract_dev(dir, proc, id, lun)
                         update_devs_dict(devs, dev, entry)
 
             # for new mptsas sysfs entries, check for phy* node
-            for i in filter(match_phy,os.listdir(path)):
+            for i in filter(match_phy,entries):
                 (target,lunid) = i.replace('phy-','').split(':')
                 tgt = "%s:0:0:%s" % (target,lunid)
-                sysfs = SYSFS_PATH2
-                for lun in os.listdir(sysfs):
-                    if not match_LUNs(lun,tgt):
-                        continue
-                    dir = os.path.join(sysfs,lun,"device")
+                for lun in disks.get(tgt, []):
+                    dir = os.path.join(SYSFS_PATH2,lun,"device")
                     (dev, entry) = _extract_dev(dir, proc, id, lun)
                     update_devs_dict(devs, dev, entry)
             if path.startswith(SYSFS_PATH2):
-                os.path.join(path,"device","block:*")
                 dev = _extract_dev_name(os.path.join(path, 'device'))
                 if devs.has_key(dev):
                     continue
@@ -211,10 +246,6 @@ def match_phy(s):
     regex = re.compile("^phy-*")
     return regex.search(s, 0)
 
-def match_LUNs(s, prefix):
-    regex = re.compile("^%s" % prefix)
-    return regex.search(s, 0)    
-
 def match_dev(s):
     regex = re.compile("^block:")
     return regex.search(s, 0)
@@ -286,6 +317,7 @@ def scan(srobj):
     
     devs = srobj.devs
     vdis = {}
+    pbds = util.PBDIndex(srobj.session)
 
     for key in hbadict:
         hba = hbadict[key]
@@ -302,7 +334,7 @@ def scan(srobj):
         if len(obj.SCSIid) and len(systemrootID) and util.match_scsiID(obj.SCSIid, systemrootID):
             util.SMlog("Ignoring root device %s" % realpath)
             continue
-        elif util.test_SCSIid(srobj.session, None, obj.SCSIid):
+        elif util.test_SCSIid(srobj.session, None, obj.SCSIid, pbds):
             util.SMlog("SCSIid in use, ignoring (%s)" % obj.SCSIid)
             continue
         elif not devs.has_key(realpath):
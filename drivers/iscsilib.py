@@ -17,6 +17,8 @@
 
 INITIATORNAME_FILE = '/etc/iscsi/initiatorname.iscsi'
 
+LUN_POLL_INTERVAL = 0.1 # seconds
+
 import util,os,scsiutil,time
 import xs_errors, socket, re
 import shutil
@@ -352,6 +354,26 @@ def wait_for_devs(targetIQN, portal):
         time.sleep(1)
     return False
 
+def wait_for_luns(paths, timeout):
+    """Wait until each of the session directories in paths
+    (/dev/iscsi/<IQN>/<portal>) has LUN links, for timeout seconds at most.
+    Return the paths that still have none"""
+    deadline = time.time() + timeout
+    while True:
+        paths = filter(lambda path: not _has_luns(path), paths)
+        if not paths or time.time() >= deadline:
+            return paths
+        time.sleep(LUN_POLL_INTERVAL)
+
+def _has_luns(path):
+    try:
+        for file in os.listdir(path):
+            if file.startswith("LUN"):
+                return True
+    except OSError:
+        pass
+    return False
+
 def refresh_luns(targetIQN, portal):
     wait_for_devs(targetIQN, portal)
     try:
@@ -360,7 +382,7 @@ def refresh_luns(targetIQN, portal):
         f=open('/sys/class/scsi_host/host%s/scan' % id, 'w')
         f.write('- - -\n')
         f.close()
-        time.sleep(2) # FIXME
+        scsiutil.settle()
     except:
         pass
 
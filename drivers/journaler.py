@@ -44,7 +44,9 @@ class Journaler:
     def create(self, type, id, val):
         """Create an entry of type "type" for "id" with the value "val".
         Error if such an entry already exists."""
-        valExisting = self.get(type, id)
+        # the value of an entry is not needed to check for it, so do not
+        # activate and read the existing journals
+        valExisting = self._getAllEntries(False).get(type, {}).get(id)
         writeData = False
         if valExisting:
             raise JournalerException("Journal already exists for '%s:%s': %s" \
@@ -107,6 +109,20 @@ class Journaler:
             lvName = self._getNameLV(type, id)
         self.lvmCache.remove(lvName)
 
+    def removeMulti(self, type, ids):
+        """Remove the entries of type "type" for all of "ids", with a single
+        LVM command. Error if any of the entries doesn't exist."""
+        # the LV name of an entry whose value did not fit in the name has the
+        # default value in it, so the names are all we need here
+        entries = self._getAllEntries(False).get(type, {})
+        lvNames = []
+        for id in ids:
+            val = entries.get(id)
+            if not val:
+                raise JournalerException("No journal for '%s:%s'" % (type, id))
+            lvNames.append(self._getNameLV(type, id, val))
+        self.lvmCache.removeMulti(lvNames)
+
     def get(self, type, id):
         """Get the value for the journal entry of type "type" for "id".
         Return None if no such entry exists"""
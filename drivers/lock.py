@@ -17,10 +17,12 @@
 
 """Serialization for concurrent operations"""
 
-import os, stat, errno
+import os, sys, stat, errno
 import time
 import flock
 import util
+import smtrace
+import lockstats
 
 VERBOSE = True
 
@@ -67,7 +69,8 @@ class Lock:
     def _open_lockfile(self):
         """Provide a seam, so extreme situations could be tested"""
         util.SMlog("lock: opening lock file %s" % self.lockpath)
-        self.lockfile = file(self.lockpath, "w+")
+        # not "w+": that would wipe the holder record of the current holder
+        self.lockfile = file(self.lockpath, "a+")
 
     def _close(self):
         """Close the lock, which implies releasing the lock."""
@@ -106,12 +109,14 @@ class Lock:
         path = os.path.join(Lock.BASE_DIR, ns, name)
         if os.path.exists(path):
             Lock._unlink(path)
+        lockstats.removeStats(ns, name)
 
     cleanup = staticmethod(cleanup)
 
     def cleanupAll(ns = None):
         ns = Lock._mknamespace(ns)
         nspath = os.path.join(Lock.BASE_DIR, ns)
+        lockstats.removeStats(ns)
 
         if not os.path.exists(nspath):
             return
@@ -157,6 +162,42 @@ class Lock:
             util.SMlog("Failed to rmdir(%s): %s" % (path, e))
     _rmdir = staticmethod(_rmdir)
 
+    #
+    # Holder record: "<pid> <time acquired> <command>" in the lock file
+    # while the lock is held
+    #
+
+    def _getHolder(self):
+        """The command holding the lock, as recorded in the lock file"""
+        try:
+            self.lockfile.seek(0)
+            fields = self.lockfile.read().split(None, 2)
+        except IOError:
+            return "?"
+        if len(fields) < 3:
+            return "?"
+        return fields[2].strip()
+
+    def _setHolder(self):
+        command = "?"
+        if getattr(sys, "argv", None):
+            # not the arguments: they may carry credentials
+            command = os.path.basename(sys.argv[0])
+        try:
+            self.lockfile.seek(0)
+            self.lockfile.truncate()
+            self.lockfile.write("%d %.3f %s\n" % (os.getpid(), time.time(),
+                command))
+            self.lockfile.flush()
+        except IOError:
+            pass
+
+    def _clearHolder(self):
+        try:
+            self.lockfile.truncate(0)
+        except IOError:
+            pass
+
     #
     # Actual Locking
     #
@@ -165,10 +206,20 @@ class Lock:
         """Blocking lock aquisition, with warnings. We don't expect to lock a
         lot. If so, not to collide. Coarse log statements should be ok
         and aid debugging."""
-        if not self.lock.trylock():
-            util.SMlog("Failed to lock %s on first attempt, " % self.lockpath
-                   + "blocked by PID %d" % self.lock.test())
-            self.lock.lock()
+        span = smtrace.Span(smtrace.TYPE_LOCK, "%s/%s" % (self.ns, self.name))
+        try:
+            start = time.time()
+            blocker = None
+            if not self.lock.trylock():
+                blocker = self._getHolder()
+                util.SMlog("Failed to lock %s on first attempt, " % self.lockpath
+                       + "blocked by PID %d (%s)" % (self.lock.test(), blocker))
+                self.lock.lock()
+            self._setHolder()
+        finally:
+            span.end()
+        lockstats.recordAcquire(self.ns, self.name, time.time() - start,
+                blocker)
         if VERBOSE:
             util.SMlog("lock: acquired %s" % self.lockpath)
 
@@ -176,6 +227,9 @@ class Lock:
         """Acquire lock if possible, or return false if lock already held"""
         exists = os.path.exists(self.lockpath)
         ret = self.lock.trylock()
+        if ret:
+            self._setHolder()
+        lockstats.recordTry(self.ns, self.name, ret)
         if VERBOSE:
             util.SMlog("lock: tried lock %s, acquired: %s (exists: %s)" % \
                     (self.lockpath, ret, exists))
@@ -187,13 +241,12 @@ class Lock:
 
     def release(self):
         """Release a previously acquired lock."""
+        self._clearHolder()
         self.lock.unlock()
         if VERBOSE:
             util.SMlog("lock: released %s" % self.lockpath)
 
 if __debug__:
-    import sys
-
     def test():
 
         # Create a Lock
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify 
+# it under the terms of the GNU Lesser General Public License as published 
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful, 
+# but WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the 
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+"""Contention statistics for lock.Lock: counters and a wait-time histogram per
+(namespace, name), kept in STATS_DIR and updated by every process that takes
+the lock. The statistics are off unless ENABLE_FILE exists (touch it to turn
+them on for the SM commands that start after). Run this file to print them,
+together with the current holders."""
+
+import os
+import sys
+import errno
+import getopt
+import json
+import time
+import flock
+
+STATS_DIR = "/var/run/sm/lockstats"
+
+ENABLE_FILE = "/etc/xensource/sm-lockstats"
+ENABLED = os.path.exists(ENABLE_FILE)
+
+# upper bounds (in seconds) of the wait-time histogram buckets, the last
+# bucket counts the waits beyond WAIT_BUCKETS[-1]
+WAIT_BUCKETS = [0.001, 0.01, 0.1, 1, 10, 60]
+
+def _empty():
+    return {"acquired": 0,      # successful acquisitions
+            "contended": 0,     # blocking acquisitions that had to wait
+            "tries": 0,         # acquireNoblock calls
+            "failed": 0,        # acquireNoblock calls that found it held
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+            "waits": [0] * (len(WAIT_BUCKETS) + 1),
+            "blockers": {}}     # holder command -> times it made us wait
+
+def _bucket(wait):
+    for i, limit in enumerate(WAIT_BUCKETS):
+        if wait < limit:
+            return i
+    return len(WAIT_BUCKETS)
+
+def _read(fd):
+    text = ""
+    while True:
+        buf = os.read(fd, 4096)
+        if not buf:
+            break
+        text += buf
+    stats = _empty()
+    if text:
+        stats.update(json.loads(text))
+    return stats
+
+def _update(ns, name, update):
+    """Apply update() to the stats of the lock, under an exclusive fcntl lock
+    on its stats file. Failures are ignored: the stats must never get in the
+    way of the locking"""
+    if not ENABLED:
+        return
+    path = os.path.join(STATS_DIR, ns, name)
+    try:
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            flock.WriteLock(fd).lock()
+            stats = _read(fd)
+            update(stats)
+            os.lseek(fd, 0, 0)
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps(stats))
+        finally:
+            # also drops the fcntl lock
+            os.close(fd)
+    except (OSError, IOError, ValueError):
+        pass
+
+def recordAcquire(ns, name, wait, blocker = None):
+    """Record a blocking acquisition that waited 'wait' seconds, 'blocker'
+    being the command that held the lock when we started waiting"""
+    def update(stats):
+        stats["acquired"] += 1
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+        stats["waits"][_bucket(wait)] += 1
+        if blocker is not None:
+            stats["contended"] += 1
+            stats["blockers"][blocker] = stats["blockers"].get(blocker, 0) + 1
+    _update(ns, name, update)
+
+def recordTry(ns, name, acquired):
+    """Record an acquireNoblock call"""
+    def update(stats):
+        stats["tries"] += 1
+        if acquired:
+            stats["acquired"] += 1
+        else:
+            stats["failed"] += 1
+    _update(ns, name, update)
+
+def getStats(ns = None):
+    """Return {(ns, name): stats} for the locks in namespace 'ns', or all"""
+    result = {}
+    if ns is None:
+        try:
+            namespaces = os.listdir(STATS_DIR)
+        except OSError:
+            return result
+    else:
+        namespaces = [ns]
+    for ns in namespaces:
+        try:
+            names = os.listdir(os.path.join(STATS_DIR, ns))
+        except OSError:
+            continue
+        for name in names:
+            try:
+                fd = os.open(os.path.join(STATS_DIR, ns, name), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                try:
+                    result[(ns, name)] = _read(fd)
+                except ValueError:
+                    pass # being rewritten
+            finally:
+                os.close(fd)
+    return result
+
+def removeStats(ns, name = None):
+    """Remove the stats of lock 'name' in namespace 'ns', or of all the locks
+    in 'ns'. Done whether or not the stats are enabled, so that the files
+    written while they were go with their locks"""
+    nspath = os.path.join(STATS_DIR, ns)
+    if name is None:
+        try:
+            names = os.listdir(nspath)
+        except OSError:
+            return
+    else:
+        names = [name]
+    for name in names:
+        try:
+            os.unlink(os.path.join(nspath, name))
+        except OSError:
+            pass
+    try:
+        os.rmdir(nspath)
+    except OSError:
+        pass # not empty
+
+def clearStats():
+    for (ns, name) in getStats().keys():
+        try:
+            os.unlink(os.path.join(STATS_DIR, ns, name))
+        except OSError:
+            pass
+
+def getHolder(lockpath):
+    """Return (pid, since, command) of the current holder of the lock file
+    at lockpath, or None if the lock is not held by another process. Not for
+    use by lock holders: closing the file drops the fcntl locks of the
+    process on it"""
+    try:
+        f = open(lockpath)
+    except IOError:
+        return None
+    try:
+        pid = flock.WriteLock(f.fileno()).test()
+        if pid == -1:
+            return None
+        fields = f.read().split(None, 2)
+        since = None
+        command = "?"
+        if len(fields) == 3:
+            since = float(fields[1])
+            command = fields[2].strip()
+        return (pid, since, command)
+    finally:
+        f.close()
+
+
+def usage():
+    print """Print the contention statistics of the SM locks, busiest first
+
+Parameters:
+    -n --namespace <ns>  only the locks in namespace <ns>
+    -c --clear           reset the statistics
+"""
+    sys.exit(1)
+
+def main():
+    import lock
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:ch",
+                ["namespace=", "clear", "help"])
+    except getopt.GetoptError:
+        usage()
+    ns = None
+    for o, a in opts:
+        if o in ("-n", "--namespace"):
+            ns = a
+        elif o in ("-c", "--clear"):
+            clearStats()
+            return
+        else:
+            usage()
+
+    stats = getStats(ns)
+    keys = stats.keys()
+    keys.sort(key = lambda x: stats[x]["wait_total"], reverse = True)
+    buckets = ["<%gs" % x for x in WAIT_BUCKETS] + [">%gs" % WAIT_BUCKETS[-1]]
+    print "%-50s %8s %8s %8s %8s %10s %10s  %s" % ("lock", "acquired",
+            "waited", "tries", "failed", "total (s)", "max (s)",
+            " ".join(buckets))
+    for key in keys:
+        s = stats[key]
+        print "%-50s %8d %8d %8d %8d %10.3f %10.3f  %s" % ("/".join(key),
+                s["acquired"], s["contended"], s["tries"], s["failed"],
+                s["wait_total"], s["wait_max"],
+                " ".join([str(x) for x in s["waits"]]))
+        blockers = s["blockers"].items()
+        blockers.sort(key = lambda x: x[1], reverse = True)
+        if blockers:
+            print "    waited for: %s" % ", ".join(["%s (%d)" % x for x in
+                blockers])
+        holder = getHolder(os.path.join(lock.Lock.BASE_DIR, *key))
+        if holder:
+            pid, since, command = holder
+            held = ""
+            if since is not None:
+                held = " for %.1fs" % (time.time() - since)
+            print "    held by PID %d (%s)%s" % (pid, command, held)
+
+if __name__ == '__main__':
+    main()
@@ -118,8 +118,10 @@ def getLVInfo(lvmCache, lvName = None):
         lvs[uuid] = lv
     return lvs
 
-def getVDIInfo(lvmCache):
-    """Load VDI info (both LV and if the VDI is not raw, VHD info)"""
+def getVDIInfo(lvmCache, vhds = None):
+    """Load VDI info (both LV and if the VDI is not raw, VHD info). The VHD
+    info is read from the VG unless it is supplied in 'vhds' (uuid ->
+    VHDInfo)"""
     vdis = {}
     lvs = getLVInfo(lvmCache)
 
@@ -139,8 +141,9 @@ def getVDIInfo(lvmCache):
         vdis[uuid]         = vdiInfo
 
     if haveVHDs:
-        pattern = "%s*" % LV_PREFIX[vhdutil.VDI_TYPE_VHD]
-        vhds = vhdutil.getAllVHDs(pattern, extractUuid, lvmCache.vgName)
+        if vhds is None:
+            pattern = "%s*" % LV_PREFIX[vhdutil.VDI_TYPE_VHD]
+            vhds = vhdutil.getAllVHDs(pattern, extractUuid, lvmCache.vgName)
         uuids = vdis.keys()
         for uuid in uuids:
             vdi = vdis[uuid]
@@ -296,10 +299,11 @@ def lvRefreshOnSlaves(session, srUuid, vgName, lvName, vdiUuid, slaves):
             "uuid3"  : vdiUuid,
             "ns3"    : NS_PREFIX_LVM + srUuid,
             "lvName3": lvName}
-    for slave in slaves:
+    def refresh(session, slave):
         util.SMlog("Refreshing %s on slave %s" % (lvName, slave))
         text = session.xenapi.host.call_plugin(slave, "on-slave", "multi", args)
-        util.SMlog("call-plugin returned: '%s'" % text)
+        util.SMlog("call-plugin on %s returned: '%s'" % (slave, text))
+    util.check_host_results(util.call_on_hosts(session, slaves, refresh))
 
 def lvRefreshOnAllSlaves(session, srUuid, vgName, lvName, vdiUuid):
     slaves = util.get_all_slaves(session)
@@ -62,6 +62,24 @@ class LVActivator:
         self.lvActivations[persistent][binary][uuid] = lvName
         self.lvmCache.activate(self.ns, uuid, lvName, binary)
 
+    def activateMulti(self, lvs, persistent = False):
+        """activate() for a list of (uuid, lvName, binary), e.g. a VHD chain,
+        with a single refcount update and LVM command. Nothing is recorded if
+        this fails, as LVMCache.activateMulti undoes its changes then"""
+        todo = []
+        for uuid, lvName, binary in lvs:
+            if self.lvActivations[persistent][binary].get(uuid):
+                if persistent:
+                    raise LVManagerException("Double persistent activation: " \
+                            "%s" % uuid)
+                continue
+            todo.append((uuid, lvName, binary))
+        if not todo:
+            return
+        self.lvmCache.activateMulti(self.ns, todo)
+        for uuid, lvName, binary in todo:
+            self.lvActivations[persistent][binary][uuid] = lvName
+
     def activateEnforce(self, uuid, lvName, lvPath):
         """incrementing the refcount is not enough to keep an LV activated if
         another party is unaware of refcounting. For example, blktap does 
@@ -91,14 +109,30 @@ class LVActivator:
         # operation failed - don't throw exceptions here
         success = True
         for persistent in [self.TEMPORARY, self.PERSISTENT]:
+            lvs = []
             for binary in [self.NORMAL, self.BINARY]:
-                uuids = self.lvActivations[persistent][binary].keys()
-                for uuid in uuids:
-                    try:
-                        self.deactivate(uuid, binary, persistent)
-                    except:
-                        success = False
-                        util.logException("_deactivateAll")
+                for uuid, lvName in \
+                        self.lvActivations[persistent][binary].items():
+                    if self.openFiles.get(uuid):
+                        self.openFiles[uuid].close()
+                        del self.openFiles[uuid]
+                        self.lvmCache.changeOpen(lvName, -1)
+                    lvs.append((uuid, lvName, binary))
+            if not lvs:
+                continue
+            try:
+                failed = self.lvmCache.deactivateMulti(self.ns, lvs)
+            except:
+                success = False
+                util.logException("_deactivateAll")
+                continue
+            if failed:
+                success = False
+                util.SMlog("_deactivateAll: failed to deactivate %s" % \
+                        [uuid for uuid, lvName, binary in failed])
+            for uuid, lvName, binary in lvs:
+                if (uuid, lvName, binary) not in failed:
+                    del self.lvActivations[persistent][binary][uuid]
         return success
 
     def deactivate(self, uuid, binary, persistent = False):
@@ -21,9 +21,15 @@
 import os
 import util
 import lvutil
+import json
 from lock import Lock
 from refcounter import RefCounter
 
+# The "lvs" output is saved here, keyed by the VG uuid and seqno, so that it 
+# can be reused across SM invocations for as long as the VG metadata does 
+# not change
+CACHE_DIR = "/var/run/sm/lvmcache"
+
 class LVInfo:
     def __init__(self, name):
         self.name = name
@@ -65,14 +71,43 @@ class LVMCache:
         self.lvs = dict()
         self.tags = dict()
         self.initialized = False
+        # the VG uuid and seqno as of the last refresh, None if unknown
+        self.vgId = None
         util.SMlog("LVMCache created for %s" % vgName)
 
     def refresh(self):
-        """Get the LV information for the VG using "lvs" """
+        """Get the LV information for the VG using "lvs", unless the VG 
+        metadata has not changed since it was last saved (by any invocation
+        on this host), as indicated by the VG seqno. The LV activation state
+        is not part of the VG metadata, so it is then read from 
+        device-mapper"""
         util.SMlog("LVMCache: refreshing")
-        cmd = [lvutil.CMD_LVS,
-                "--noheadings", "--units", "b", "-o", "+lv_tags", self.vgPath]
-        text = util.pread2(cmd)
+        vgId = self._getVGId()
+        self.vgId = vgId
+        text = None
+        if vgId:
+            text = self._loadSaved(vgId)
+        if text is not None:
+            dmState = self._getDMState()
+            if dmState is None:
+                text = None
+        if text is not None:
+            util.SMlog("LVMCache: VG %s unchanged (%s)" % (self.vgName, vgId))
+            self._parseLVs(text)
+            for lvName, lvInfo in self.lvs.iteritems():
+                openCount = dmState.get(self._getDMName(lvName))
+                lvInfo.active = (openCount is not None)
+                lvInfo.open = int(openCount > 0)
+        else:
+            cmd = [lvutil.CMD_LVS, "--noheadings", "--units", "b",
+                    "-o", "+lv_tags", self.vgPath]
+            text = util.pread2(cmd)
+            self._parseLVs(text)
+            if vgId:
+                self._save(vgId, text)
+        self.initialized = True
+
+    def _parseLVs(self, text):
         self.lvs.clear()
         self.tags.clear()
         for line in text.split('\n'):
@@ -91,7 +126,6 @@ class LVMCache:
                 tags = fields[4].split(',')
                 for tag in tags:
                     self._addTag(lvName, tag)
-        self.initialized = True
 
     #
     # lvutil functions
@@ -114,6 +148,15 @@ class LVMCache:
             self._removeTag(lvName, tag)
         del self.lvs[lvName]
 
+    @lazyInit
+    def removeMulti(self, lvNames):
+        """Remove several LVs with a single LVM command"""
+        lvutil.removeMulti(map(self._getPath, lvNames))
+        for lvName in lvNames:
+            for tag in list(self.lvs[lvName].tags):
+                self._removeTag(lvName, tag)
+            del self.lvs[lvName]
+
     @lazyInit
     def rename(self, lvName, newName):
         path = self._getPath(lvName)
@@ -188,6 +231,120 @@ class LVMCache:
         finally:
             lock.release()
 
+    @lazyInit
+    def activateMulti(self, ns, lvs):
+        """activate() for a list of (ref, lvName, binary), e.g. a VHD chain:
+        the refcounts are updated at once and the LVs that need activating
+        are activated with a single LVM command. If that fails, the refcounts
+        are restored and the LVs that this call activated are deactivated
+        again before raising, so that either all of the LVs are activated or
+        none of them are (apart from those already active before)"""
+        locks = self._lockRefs(ns, lvs)
+        try:
+            refs = [(ref, binary) for ref, lvName, binary in lvs]
+            counts = RefCounter.getMulti(refs, ns)
+            lvNames = [lvs[i][1] for i in range(len(lvs)) if counts[i] == 1]
+            wasActive = [lvName for lvName in lvNames \
+                    if self.checkLV(lvName) and self.lvs[lvName].active]
+            try:
+                self.activateNoRefcountMulti(lvNames)
+            except util.CommandException:
+                RefCounter.putMulti(refs, ns)
+                try:
+                    self.refresh()
+                    self.deactivateNoRefcountMulti([lvName for lvName in \
+                            lvNames if lvName not in wasActive and \
+                            self.checkLV(lvName) and \
+                            self.lvs[lvName].active])
+                except util.CommandException:
+                    util.logException("activateMulti rollback")
+                raise
+        finally:
+            for lock in locks:
+                lock.release()
+
+    @lazyInit
+    def deactivateMulti(self, ns, lvs):
+        """deactivate() for a list of (ref, lvName, binary): the refcounts are
+        updated at once and the LVs no longer referenced are deactivated with
+        a single LVM command, or one by one if that fails. Returns the (ref,
+        lvName, binary) for which deactivate() would have raised, the
+        refcounts of those still active being restored"""
+        locks = self._lockRefs(ns, lvs)
+        try:
+            refs = [(ref, binary) for ref, lvName, binary in lvs]
+            counts = RefCounter.putMulti(refs, ns)
+            unused = [lvs[i] for i in range(len(lvs)) if counts[i] == 0]
+            failed = [x for x in unused if not self.checkLV(x[1])]
+            if failed:
+                util.SMlog("LV info not found for %s" % \
+                        [ref for ref, lvName, binary in failed])
+            unused = [x for x in unused if self.checkLV(x[1])]
+            if [x for x in unused if self.lvs[x[1]].open]:
+                # check again in case the cached values are stale
+                self.refresh()
+                for ref, lvName, binary in unused:
+                    if self.checkLV(lvName) and self.lvs[lvName].open:
+                        util.SMlog("WARNING: deactivate: LV %s open" % lvName)
+                unused = [x for x in unused if not self.checkLV(x[1]) or \
+                        not self.lvs[x[1]].open]
+
+            try:
+                self.deactivateNoRefcountMulti([x[1] for x in unused])
+                return failed
+            except util.CommandException:
+                util.SMlog("Deactivating %d LVs at once failed, retrying "
+                        "one by one" % len(unused))
+            for ref, lvName, binary in unused:
+                try:
+                    self.deactivateNoRefcount(lvName)
+                except util.CommandException:
+                    self.refresh()
+                    if self.checkLV(lvName):
+                        util.SMlog("LV %s could not be deactivated" % lvName)
+                        if self.lvs[lvName].active:
+                            util.SMlog("Reverting the refcount change")
+                            RefCounter.get(ref, binary, ns)
+                        failed.append((ref, lvName, binary))
+                    else:
+                        util.SMlog("LV %s not found" % lvName)
+            return failed
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def _lockRefs(self, ns, lvs):
+        """Acquire the locks of the refs of lvs, in a fixed order"""
+        refs = list(set([ref for ref, lvName, binary in lvs]))
+        refs.sort()
+        locks = []
+        try:
+            for ref in refs:
+                lock = Lock(ref, ns)
+                lock.acquire()
+                locks.append(lock)
+        except:
+            for lock in locks:
+                lock.release()
+            raise
+        return locks
+
+    @lazyInit
+    def activateNoRefcountMulti(self, lvNames):
+        if not lvNames:
+            return
+        lvutil.activateNoRefcountMulti(map(self._getPath, lvNames))
+        for lvName in lvNames:
+            self.lvs[lvName].active = True
+
+    @lazyInit
+    def deactivateNoRefcountMulti(self, lvNames):
+        if not lvNames:
+            return
+        lvutil.deactivateNoRefcountMulti(map(self._getPath, lvNames))
+        for lvName in lvNames:
+            self.lvs[lvName].active = False
+
     @lazyInit
     def activateNoRefcount(self, lvName, refresh = False):
         path = self._getPath(lvName)
@@ -221,6 +378,29 @@ class LVMCache:
             lvutil.setReadonly(path, readonly)
             self.lvs[lvName].readonly = readonly
 
+    @lazyInit
+    def setHiddenMulti(self, lvNames, hidden=True):
+        """Set or clear the hidden tag of several LVs with a single LVM
+        command"""
+        if not lvNames:
+            return
+        lvutil.setHiddenMulti(map(self._getPath, lvNames), hidden)
+        for lvName in lvNames:
+            if hidden:
+                self._addTag(lvName, lvutil.LV_TAG_HIDDEN)
+            else:
+                self._removeTag(lvName, lvutil.LV_TAG_HIDDEN)
+
+    @lazyInit
+    def setReadonlyMulti(self, lvNames, readonly):
+        """setReadonly() for several LVs with a single LVM command"""
+        lvNames = filter(lambda x: self.lvs[x].readonly != readonly, lvNames)
+        if not lvNames:
+            return
+        lvutil.setReadonlyMulti(map(self._getPath, lvNames), readonly)
+        for lvName in lvNames:
+            self.lvs[lvName].readonly = readonly
+
     @lazyInit
     def changeOpen(self, lvName, inc):
         """We don't actually open or close the LV, just mark it in the cache"""
@@ -272,6 +452,70 @@ class LVMCache:
     #
     # private
     #
+    def _getVGId(self):
+        """The VG uuid and seqno, which changes with every VG metadata 
+        update. None if it cannot be determined"""
+        cmd = [lvutil.CMD_VGS, "--noheadings", "-o", "vg_uuid,vg_seqno",
+                self.vgName]
+        try:
+            return " ".join(util.pread2(cmd).split())
+        except util.CommandException, e:
+            util.SMlog("LVMCache: failed to get the VG seqno: %s" % e)
+            return None
+
+    def _getSavePath(self):
+        return os.path.join(CACHE_DIR, self.vgName)
+
+    def _loadSaved(self, vgId):
+        try:
+            f = open(self._getSavePath())
+            try:
+                saved = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+        if saved.get("vg") != vgId:
+            return None
+        return str(saved["lvs"])
+
+    def _save(self, vgId, text):
+        path = self._getSavePath()
+        tmpPath = "%s.%d" % (path, os.getpid())
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            f = open(tmpPath, "w")
+            try:
+                json.dump({"vg": vgId, "lvs": text}, f)
+            finally:
+                f.close()
+            os.rename(tmpPath, path)
+        except (IOError, OSError), e:
+            util.SMlog("LVMCache: failed to save LV info: %s" % e)
+
+    def _getDMName(self, lvName):
+        return "%s-%s" % (self.vgName.replace("-", "--"),
+                lvName.replace("-", "--"))
+
+    def _getDMState(self):
+        """Return the open count of every device-mapper device on this host,
+        by name, or None on failure"""
+        cmd = [lvutil.CMD_DMSETUP, "info", "-c", "--noheadings",
+                "--separator", " ", "-o", "name,open"]
+        try:
+            text = util.pread2(cmd)
+        except util.CommandException, e:
+            util.SMlog("LVMCache: failed to get the device-mapper state: %s" \
+                    % e)
+            return None
+        dmState = dict()
+        for line in text.split('\n'):
+            fields = line.split()
+            if len(fields) == 2:
+                dmState[fields[0]] = int(fields[1])
+        return dmState
+
     def _getPath(self, lvName):
         return os.path.join(self.vgPath, lvName)
 
@@ -422,6 +422,19 @@ def remove(path, config_param=None):
             util.SMlog("*** lvremove failed on attempt #%d" % i)
     _lvmBugCleanup(path)
 
+def removeMulti(paths):
+    """Remove several LVs of the same VG with a single LVM command"""
+    try:
+        util.pread2([CMD_LVREMOVE, "-f"] + paths)
+    except util.CommandException, e:
+        util.SMlog("*** lvremove of %d LVs failed, removing them one by one" \
+                % len(paths))
+        for path in paths:
+            if _checkLV(path):
+                remove(path)
+    for path in paths:
+        _lvmBugCleanup(path)
+
 def _remove(path, config_param=None):
     CONFIG_TAG = "--config"
     cmd = [CMD_LVREMOVE, "-f", path]
@@ -440,6 +453,14 @@ def setReadonly(path, readonly):
     cmd = [CMD_LVCHANGE, path, "-p", val]
     ret = util.pread(cmd)
 
+def setReadonlyMulti(paths, readonly):
+    """setReadonly() for several LVs of the same VG at once"""
+    val = "r"
+    if not readonly:
+        val += "w"
+    cmd = [CMD_LVCHANGE] + paths + ["-p", val]
+    ret = util.pread(cmd)
+
 def exists(path):
     cmd = [CMD_LVS, "--noheadings", path]
     try:
@@ -491,6 +512,14 @@ def setHidden(path, hidden = True):
     cmd = [CMD_LVCHANGE, opt, LV_TAG_HIDDEN, path]
     util.pread2(cmd)
 
+def setHiddenMulti(paths, hidden = True):
+    """setHidden() for several LVs of the same VG at once"""
+    opt = "--addtag"
+    if not hidden:
+        opt = "--deltag"
+    cmd = [CMD_LVCHANGE, opt, LV_TAG_HIDDEN] + paths
+    util.pread2(cmd)
+
 def activateNoRefcount(path, refresh):
     cmd = [CMD_LVCHANGE, "-ay", path]
     text = util.pread2(cmd)
@@ -530,6 +559,23 @@ def _deactivate(path):
     cmd = [CMD_LVCHANGE, "-an", path]
     text = util.pread2(cmd)
 
+def activateNoRefcountMulti(paths):
+    """activateNoRefcount() (without refresh) for several LVs of the same VG
+    with a single LVM command"""
+    cmd = [CMD_LVCHANGE, "-ay"] + paths
+    text = util.pread2(cmd)
+    for path in paths:
+        if not _checkActive(path):
+            raise util.CommandException(-1, str(cmd), "LV not activated")
+
+def deactivateNoRefcountMulti(paths):
+    """deactivateNoRefcount() for several LVs of the same VG with a single
+    LVM command. There are no retries: on failure, the caller should fall
+    back to deactivateNoRefcount() for the LVs that are still active"""
+    cmd = [CMD_LVCHANGE, "-an"] + paths
+    text = util.pread2(cmd)
+    _lvmBugCleanupMulti(paths)
+
 #def getLVInfo(path):
 #    cmd = [CMD_LVS, "--noheadings", "--units", "b", "-o", "+lv_tags", path]
 #    text = util.pread2(cmd)
@@ -587,6 +633,20 @@ def _checkActive(path):
 
     return False
 
+def _lvmBugCleanupMulti(paths):
+    """_lvmBugCleanup() for several LVs, listing the device-mapper devices
+    once to find the LVs that need it"""
+    cmd = [CMD_DMSETUP, "info", "-c", "--noheadings", "-o", "name"]
+    try:
+        devices = set(util.pread2(cmd).split())
+    except util.CommandException:
+        devices = None
+    for path in paths:
+        mapperDevice = path[5:].replace("-", "--").replace("/", "-")
+        if devices is None or mapperDevice in devices or \
+                util.pathexists("/dev/mapper/" + mapperDevice):
+            _lvmBugCleanup(path)
+
 def _lvmBugCleanup(path):
     # the device should not exist at this point. If it does, this was an LVM 
     # bug, and we manually clean up after LVM here
@@ -56,6 +56,9 @@ def reconfigure():
 regex = re.compile("[0-9]+:[0-9]+:[0-9]+:[0-9]+\s*([a-z]*)")
 regex2 = re.compile("multipathd>(\s*[^:]*:)?\s+(.*)")
 regex3 = re.compile("switchgroup")
+# The first line of a map in a topology: its name, then its wwid in brackets
+# if the name is an alias, then its dm device
+regex4 = re.compile("^(\S+)\s+(\((\S+)\)\s+)?dm-[0-9]+")
 
 def is_working():
     cmd="help"
@@ -89,6 +92,27 @@ def get_all_topologies():
     cmd="show topology"
     return do_get_topology(cmd)
 
+def split_topologies(lines):
+    """Split the lines of 'show topology' by map, into a dict map name (and
+    wwid, if the name is an alias) -> the lines of the map"""
+    topologies = {}
+    current = None
+    for line in lines:
+        m = regex4.search(line)
+        if m:
+            current = [line]
+            topologies[m.group(1)] = current
+            if m.group(3):
+                topologies[m.group(3)] = current
+        elif current is not None:
+            current.append(line)
+    return topologies
+
+def get_topologies():
+    """The topology of every map, from a single multipathd command, in the
+    form of split_topologies"""
+    return split_topologies(get_all_topologies())
+
 def list_paths(scsi_id):
     lines = get_topology(scsi_id)
     matches = []
@@ -46,6 +46,9 @@ MP_INUSEDIR = "/dev/disk/mpInuse"
 
 MPPGETAIDLNOBIN = "/opt/xensource/bin/xe-get-arrayid-lunnum"
 
+PATH_WAIT_TIMEOUT = 60 # seconds
+PATH_POLL_INTERVAL = 0.2 # seconds, between udev settles, doubling up to 1
+
 def _is_mpath_daemon_running():
     cmd = ["/sbin/pidof", "-s", "/sbin/multipathd"]
     (rc,stdout,stderr) = util.doexec(cmd)
@@ -169,39 +172,45 @@ def map_by_scsibus(sid,npaths=0):
 
     util.SMlog("map_by_scsibus: sid=%s" % sid)
 
-    devices = []
-
-    # Wait for up to 60 seconds for n devices to appear
-    for attempt in range(0,60):
-        devices = scsiutil._genReverseSCSIidmap(sid)
+    devices = _wait_for_paths(sid, npaths, PATH_WAIT_TIMEOUT)
+    if len(devices) and (len(devices)>=npaths or npaths==0):
+        # Enable this device's sid: it could be blacklisted
+        # We expect devices to be blacklisted according to their
+        # wwid only. Checking the first one is sufficient
+        if wwid_conf.is_blacklisted(devices[0]):
+            try:
+                wwid_conf.edit_wwid(sid)
+            except:
+                util.SMlog("WARNING: exception raised while attempting to"
+                           " modify multipath.conf")
+            try:
+                mpath_cli.reconfigure()
+            except:
+                util.SMlog("WARNING: exception raised while attempting to"
+                           " reconfigure")
+            time.sleep(5)
 
-        # If we've got the right number of paths, or we don't know
-        # how many devices there ought to be, tell multipathd about
-        # the paths, and return.
-        if(len(devices)>=npaths or npaths==0):
-            # Enable this device's sid: it could be blacklisted
-            # We expect devices to be blacklisted according to their
-            # wwid only. Checking the first one is sufficient
-            if wwid_conf.is_blacklisted(devices[0]):
-                try:
-                    wwid_conf.edit_wwid(sid)
-                except:
-                    util.SMlog("WARNING: exception raised while attempting to"
-                               " modify multipath.conf")
-                try:
-                    mpath_cli.reconfigure()
-                except:
-                    util.SMlog("WARNING: exception raised while attempting to"
-                               " reconfigure")
-                time.sleep(5)
-
-            __map_explicit(devices)
-            return
+    __map_explicit(devices)
 
-        time.sleep(1)
+def _wait_for_paths(sid, npaths, timeout):
+    """Return the /dev/disk/by-scsibus paths of sid once there are npaths of
+    them (or any number, if npaths is 0), or when timeout seconds have passed.
+    Waits on udev to create the links, rather than sleeping"""
+    deadline = time.time() + timeout
+    interval = PATH_POLL_INTERVAL
+    while True:
+        devices = scsiutil._genReverseSCSIidmap(sid)
+        if len(devices)>=npaths or npaths==0:
+            return devices
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            util.SMlog("MPATH: %d of %d paths of %s appeared" % \
+                       (len(devices), npaths, sid))
+            return devices
+        scsiutil.settle(max(int(remaining), 1))
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, 1)
 
-    __map_explicit(devices)
-    
 def refresh(sid,npaths):
     # Refresh the multipath status
     util.SMlog("Refreshing LUN %s" % sid)
@@ -220,6 +229,8 @@ def refresh(sid,npaths):
 
 def _refresh_DMP(sid, npaths):
     map_by_scsibus(sid,npaths)
+    # the map's device node is created by udev
+    scsiutil.settle()
     path = os.path.join(DEVMAPPERPATH, sid)
     util.wait_for_path(path, 10)
     if not os.path.exists(path):
@@ -117,18 +117,30 @@ def match_pathup(s):
 def _tostring(l):
     return str(l)
 
-def get_path_count(SCSIid, active=True):
-    count = 0
+# The topology of the maps, read once per run: only that of the map being
+# updated when matching a single SCSIid, that of all the maps otherwise
+topologies = None
+def get_topology(SCSIid):
+    global topologies
+    if topologies is None:
+        if match_bySCSIid:
+            topologies = {SCSIid: mpath_cli.get_topology(SCSIid)}
+        else:
+            topologies = mpath_cli.get_topologies()
+    return topologies.get(SCSIid, [])
+
+def get_path_count(SCSIid):
+    """Return (active, total) path counts"""
     if (mpp_luncheck.is_RdacLun(SCSIid)):
         (total_count, active_count) = mpp_mpathutil.get_pathinfo(SCSIid)
-        return (total_count, active_count)
-    lines = mpath_cli.get_topology(SCSIid)
-    for line in filter(match_dmpLUN,lines):
-        if not active:
-            count += 1
-        elif match_pathup(line):
+        return (active_count, total_count)
+    count = 0
+    total = 0
+    for line in filter(match_dmpLUN,get_topology(SCSIid)):
+        total += 1
+        if match_pathup(line):
             count += 1
-    return count
+    return (count, total)
 
 def get_root_dev_major():
     buf = os.stat('/')
@@ -159,11 +171,7 @@ def update_config(key, SCSIid, entry, remove, add, mpp_path_update = False):
         path = MP_INUSEDIR + "/" + SCSIid
     util.SMlog("MPATH: Updating entry for [%s], current: %s" % (SCSIid,entry))
     if os.path.exists(path):
-        if rdaclun:
-            (total, count) = get_path_count(SCSIid)
-        else:
-            count = get_path_count(SCSIid)
-            total = get_path_count(SCSIid, active=False)
+        (count, total) = get_path_count(SCSIid)
         max = 0
 	if len(entry) != 0:
             try:
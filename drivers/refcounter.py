@@ -20,12 +20,17 @@
 # parameter "binary" specifies which of the two counters to update, while the 
 # return value is zero IFF both counters are zero
 #
-# Synchronization must be done at a higher level, by the users of this module
+# The counts of a namespace are kept in a single table file, which is locked
+# for the duration of each update, so the counts of many objects can be
+# adjusted at once (getMulti/putMulti/adjustMulti). Synchronization of the
+# operations that the counts protect must still be done at a higher level, by
+# the users of this module
 #
 
 
 import os
 import util
+import flock
 from lock import Lock
 import errno
 
@@ -37,6 +42,9 @@ class RefCounter:
     operations are get() and put(), and they are atomic."""
 
     BASE_DIR = "/var/run/sm/refcount"
+    TABLE_SUFFIX = ".table"
+    RECORD_SIZE = 128
+    NAME_SIZE = RECORD_SIZE - len(" %10d %1d\n" % (0, 0))
 
     def get(obj, binary, ns = None):
         """Get (inc ref count) 'obj' in namespace 'ns' (optional). 
@@ -57,6 +65,22 @@ class RefCounter:
             return RefCounter._adjust(ns, obj, -1, 0)
     put = staticmethod(put)
 
+    def getMulti(objs, ns):
+        """Get (inc ref count) every (obj, binary) in 'objs' in namespace
+        'ns' with a single update of the namespace table.
+        Returns the list of new ref counts"""
+        return RefCounter.adjustMulti(ns,
+                [(obj, int(not binary), int(binary)) for obj, binary in objs])
+    getMulti = staticmethod(getMulti)
+
+    def putMulti(objs, ns):
+        """Put (dec ref count) every (obj, binary) in 'objs' in namespace
+        'ns' with a single update of the namespace table.
+        Returns the list of new ref counts"""
+        return RefCounter.adjustMulti(ns, [(obj, -int(not binary),
+            -int(binary)) for obj, binary in objs])
+    putMulti = staticmethod(putMulti)
+
     def set(obj, count, binaryCount, ns = None):
         """Set normal & binary counts explicitly to the specified values.
         Returns new ref count"""
@@ -64,7 +88,11 @@ class RefCounter:
         assert(count >= 0 and binaryCount >= 0)
         if binaryCount > 1:
             raise RefCounterException("Binary count = %d > 1" % binaryCount)
-        RefCounter._set(ns, obj, count, binaryCount)
+        util.SMlog("Refcount for %s:%s set => (%d, %db)" % \
+                (ns, obj, count, binaryCount))
+        def update(counts):
+            counts[obj] = (count, binaryCount)
+        RefCounter._update(ns, update)
     set = staticmethod(set)
 
     def check(obj, ns = None):
@@ -103,59 +131,96 @@ class RefCounter:
                 nsList = os.listdir(RefCounter.BASE_DIR)
             except OSError:
                 raise RefCounterException("failed to get namespace list")
+            # tables and (pre-table) namespace directories
+            nsList = set([ns.endswith(RefCounter.TABLE_SUFFIX) and \
+                    ns[:-len(RefCounter.TABLE_SUFFIX)] or ns for ns in nsList])
         for ns in nsList:
             RefCounter._reset(ns, obj)
     resetAll = staticmethod(resetAll)
 
+    def adjustMulti(ns, changes):
+        """Add 'delta' to the normal refcount and 'binaryDelta' to the binary
+        refcount of 'obj' in namespace 'ns' for every (obj, delta,
+        binaryDelta) in 'changes', with a single update of the namespace
+        table. Returns the list of new ref counts"""
+        changes = list(changes)
+        for obj, delta, binaryDelta in changes:
+            if binaryDelta > 1 or binaryDelta < -1:
+                raise RefCounterException("Binary delta = %d outside [-1;1]" \
+                        % binaryDelta)
+        changes = [(RefCounter._getSafeNames(obj, ns)[0], delta, binaryDelta)
+                for obj, delta, binaryDelta in changes]
+        if not changes:
+            return []
+
+        def update(counts):
+            results = []
+            msgs = []
+            for obj, delta, binaryDelta in changes:
+                (count, binaryCount) = counts.get(obj, (0, 0))
+                newCount = count + delta
+                newBinaryCount = binaryCount + binaryDelta
+                if newCount < 0:
+                    util.SMlog("WARNING: decrementing normal refcount of 0")
+                    newCount = 0
+                if newBinaryCount < 0:
+                    util.SMlog("WARNING: decrementing binary refcount of 0")
+                    newBinaryCount = 0
+                if newBinaryCount > 1:
+                    newBinaryCount = 1
+                msgs.append("%s (%d, %d) + (%d, %d) => (%d, %d)" % (obj,
+                    count, binaryCount, delta, binaryDelta, newCount,
+                    newBinaryCount))
+                counts[obj] = (newCount, newBinaryCount)
+                results.append(newCount + newBinaryCount)
+            util.SMlog("Refcount for %s:%s" % (ns, ", ".join(msgs)))
+            return results
+        return RefCounter._update(ns, update)
+    adjustMulti = staticmethod(adjustMulti)
+
     def _adjust(ns, obj, delta, binaryDelta):
         """Add 'delta' to the normal refcount and 'binaryDelta' to the binary
         refcount of 'obj' in namespace 'ns'. 
         Returns new ref count"""
-        if binaryDelta > 1 or binaryDelta < -1:
-            raise RefCounterException("Binary delta = %d outside [-1;1]" % \
-                    binaryDelta)
         (obj, ns) = RefCounter._getSafeNames(obj, ns)
-        (count, binaryCount) = RefCounter._get(ns, obj)
-
-        newCount = count + delta
-        newBinaryCount = binaryCount + binaryDelta
-        if newCount < 0:
-            util.SMlog("WARNING: decrementing normal refcount of 0")
-            newCount = 0
-        if newBinaryCount < 0:
-            util.SMlog("WARNING: decrementing binary refcount of 0")
-            newBinaryCount = 0
-        if newBinaryCount > 1:
-            newBinaryCount = 1
-        util.SMlog("Refcount for %s:%s (%d, %d) + (%d, %d) => (%d, %d)" % \
-                (ns, obj, count, binaryCount, delta, binaryDelta,
-                    newCount, newBinaryCount))
-        RefCounter._set(ns, obj, newCount, newBinaryCount)
-        return newCount + newBinaryCount
+        return RefCounter.adjustMulti(ns, [(obj, delta, binaryDelta)])[0]
     _adjust = staticmethod(_adjust)
 
     def _get(ns, obj):
         """Get the ref count values for 'obj' in namespace 'ns'"""
-        objFile = os.path.join(RefCounter.BASE_DIR, ns, obj)
-        (count, binaryCount) = (0, 0)
-        if util.pathexists(objFile):
-            (count, binaryCount) = RefCounter._readCount(objFile)
+        if util.pathexists(os.path.join(RefCounter.BASE_DIR, ns)):
+            # migrate the pre-table counts first
+            return RefCounter._update(ns,
+                    lambda counts: counts.get(obj, (0, 0)))
+        fd = RefCounter._openTable(ns, False)
+        if fd is None:
+            return (0, 0)
+        try:
+            (count, binaryCount) = \
+                    RefCounter._readTable(fd)[0].get(obj, (0, 0, 0))[1:]
+        finally:
+            os.close(fd)
         return (count, binaryCount)
     _get = staticmethod(_get)
 
-    def _set(ns, obj, count, binaryCount):
-        """Set the ref count values for 'obj' in namespace 'ns'"""
-        util.SMlog("Refcount for %s:%s set => (%d, %db)" % \
-                (ns, obj, count, binaryCount))
-        if count == 0 and binaryCount == 0:
-            RefCounter._removeObject(ns, obj)
-        else:
-            objFile = os.path.join(RefCounter.BASE_DIR, ns, obj)
-
-            while not RefCounter._writeCount(objFile, count, binaryCount):
-                RefCounter._createNamespace(ns)
-
-    _set = staticmethod(_set)
+    def _update(ns, update):
+        """Call update() on the {obj: (count, binaryCount)} dictionary of
+        namespace 'ns' and write back the records that changed, all under
+        the table lock. Returns what update() returns"""
+        fd = RefCounter._openTable(ns, True)
+        try:
+            (records, numRecords) = RefCounter._readTable(fd)
+            counts = dict([(obj, record[1:]) for obj, record in \
+                    records.iteritems()])
+            legacy = RefCounter._readLegacy(ns, counts)
+            ret = update(counts)
+            RefCounter._writeTable(fd, records, numRecords, counts)
+            for obj in legacy:
+                RefCounter._removeObject(ns, obj)
+        finally:
+            os.close(fd)
+        return ret
+    _update = staticmethod(_update)
 
     def _getSafeNames(obj, ns):
         """Get a name that can be used as a file name"""
@@ -168,15 +233,177 @@ class RefCounter:
         return (obj, ns)
     _getSafeNames = staticmethod(_getSafeNames)
 
-    def _createNamespace(ns):
-        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
+    #
+    # The namespace table: fixed-size records of "<obj> <count> <binary>\n",
+    # blank records being free. Records are rewritten in place, so that a
+    # single-object update is a single write that never crosses a page
+    #
+
+    def _getTablePath(ns):
+        return os.path.join(RefCounter.BASE_DIR, ns + RefCounter.TABLE_SUFFIX)
+    _getTablePath = staticmethod(_getTablePath)
+
+    def _openTable(ns, write):
+        """Open and lock (for writing or reading) the table of namespace 'ns'.
+        Returns None if the namespace has no table and 'write' is False"""
+        path = RefCounter._getTablePath(ns)
+        while True:
+            try:
+                if write:
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+                else:
+                    fd = os.open(path, os.O_RDONLY)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise RefCounterException("failed to open '%s' (%s)" % \
+                            (path, e))
+                if not write:
+                    return None
+                RefCounter._createBaseDir()
+                continue
+            if write:
+                flock.WriteLock(fd).lock()
+            else:
+                flock.ReadLock(fd).lock()
+            # the table may have been removed while we waited for the lock
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except OSError:
+                pass
+            os.close(fd)
+    _openTable = staticmethod(_openTable)
+
+    def _readTable(fd):
+        """Returns ({obj: (index, count, binaryCount)}, number of records)"""
+        data = ""
+        while True:
+            buf = os.read(fd, 65536)
+            if not buf:
+                break
+            data += buf
+        records = {}
+        numRecords = len(data) / RefCounter.RECORD_SIZE
+        for i in range(numRecords):
+            record = data[i * RefCounter.RECORD_SIZE:
+                    (i + 1) * RefCounter.RECORD_SIZE]
+            obj = record[:RefCounter.NAME_SIZE].rstrip()
+            if not obj:
+                continue
+            try:
+                nums = record[RefCounter.NAME_SIZE:].split()
+                records[obj] = (i, int(nums[0]), int(nums[1]))
+            except (ValueError, IndexError):
+                raise RefCounterException("corrupt record %d in table (%s)" % \
+                        (i, repr(record)))
+        return (records, numRecords)
+    _readTable = staticmethod(_readTable)
+
+    def _writeTable(fd, records, numRecords, counts):
+        """Write out the records of the objects whose counts differ from
+        'records': in place, in a free record or appended to the table"""
+        used = set([record[0] for record in records.itervalues()])
+        free = [i for i in range(numRecords) if i not in used]
+        writes = {}
+        for obj, (index, count, binaryCount) in records.iteritems():
+            newCounts = counts.get(obj, (0, 0))
+            if newCounts == (0, 0):
+                writes[index] = None
+                used.remove(index)
+                free.append(index)
+            elif newCounts != (count, binaryCount):
+                writes[index] = obj
+        free.sort(reverse = True)
+        for obj, newCounts in counts.iteritems():
+            if obj in records or newCounts == (0, 0):
+                continue
+            if free:
+                index = free.pop()
+            else:
+                index = numRecords
+                numRecords += 1
+            writes[index] = obj
+            used.add(index)
+
+        try:
+            for index in sorted(writes.keys()):
+                obj = writes[index]
+                if obj is None:
+                    record = RefCounter._formatRecord(None, 0, 0)
+                else:
+                    record = RefCounter._formatRecord(obj, *counts[obj])
+                os.lseek(fd, index * RefCounter.RECORD_SIZE, 0)
+                os.write(fd, record)
+            # drop the free records at the end
+            size = (max(list(used) + [-1]) + 1) * RefCounter.RECORD_SIZE
+            if size < numRecords * RefCounter.RECORD_SIZE:
+                os.ftruncate(fd, size)
+        except OSError, e:
+            raise RefCounterException("failed to write refcount table (%s)" % \
+                    e)
+    _writeTable = staticmethod(_writeTable)
+
+    def _formatRecord(obj, count, binaryCount):
+        if obj is None:
+            return " " * (RefCounter.RECORD_SIZE - 1) + "\n"
+        if len(obj) > RefCounter.NAME_SIZE or obj.split() != [obj]:
+            raise RefCounterException("invalid object name '%s'" % obj)
+        return "%-*s %10d %1d\n" % (RefCounter.NAME_SIZE, obj, count,
+                binaryCount)
+    _formatRecord = staticmethod(_formatRecord)
+
+    def _createBaseDir():
         try:
-            os.makedirs(nsDir)
+            os.makedirs(RefCounter.BASE_DIR)
         except OSError, e:
             if e.errno != errno.EEXIST:
                 raise RefCounterException("failed to makedirs '%s' (%s)" % \
-                        (nsDir, e))
-    _createNamespace = staticmethod(_createNamespace)
+                        (RefCounter.BASE_DIR, e))
+    _createBaseDir = staticmethod(_createBaseDir)
+
+    def _reset(ns, obj = None):
+        if not util.pathexists(RefCounter._getTablePath(ns)) and \
+                not util.pathexists(os.path.join(RefCounter.BASE_DIR, ns)):
+            return
+        if obj:
+            def update(counts):
+                counts.pop(obj, None)
+            RefCounter._update(ns, update)
+            return
+        fd = RefCounter._openTable(ns, True)
+        try:
+            for obj in RefCounter._readLegacy(ns, {}):
+                RefCounter._removeObject(ns, obj)
+            try:
+                os.unlink(RefCounter._getTablePath(ns))
+            except OSError:
+                raise RefCounterException("failed to remove table of '%s'" % \
+                        ns)
+        finally:
+            os.close(fd)
+    _reset = staticmethod(_reset)
+
+    #
+    # Pre-table layout: one "<count> <binary>\n" file per object in a
+    # directory per namespace. Counts left in that layout (e.g. by an
+    # earlier version of this module) are moved to the table on first use
+    #
+
+    def _readLegacy(ns, counts):
+        """Add the pre-table counts of namespace 'ns' that the table does not
+        have to 'counts'. Returns the objects found"""
+        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
+        if not util.pathexists(nsDir):
+            return []
+        try:
+            objList = os.listdir(nsDir)
+        except OSError:
+            raise RefCounterException("failed to list '%s'" % ns)
+        for obj in objList:
+            if not counts.has_key(obj):
+                counts[obj] = RefCounter._readCount(os.path.join(nsDir, obj))
+        return objList
+    _readLegacy = staticmethod(_readLegacy)
 
     def _removeObject(ns, obj):
         nsDir = os.path.join(RefCounter.BASE_DIR, ns)
@@ -200,23 +427,6 @@ class RefCounter:
                 raise RefCounterException("failed to remove '%s'" % nsDir)
     _removeObject = staticmethod(_removeObject)
 
-    def _reset(ns, obj = None):
-        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
-        if not util.pathexists(nsDir):
-            return
-        if obj:
-            if not util.pathexists(os.path.join(nsDir, obj)):
-                return
-            objList = [obj]
-        else:
-            try:
-                objList = os.listdir(nsDir)
-            except OSError:
-                raise RefCounterException("failed to list '%s'" % ns)
-        for obj in objList:
-            RefCounter._removeObject(ns, obj)
-    _reset = staticmethod(_reset)
-
     def _readCount(fn):
         try:
             f = open(fn, 'r')
@@ -230,20 +440,6 @@ class RefCounter:
         return (count, binaryCount)
     _readCount = staticmethod(_readCount)
 
-    def _writeCount(fn, count, binaryCount):
-        try:
-            f = open(fn, 'w')
-            f.write("%d %d\n" % (count, binaryCount))
-            f.close()
-            return True
-        except IOError, e:
-            fileNotFound = e.errno == errno.ENOENT
-            if fileNotFound:
-                return False
-            raise RefCounterException("failed to write '(%d %d)' to '%s': %s" \
-                    % (count, binaryCount, fn, e))
-    _writeCount = staticmethod(_writeCount)
-
 
     def _runTests():
         "Unit tests"
@@ -26,12 +26,38 @@ import base64
 import time
 import errno
 import glob
+import hashlib
 import mpath_cli
 
 PREFIX_LEN = 4
 SUFFIX_LEN = 12
 SECTOR_SHIFT = 9
 
+SETTLE_TIMEOUT = 10 # seconds
+
+SYSFS_BLOCK = "/sys/block"
+
+# Designators of VPD page 0x83 (SPC-3 7.6.3)
+VPD_CODESET_BINARY = 1
+VPD_CODESET_ASCII = 2
+VPD_ID_EUI64 = 2
+VPD_ID_NAA = 3
+NAA_IEEE_REG = 5
+NAA_IEEE_REG_EXTENDED = 6
+
+# The designators scsi_id picks from, best first, as (type, NAA type, code
+# set), None being any NAA type. Beyond these it turns to T10 vendor and
+# vendor specific identifiers
+SCSI_ID_SEARCH = [
+        (VPD_ID_NAA, NAA_IEEE_REG_EXTENDED, VPD_CODESET_BINARY),
+        (VPD_ID_NAA, NAA_IEEE_REG_EXTENDED, VPD_CODESET_ASCII),
+        (VPD_ID_NAA, NAA_IEEE_REG, VPD_CODESET_BINARY),
+        (VPD_ID_NAA, NAA_IEEE_REG, VPD_CODESET_ASCII),
+        (VPD_ID_NAA, None, VPD_CODESET_BINARY),
+        (VPD_ID_NAA, None, VPD_CODESET_ASCII),
+        (VPD_ID_EUI64, None, VPD_CODESET_BINARY),
+        (VPD_ID_EUI64, None, VPD_CODESET_ASCII)]
+
 def gen_hash(st, len):
     hs = 0
     for i in st:
@@ -67,12 +93,8 @@ def getsize(path):
     return size
 
 def getuniqueserial(path):
-    dev = getdev(path)
-    output = gen_rdmfile()
     try:
-        cmd = ["md5sum"]
-        txt = util.pread3(cmd, getSCSIid(path))
-        return txt.split(' ')[0]
+        return hashlib.md5(getSCSIid(path)).hexdigest()
     except:
         return ''
 
@@ -85,8 +107,61 @@ def SCSIid_sanitise(str):
     text = re.sub("^\s+","",str)
     return re.sub("\s+","_",text)
 
+def _read_device_attr(dev, name):
+    """The contents of the sysfs attribute name of the SCSI device behind the
+    block device dev, or None if it cannot be read"""
+    try:
+        f = open(os.path.join(SYSFS_BLOCK, dev, 'device', name), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+def _vpd_designators(page):
+    """The (type, NAA type, code set, designator) of the designators of the
+    logical unit in VPD page 0x83"""
+    designators = []
+    if len(page) < 4 or ord(page[1]) != 0x83:
+        return designators
+    end = min(len(page), 4 + (ord(page[2]) << 8) + ord(page[3]))
+    pos = 4
+    while pos + 4 <= end:
+        length = ord(page[pos + 3])
+        designator = page[pos + 4:pos + 4 + length]
+        if len(designator) < length:
+            break
+        # association 0: the logical unit itself
+        if (ord(page[pos + 1]) & 0x30) == 0 and designator:
+            designators.append((ord(page[pos + 1]) & 0x0f,
+                    ord(designator[0]) >> 4, ord(page[pos]) & 0x0f,
+                    designator))
+        pos += 4 + length
+    return designators
+
+def _SCSIid_from_vpd(page):
+    """The SCSIid 'scsi_id -g' derives from VPD page 0x83, when it is a
+    binary NAA or EUI-64 designator; None when it would be anything else"""
+    designators = _vpd_designators(page)
+    for id_type, naa_type, code_set in SCSI_ID_SEARCH:
+        for designator in designators:
+            if designator[0] != id_type or designator[2] != code_set:
+                continue
+            if naa_type != None and designator[1] != naa_type:
+                continue
+            if code_set != VPD_CODESET_BINARY:
+                return None
+            return "%x%s" % (id_type, designator[3].encode("hex"))
+    return None
+
 def getSCSIid(path):
     dev = rawdev(path)
+    page = _read_device_attr(dev, 'vpd_pg83')
+    if page:
+        scsi_id = _SCSIid_from_vpd(page)
+        if scsi_id:
+            return scsi_id
     cmd_fallback = ["/usr/lib/udev/scsi_id", "-g", "-s", "/block/%s" % dev]
     cmd_new = ["/usr/lib/udev/scsi_id", "-g", "--device", "/dev/%s" % dev]
     for cmd in cmd_new, cmd_fallback:
@@ -112,6 +187,10 @@ def compareSCSIid_2_6_18(SCSIid, path):
         return False
 
 def getserial(path):
+    page = _read_device_attr(getdev(path), 'vpd_pg80')
+    if page and len(page) >= 4 and ord(page[1]) == 0x80:
+        length = (ord(page[2]) << 8) + ord(page[3])
+        return re.sub("\s+", "", page[4:4 + length]).strip('\0')
     dev = os.path.join('/dev',getdev(path))
     try:
         cmd = ["sginfo", "-s", dev]
@@ -126,6 +205,9 @@ def getserial(path):
         return ''
 
 def getmanufacturer(path):
+    vendor = _read_device_attr(rawdev(path), 'vendor')
+    if vendor:
+        return vendor.replace(' ','').strip()
     cmd = ["sginfo", "-M", path]
     try:
         for line in filter(match_vendor, util.pread2(cmd).split('\n')):
@@ -312,6 +394,18 @@ def rescan(ids, fullrescan=True):
     for id in ids:
         refresh_HostID(id, fullrescan)
 
+def settle(timeout=SETTLE_TIMEOUT):
+    """Wait until udev has handled the events queued so far (such as those of
+    a rescan), for timeout seconds at most"""
+    if os.path.exists("/sbin/udevsettle"):
+        cmd = ["/sbin/udevsettle", "--timeout=%d" % timeout]
+    else:
+        cmd = ["/sbin/udevadm", "settle", "--timeout=%d" % timeout]
+    try:
+        util.pread2(cmd)
+    except Exception, e:
+        util.SMlog("Waiting for udev failed: %s" % e)
+
 def _genArrayIdentifier(dev):
     try:
         cmd = ["sg_inq", "--page=0xc8", "-r", dev]
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify 
+# it under the terms of the GNU Lesser General Public License as published 
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful, 
+# but WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the 
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+"""Timing spans for SM operations: the SM command, the external commands it
+runs, lock waits and XenAPI calls. Spans nest, and are written to TRACE_FILE
+when the outermost span of a thread ends, one line per span:
+
+    <start> <pid> <span id> <parent span id> <type> <name> <duration>
+
+with times in seconds. Tracing is off unless ENABLE_FILE exists (touch it to
+turn tracing on for the SM commands that start after). Run this file to
+summarise the spans."""
+
+import os
+import sys
+import re
+import math
+import time
+import getopt
+import threading
+
+TRACE_FILE = "/var/log/SMtrace"
+MAX_SIZE = 8 * 1024 * 1024 # rotate to TRACE_FILE.1 beyond that
+
+ENABLE_FILE = "/etc/xensource/sm-trace"
+ENABLED = os.path.exists(ENABLE_FILE)
+
+TYPE_OP = "op"
+TYPE_EXEC = "exec"
+TYPE_TAPCTL = "tapctl"
+TYPE_LOCK = "lock"
+TYPE_XAPI = "xapi"
+
+_state = threading.local()
+_ids = [0]
+_idsLock = threading.Lock()
+
+def _nextId():
+    _idsLock.acquire()
+    try:
+        _ids[0] += 1
+        return _ids[0]
+    finally:
+        _idsLock.release()
+
+def reset():
+    """Drop the spans of this thread without writing them. To be called in a
+    child process after a fork, where the spans open in the parent never
+    end"""
+    _state.stack = []
+    _state.done = []
+
+def _stack():
+    if not hasattr(_state, "stack"):
+        _state.stack = []
+        _state.done = []
+    return _state.stack
+
+
+class Span:
+    """A timed operation. Create it when the operation starts and end() it
+    when it is over, whether it succeeded or not"""
+
+    def __init__(self, type, name):
+        self.type = type
+        self.name = re.sub(r"\s+", "_", str(name)) or "-"
+        self.id = 0
+        self.parent = 0
+        self.start = time.time()
+        self.duration = None
+        if not ENABLED:
+            return
+        stack = _stack()
+        self.id = _nextId()
+        if stack:
+            self.parent = stack[-1].id
+        stack.append(self)
+
+    def end(self):
+        if self.duration is not None:
+            return
+        self.duration = time.time() - self.start
+        if not ENABLED or not self.id:
+            return
+        stack = _stack()
+        if self in stack:
+            # also ends any nested span left open by an exception
+            del stack[stack.index(self):]
+        _state.done.append(self)
+        if not stack:
+            done = _state.done
+            _state.done = []
+            _write(done)
+
+    def toString(self):
+        return "%.3f %d %d %d %s %s %.6f" % (self.start, os.getpid(),
+                self.id, self.parent, self.type, self.name, self.duration)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.end()
+
+
+def _write(spans):
+    try:
+        try:
+            if os.stat(TRACE_FILE).st_size > MAX_SIZE:
+                os.rename(TRACE_FILE, TRACE_FILE + ".1")
+        except OSError:
+            pass
+        spans.sort(key = lambda x: x.id)
+        text = "".join(["%s\n" % span.toString() for span in spans])
+        fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, text)
+        finally:
+            os.close(fd)
+    except (OSError, IOError):
+        # tracing must never get in the way
+        pass
+
+def traceSession(session):
+    """Record a span for every XenAPI call made through session"""
+    request = session.xenapi_request
+    def xenapi_request(methodname, params):
+        span = Span(TYPE_XAPI, methodname)
+        try:
+            return request(methodname, params)
+        finally:
+            span.end()
+    session.xenapi_request = xenapi_request
+    return session
+
+
+#
+# Summary
+#
+UUID_RE = re.compile(
+        "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+def readSpans(paths, since = 0):
+    """Return (type, name, duration) for each span in the files in paths that
+    started at or after 'since'. UUIDs in names are replaced by <uuid>"""
+    spans = []
+    for path in paths:
+        try:
+            f = open(path)
+        except IOError:
+            continue
+        try:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 7:
+                    continue
+                try:
+                    start = float(fields[0])
+                    duration = float(fields[6])
+                except ValueError:
+                    continue
+                if start < since:
+                    continue
+                name = UUID_RE.sub("<uuid>", fields[5])
+                spans.append((fields[4], name, duration))
+        finally:
+            f.close()
+    return spans
+
+def percentile(values, pct):
+    """The nearest-rank percentile of the sorted list values"""
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def summarise(spans, spanType = None):
+    """Return a list of (type, name, count, p50, p99, max, total) sorted by
+    descending total time"""
+    durations = {}
+    for type, name, duration in spans:
+        if spanType and type != spanType:
+            continue
+        durations.setdefault((type, name), []).append(duration)
+    rows = []
+    for (type, name), values in durations.iteritems():
+        values.sort()
+        rows.append((type, name, len(values), percentile(values, 50),
+                percentile(values, 99), values[-1], sum(values)))
+    rows.sort(key = lambda x: x[6], reverse = True)
+    return rows
+
+def usage():
+    print """Summarise the SM timing spans recorded in %s
+
+Parameters:
+    -w --window <minutes>  only spans that started in the last <minutes>
+    -t --type <type>       only spans of <type> (%s)
+    -f --file <path>       read <path> instead of %s (and its rotated copy)
+""" % (TRACE_FILE, ", ".join([TYPE_OP, TYPE_EXEC, TYPE_TAPCTL, TYPE_LOCK,
+        TYPE_XAPI]), TRACE_FILE)
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "w:t:f:h",
+                ["window=", "type=", "file=", "help"])
+    except getopt.GetoptError:
+        usage()
+    since = 0
+    spanType = None
+    paths = [TRACE_FILE + ".1", TRACE_FILE]
+    for o, a in opts:
+        if o in ("-w", "--window"):
+            since = time.time() - float(a) * 60
+        elif o in ("-t", "--type"):
+            spanType = a
+        elif o in ("-f", "--file"):
+            paths = [a + ".1", a]
+        else:
+            usage()
+
+    rows = summarise(readSpans(paths, since), spanType)
+    print "%-7s %-40s %7s %10s %10s %10s %10s" % ("type", "name", "count",
+            "p50 (ms)", "p99 (ms)", "max (ms)", "total (s)")
+    for type, name, count, p50, p99, maxVal, total in rows:
+        print "%-7s %-40s %7d %10.1f %10.1f %10.1f %10.3f" % (type, name,
+                count, p50 * 1000, p99 * 1000, maxVal * 1000, total)
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,7 @@
 import util
 import metadata
 import os
+import re
 import sys
 sys.path.insert(0,'/opt/xensource/sm/snapwatchd')
 import xs_errors
@@ -165,6 +166,45 @@ def getSectorAlignedXML(tagName, value):
     
 def getXMLTag(tagName):
         return "<%s>%s</%s>" % (tagName, '%s', tagName)
+
+# A VDI slot, as written by getVdiInfo, is a flat <vdi><tag>text</tag>...</vdi>
+# element padded with spaces. decodeVdiSlot() decodes such slots without
+# building a DOM, and gives the same result as metadata._parseXML would
+_SLOT_ELEMENT = r"<([A-Za-z_][\w.-]*)>([^<]*)</\%d>"
+_SLOT_RE = re.compile(r"^\s*<%s>((?:\s*%s)*)\s*</%s>\s*$" % (VDI_TAG,
+        _SLOT_ELEMENT % 2, VDI_TAG))
+_SLOT_ELEMENT_RE = re.compile(_SLOT_ELEMENT % 1)
+_SLOT_UNSUPPORTED_RE = re.compile(r"\r|&(?!(amp|lt|gt|quot|apos);)")
+_SLOT_ENTITIES = {"&quot;": '"', "&apos;": "'"}
+
+def decodeVdiSlot(vdi_info):
+    """Return the VDI info map of the VDI slot vdi_info (NULs removed), or
+    None if the slot is not in the flat format, e.g. it uses character
+    references, and needs the DOM parser"""
+    match = _SLOT_RE.match(vdi_info)
+    if not match:
+        return None
+    escaped = "&" in vdi_info
+    if (escaped or "\r" in vdi_info) and _SLOT_UNSUPPORTED_RE.search(vdi_info):
+        return None
+    try:
+        vdi_info = match.group(1).decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    vdi_info_map = {}
+    for tag, text in _SLOT_ELEMENT_RE.findall(vdi_info):
+        value = text.strip()
+        if value:
+            if escaped and "&" in value:
+                value = xml.sax.saxutils.unescape(value, _SLOT_ENTITIES)
+            value = value.encode("utf-8")
+        elif text:
+            # like _walkXML on an element holding only whitespace
+            value = {}
+        else:
+            value = ''
+        vdi_info_map[str(tag)] = value
+    return vdi_info_map
     
 def updateLengthInHeader(fd, length, major = metadata.MD_MAJOR, \
                          minor = metadata.MD_MINOR):
@@ -240,6 +280,12 @@ class MetadataHandler:
 
     VDI_INFO_SIZE_IN_SECTORS = None
 
+    # Index of the VDI slots of each metadata volume, shared by all handlers
+    # in this process: path -> {'length': metadata length, 'uuids': uuid ->
+    # offset, 'free': offsets of deleted slots}. Every use is checked against
+    # the slot read, so an index made stale by another process gets rebuilt
+    slotIndexes = {}
+
     # constructor
     def __init__(self, path = None, write = True):
 
@@ -367,21 +413,26 @@ class MetadataHandler:
     def deleteVdi(self, vdi_uuid, offset = 0):
         util.SMlog("Entering deleteVdi")
         try:
-            md = self.getMetadataInternal({'vdi_uuid': vdi_uuid})
-            if not md.has_key('offset'):
+            (offset, vdi_map) = self.findVdiSlot(vdi_uuid)
+            if offset is None:
                 util.SMlog("Metadata for VDI %s not present, or already removed, " \
                     "no further deletion action required." % vdi_uuid)
                 return
             
-            md['vdi_info'][md['offset']][VDI_DELETED_TAG] = '1'
-            self.updateVdi(md['vdi_info'][md['offset']])
+            vdi_map[VDI_DELETED_TAG] = '1'
+            self.writeVdiSlot(offset, vdi_map)
             
+            index = self.slotIndexes[self.path]
+            del index['uuids'][vdi_uuid]
+            slot_size = self.VDI_INFO_SIZE_IN_SECTORS * SECTOR_SIZE
             try:
                 mdlength = getMetadataLength(self.fd)
-                if (mdlength - md['offset']) == \
-                    self.VDI_INFO_SIZE_IN_SECTORS * SECTOR_SIZE:
-                    updateLengthInHeader(self.fd, (mdlength - \
-                                    self.VDI_INFO_SIZE_IN_SECTORS * SECTOR_SIZE))
+                if (mdlength - offset) == slot_size:
+                    updateLengthInHeader(self.fd, (mdlength - slot_size))
+                    index['length'] = mdlength - slot_size
+                else:
+                    index['free'].append(offset)
+                    index['free'].sort()
             except:
                 raise
         except Exception, e:
@@ -418,32 +469,25 @@ class MetadataHandler:
     def addVdiInternal(self, Dict):
         util.SMlog("Entering addVdiInternal")
         try:
-            value = ''
             Dict[VDI_DELETED_TAG] = '0'
-            min_block_size = get_min_blk_size_wrapper(self.fd)
             mdlength = getMetadataLength(self.fd)
-            md = self.getMetadataInternal({'firstDeleted': 1, 'includeDeletedVdis': 1})
-            if not md.has_key('foundDeleted'):
-                md['offset'] = mdlength
-                (md['lower'], md['upper']) = \
-                    getBlockAlignedRange(min_block_size, mdlength, \
-                                        SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS)
-            # If this has created a new VDI, update metadata length 
-            if md.has_key('foundDeleted'):
-                value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, md['offset'])
-            else:
-                value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, mdlength)
-            
-            file_write_wrapper(self.fd, md['lower'], min_block_size, \
-                                  value, len(value))
-            
-            if md.has_key('foundDeleted'):
+            (offset, vdi_map) = self.findFreeSlot()
+            index = self.slotIndexes[self.path]
+            if offset is not None:
+                # reuse the slot of a deleted VDI
+                vdi_map.update(Dict)
+                self.writeVdiSlot(offset, vdi_map)
+                index['free'].remove(offset)
                 updateLengthInHeader(self.fd, mdlength)
             else:
+                # If this has created a new VDI, update metadata length 
+                offset = mdlength
+                self.writeVdiSlot(offset, Dict)
                 updateLengthInHeader(self.fd, mdlength + \
                         SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS)
+                index['length'] = mdlength + \
+                        SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS
+            index['uuids'][Dict[UUID_TAG]] = offset
             return True
         except Exception, e:
             util.SMlog("Exception adding vdi with info: %s. Error: %s" % \
@@ -496,11 +540,7 @@ class MetadataHandler:
                 vdi_info = metadataxml[offset: 
                                 offset + 
                                 (SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS)]
-                vdi_info = vdi_info.replace('\x00','')
-                parsable_metadata = '%s<%s>%s</%s>' % (XML_HEADER, metadata.XML_TAG, 
-                                               vdi_info, metadata.XML_TAG)
-                vdi_info_map = metadata._parseXML(parsable_metadata)[VDI_TAG]
-                vdi_info_map[OFFSET_TAG] = offset
+                vdi_info_map = self.parseVdiInfo(vdi_info, offset)
                 
                 if not params.has_key('includeDeletedVdis') and \
                     vdi_info_map[VDI_DELETED_TAG] == '1':
@@ -538,6 +578,90 @@ class MetadataHandler:
                     "%s. Error: %s" % (params, str(e)))
             raise
 
+    def parseVdiInfo(self, vdi_info, offset):
+        vdi_info = vdi_info.replace('\x00','')
+        vdi_info_map = decodeVdiSlot(vdi_info)
+        if vdi_info_map is None:
+            parsable_metadata = '%s<%s>%s</%s>' % (XML_HEADER,
+                    metadata.XML_TAG, vdi_info, metadata.XML_TAG)
+            vdi_info_map = metadata._parseXML(parsable_metadata)[VDI_TAG]
+        vdi_info_map[OFFSET_TAG] = offset
+        return vdi_info_map
+
+    # Build the index of the VDI slots (see slotIndexes) from a full read of
+    # the metadata
+    def buildSlotIndex(self):
+        util.SMlog("Building VDI slot index for %s" % self.path)
+        md = self.getMetadataInternal({'includeDeletedVdis': 1})
+        index = {'length': getMetadataLength(self.fd), 'uuids': {}, 'free': []}
+        for offset in sorted(md['vdi_info'].keys()):
+            vdi_info_map = md['vdi_info'][offset]
+            if vdi_info_map[VDI_DELETED_TAG] == '1':
+                index['free'].append(offset)
+            else:
+                index['uuids'][vdi_info_map[UUID_TAG]] = offset
+        self.slotIndexes[self.path] = index
+        return index
+
+    # returns the slot index and whether it has just been built
+    def getSlotIndex(self):
+        index = self.slotIndexes.get(self.path)
+        if not index or index['length'] != getMetadataLength(self.fd):
+            return (self.buildSlotIndex(), True)
+        return (index, False)
+
+    # read and parse the VDI slot at offset only
+    def readVdiSlot(self, offset):
+        vdi_info = file_read_wrapper(self.fd, offset, \
+                SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS, \
+                get_min_blk_size_wrapper(self.fd))
+        return self.parseVdiInfo(vdi_info, offset)
+
+    # write the VDI slot at offset, along with whatever else shares its
+    # block aligned range
+    def writeVdiSlot(self, offset, vdi_map):
+        min_block_size = get_min_blk_size_wrapper(self.fd)
+        slot_size = SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS
+        (lower, upper) = getBlockAlignedRange(min_block_size, offset, slot_size)
+        value = self.getVdiInfo(vdi_map)
+        if (lower, upper) != (offset, offset + slot_size):
+            data = file_read_wrapper(self.fd, lower, upper - lower, \
+                    min_block_size).ljust(upper - lower)
+            value = data[:offset - lower] + value + \
+                    data[offset - lower + slot_size:]
+        file_write_wrapper(self.fd, lower, min_block_size, value, len(value))
+
+    # find the slot of a VDI using the slot index: returns the offset and
+    # the VDI info, or (None, None) if the VDI is not in the metadata
+    def findVdiSlot(self, vdi_uuid):
+        (index, fresh) = self.getSlotIndex()
+        while True:
+            offset = index['uuids'].get(vdi_uuid)
+            if offset is not None:
+                vdi_info_map = self.readVdiSlot(offset)
+                if vdi_info_map[UUID_TAG] == vdi_uuid and \
+                        vdi_info_map[VDI_DELETED_TAG] != '1':
+                    return (offset, vdi_info_map)
+            if fresh:
+                return (None, None)
+            # the index may be stale: rebuild it and retry
+            (index, fresh) = (self.buildSlotIndex(), True)
+
+    # find the first deleted slot using the slot index: returns its offset
+    # and VDI info, or (None, None) if there is none
+    def findFreeSlot(self):
+        (index, fresh) = self.getSlotIndex()
+        while index['free']:
+            offset = index['free'][0]
+            vdi_info_map = self.readVdiSlot(offset)
+            if vdi_info_map[VDI_DELETED_TAG] == '1':
+                return (offset, vdi_info_map)
+            if fresh:
+                break
+            # the index is stale: rebuild it and retry
+            (index, fresh) = (self.buildSlotIndex(), True)
+        return (None, None)
+
     # This function expects both sr name_label and sr name_description to be
     # passed in
     def updateSR(self, Dict):
@@ -587,13 +711,12 @@ class MetadataHandler:
     def updateVdi(self, Dict):
         util.SMlog('entering updateVdi')
         try:
-            value = ''
-            min_block_size = get_min_blk_size_wrapper(self.fd)
-            mdlength = getMetadataLength(self.fd)
-            md = self.getMetadataInternal({'vdi_uuid': Dict[UUID_TAG]})
-            value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, md['offset'])
-            file_write_wrapper(self.fd, md['lower'], min_block_size, value, len(value))
+            (offset, vdi_map) = self.findVdiSlot(Dict[UUID_TAG])
+            if offset is None:
+                raise Exception("VDI %s not found in the metadata" % \
+                        Dict[UUID_TAG])
+            vdi_map.update(Dict)
+            self.writeVdiSlot(offset, vdi_map)
             return True
         except Exception, e:
             util.SMlog("Exception updating vdi with info: %s. Error: %s" % \
@@ -616,6 +739,7 @@ class MetadataHandler:
             min_block_size = get_min_blk_size_wrapper(self.fd)
             file_write_wrapper(self.fd, 0, min_block_size, md, len(md))
             updateLengthInHeader(self.fd, len(md))
+            self.slotIndexes.pop(self.path, None)
            
         except Exception, e:
             util.SMlog("Exception writing metadata with info: %s, %s. "\
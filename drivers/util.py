@@ -34,6 +34,9 @@ import exceptions
 import traceback
 import glob
 import copy
+import threading
+import Queue
+import smtrace
 
 NO_LOGGING_STAMPFILE='/etc/xensource/no_sm_log'
 
@@ -57,6 +60,10 @@ CMD_DD = "/bin/dd"
 
 FIST_PAUSE_PERIOD = 30 # seconds
 
+# calls made to several hosts at once (see call_on_hosts)
+HOST_CALL_WORKERS = 8
+HOST_CALL_TIMEOUT = 300 # seconds
+
 class SMException(Exception):
     """Base class for all SM exceptions for easier catching & wrapping in 
     XenError"""
@@ -132,8 +139,12 @@ def _getDateString():
 
 def doexec(args, inputtext=None):
     """Execute a subprocess, then return its return code, stdout and stderr"""
-    proc = subprocess.Popen(args,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,close_fds=True)
-    (stdout,stderr) = proc.communicate(inputtext)
+    span = smtrace.Span(smtrace.TYPE_EXEC, os.path.basename(args[0]))
+    try:
+        proc = subprocess.Popen(args,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,close_fds=True)
+        (stdout,stderr) = proc.communicate(inputtext)
+    finally:
+        span.end()
     # Workaround for a pylint bug, can be removed after upgrade to
     # python 3.x or maybe a newer version of pylint in the future
     stdout = str(stdout)
@@ -577,7 +588,7 @@ def getrootdevID():
 
 def get_localAPI_session():
     # First acquire a valid session
-    session = XenAPI.xapi_local()
+    session = smtrace.traceSession(XenAPI.xapi_local())
     try:
         session.xenapi.login_with_password('root','')
     except:
@@ -664,6 +675,120 @@ def get_all_slaves(session):
     master_ref = get_this_host_ref(session)
     return filter(lambda x: x != master_ref, host_refs)
 
+def _thread_session(session):
+    """A new connection to xapi on the login of session, because a session
+    cannot be used by several threads at once"""
+    thread_session = smtrace.traceSession(XenAPI.xapi_local())
+    thread_session._session = session._session
+    return thread_session
+
+def run_parallel(func, items, workers, timeout = None):
+    """Call func(item) for each item in items, up to 'workers' at a time, in
+    threads. Return a dict item -> (True, return value) or (False,
+    exception). If timeout is given, a call that does not return within
+    timeout seconds fails with ETIMEDOUT (and is left to finish in the
+    background)"""
+    results = {}
+    if len(items) <= 1:
+        for item in items:
+            try:
+                results[item] = (True, func(item))
+            except Exception, e:
+                results[item] = (False, e)
+        return results
+
+    done = Queue.Queue()
+    def call(item):
+        try:
+            result = (True, func(item))
+        except Exception, e:
+            result = (False, e)
+        done.put((item, result))
+
+    pending = list(items)
+    deadlines = {}
+    while pending or deadlines:
+        while pending and len(deadlines) < workers:
+            item = pending.pop(0)
+            thread = threading.Thread(target = call, args = (item,))
+            thread.setDaemon(True)
+            thread.start()
+            deadlines[item] = time.time() + (timeout or 0)
+        try:
+            if timeout:
+                wait = max(min(deadlines.values()) - time.time(), 0)
+                item, result = done.get(True, wait)
+            else:
+                item, result = done.get()
+            if deadlines.has_key(item):
+                del deadlines[item]
+                results[item] = result
+        except Queue.Empty:
+            now = time.time()
+            for item, deadline in deadlines.items():
+                if deadline <= now:
+                    SMlog("Call for %s timed out" % str(item))
+                    del deadlines[item]
+                    results[item] = (False, CommandException(
+                        errno.ETIMEDOUT, "call for %s" % str(item),
+                        "timed out after %ds" % timeout))
+    return results
+
+def run_parallel_first(func, items, workers):
+    """Call func(item) for each item in items, up to 'workers' at a time, in
+    threads, and return the first item (in the order of items) for which 
+    func did not raise, as soon as the calls for it and the items before it
+    are done, or None if func raised for all of them. Calls still running
+    then are left to finish in the background"""
+    done = Queue.Queue()
+    def call(item):
+        try:
+            func(item)
+            done.put((item, True))
+        except Exception:
+            done.put((item, False))
+
+    results = {}
+    pending = list(items)
+    running = 0
+    for item in items:
+        while not results.has_key(item):
+            while pending and running < workers:
+                thread = threading.Thread(target = call,
+                        args = (pending.pop(0),))
+                thread.setDaemon(True)
+                thread.start()
+                running += 1
+            doneItem, ok = done.get()
+            running -= 1
+            results[doneItem] = ok
+        if results[item]:
+            return item
+    return None
+
+def call_on_hosts(session, host_refs, func, timeout = HOST_CALL_TIMEOUT,
+        workers = HOST_CALL_WORKERS):
+    """Call func(session, host_ref) for each host in host_refs, up to
+    'workers' hosts at a time, so that the calls take about as long as the
+    slowest of them rather than all of them together. Return a dict
+    host_ref -> (True, return value) or (False, exception). A call that does
+    not return within 'timeout' seconds fails with ETIMEDOUT (and is left
+    to finish in the background)"""
+    if len(host_refs) <= 1:
+        return run_parallel(lambda host_ref: func(session, host_ref),
+                host_refs, 1)
+    return run_parallel(
+            lambda host_ref: func(_thread_session(session), host_ref),
+            host_refs, workers, timeout)
+
+def check_host_results(results, ignore_hosts = []):
+    """Raise the exception of the first (in host ref order) failed call in
+    the results of call_on_hosts, ignoring the hosts in ignore_hosts"""
+    for host_ref in sorted(results.keys()):
+        ok, result = results[host_ref]
+        if not ok and host_ref not in ignore_hosts:
+            raise result
+
 def get_nfs_timeout(session, sr_uuid):
     if not isinstance(session, XenAPI.Session):
         SMlog("No XAPI session for getting nfs timeout config")
@@ -719,66 +844,93 @@ def find_my_pbd(session, host_ref, sr_ref):
     else:
         return None
 
-def test_hostPBD_devs(session, sr_uuid, devs):
-    host = get_localhost_uuid(session)
-    sr = session.xenapi.SR.get_by_uuid(sr_uuid)
-    try:
-        pbds = session.xenapi.PBD.get_all_records()
-    except:
-        raise xs_errors.XenError('APIPBDQuery')
-    for dev in devs.split(','):
-        for pbd in pbds:
-            record = pbds[pbd]
-            # it's ok if it's *our* PBD
-            if record["SR"] == sr:
-                break
-            if record["host"] == host:
-                devconfig = record["device_config"]
-                if devconfig.has_key('device'):
-                    for device in devconfig['device'].split(','):
-                        if os.path.realpath(device) == os.path.realpath(dev):
-                            return True;
-    return False
+class PBDIndex:
+    """The device_config of every PBD in the pool and the sm_config of their
+    SRs, fetched with one call each the first time they are needed, for
+    checking many devices against the SRs that use them"""
 
-def test_hostPBD_lun(session, targetIQN, LUNid):
-    host = get_localhost_uuid(session)
-    try:
-        pbds = session.xenapi.PBD.get_all_records()
-    except:
-        raise xs_errors.XenError('APIPBDQuery')
-    for pbd in pbds:
-        record = pbds[pbd]
-        if record["host"] == host:
+    def __init__(self, session):
+        self.session = session
+        self.pbds = None
+        self.SCSIids = {}
+
+    def _load(self):
+        if self.pbds != None:
+            return
+        try:
+            pbds = self.session.xenapi.PBD.get_all_records()
+            srs = self.session.xenapi.SR.get_all_records()
+        except:
+            raise xs_errors.XenError('APIPBDQuery')
+        for record in pbds.values():
+            sr = record["SR"]
+            ids = []
+            if record["device_config"].has_key('SCSIid'):
+                ids.append(record["device_config"]['SCSIid'])
+            if srs.has_key(sr):
+                sm_config = srs[sr]["sm_config"]
+                if sm_config.has_key('SCSIid'):
+                    ids.append(sm_config['SCSIid'])
+                for key in sm_config:
+                    if key.startswith('scsi-'):
+                        ids.append(key[len('scsi-'):])
+            for SCSIid in ids:
+                self.SCSIids.setdefault(SCSIid, set()).add(sr)
+        self.pbds = pbds
+
+    def SCSIid_in_use(self, SCSIid, sr = None):
+        """Whether an SR other than sr uses SCSIid"""
+        self._load()
+        return bool(self.SCSIids.get(SCSIid, set()) - set([sr]))
+
+    def devs_in_use(self, host, devs, sr = None):
+        """Whether an SR other than sr uses one of devs on host"""
+        self._load()
+        paths = set([os.path.realpath(dev) for dev in devs])
+        for record in self.pbds.values():
+            if record["SR"] == sr or record["host"] != host:
+                continue
             devconfig = record["device_config"]
-            if devconfig.has_key('targetIQN') and devconfig.has_key('LUNid'):
-                if devconfig['targetIQN'] == targetIQN and \
-                       devconfig['LUNid'] == LUNid:
-                    return True;
-    return False
+            if devconfig.has_key('device'):
+                for device in devconfig['device'].split(','):
+                    if os.path.realpath(device) in paths:
+                        return True
+        return False
 
-def test_SCSIid(session, sr_uuid, SCSIid):
+    def lun_in_use(self, host, targetIQN, LUNid):
+        """Whether an SR uses the LUN LUNid of targetIQN on host"""
+        self._load()
+        for record in self.pbds.values():
+            devconfig = record["device_config"]
+            if record["host"] == host and \
+                    devconfig.get('targetIQN') == targetIQN and \
+                    devconfig.get('LUNid') == LUNid:
+                return True
+        return False
+
+def test_hostPBD_devs(session, sr_uuid, devs, index = None):
+    if index == None:
+        index = PBDIndex(session)
+    host = get_this_host_ref(session)
+    sr = session.xenapi.SR.get_by_uuid(sr_uuid)
+    return index.devs_in_use(host, devs.split(','), sr)
+
+def test_hostPBD_lun(session, targetIQN, LUNid, index = None):
+    if index == None:
+        index = PBDIndex(session)
+    host = get_this_host_ref(session)
+    return index.lun_in_use(host, targetIQN, LUNid)
+
+def test_SCSIid(session, sr_uuid, SCSIid, index = None):
+    """Whether an SR other than sr_uuid uses SCSIid. Pass the same PBDIndex
+    to test many SCSIids against one fetch of the PBD and SR records"""
+    if index == None:
+        index = PBDIndex(session)
+    sr = None
+    # During FC SR creation, devscan.py passes sr_uuid as None
     if sr_uuid != None:
         sr = session.xenapi.SR.get_by_uuid(sr_uuid)
-    try:
-        pbds = session.xenapi.PBD.get_all_records()
-    except:
-        raise xs_errors.XenError('APIPBDQuery')
-    for pbd in pbds:
-        record = pbds[pbd]
-        # it's ok if it's *our* PBD
-        # During FC SR creation, devscan.py passes sr_uuid as None
-        if sr_uuid != None:
-            if record["SR"] == sr:
-                break
-        devconfig = record["device_config"]
-        sm_config = session.xenapi.SR.get_sm_config(record["SR"])
-        if devconfig.has_key('SCSIid') and devconfig['SCSIid'] == SCSIid:
-                    return True;
-        elif sm_config.has_key('SCSIid') and sm_config['SCSIid'] == SCSIid:
-                    return True;
-        elif sm_config.has_key('scsi-' + SCSIid):
-                    return True;
-    return False
+    return index.SCSIid_in_use(SCSIid, sr)
 
 
 class TimeoutException(SMException):
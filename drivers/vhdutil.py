@@ -20,10 +20,15 @@
 
 
 import os
+import io
+import sys
 import util
 import errno
 import zlib
 import re
+import mmap
+import array
+import struct
 
 
 MAX_VHD_JOURNAL_SIZE = 6 * 1024 * 1024 # 2MB VHD block size, max 2TB VHD size
@@ -32,6 +37,9 @@ VHD_UTIL = "/usr/bin/vhd-util"
 OPT_LOG_ERR = "--debug"
 VHD_BLOCK_SIZE = 2 * 1024 * 1024
 VHD_FOOTER_SIZE = 512
+VHD_HEADER_SIZE = 1024
+VHD_SECTOR_SIZE = 512
+VHD_BLK_UNUSED = 0xFFFFFFFF
  
 # lock to lock the entire SR for short ops
 LOCK_TYPE_SR = "sr"
@@ -46,6 +54,40 @@ FILE_EXTN = {
         VDI_TYPE_RAW: FILE_EXTN_RAW
 }
 
+# Paths of VHDs whose metadata was modified through this module, for the 
+# benefit of scanners that cache VHD metadata (see getMutations). The first 
+# line of the log is a generation ID that changes whenever the log is 
+# recreated.
+MUTATION_LOG = "/var/run/sm/vhd-mutations"
+MUTATION_LOG_MAX_SIZE = 1024 * 1024
+
+
+VHD_COOKIE_FOOTER = "conectix"
+VHD_COOKIE_HEADER = "cxsparse"
+VHD_COOKIE_BATMAP = "tdbatmap"
+VHD_DISK_TYPE_FIXED = 2
+VHD_DISK_TYPE_DYNAMIC = 3
+VHD_DISK_TYPE_DIFF = 4
+VHD_PLAT_CODE_MACX = 0x4D616358
+VHD_PLAT_CODE_W2KU = 0x57326B75
+VHD_PLAT_CODE_W2RU = 0x57327275
+# blktap versions that kept the hidden flag in the backup footer only
+_HIDDEN_IN_BACKUP_FOOTER_VERSIONS = [0x00000001, 0x00010001]
+
+# on-disk layouts (big-endian) of the footer (up to the "hidden" field, which 
+# is a blktap extension), the dynamic disk header (up to the parent 
+# locators), a parent locator entry, and the batmap header
+_FOOTER_FORMAT = ">8sIIQI4sIIQQIII16sBB"
+_HEADER_FORMAT = ">8sQQIIII16sI4s512s"
+_LOCATOR_FORMAT = ">IIIIQ"
+_BATMAP_HEADER_FORMAT = ">8sQI"
+_FOOTER_CHECKSUM_OFFSET = 64
+_HEADER_CHECKSUM_OFFSET = 36
+_NUM_LOCATORS = 8
+
+# alignment for O_DIRECT reads
+_DIRECT_IO_ALIGN = 4096
+
 
 class VHDInfo:
     uuid = ""
@@ -61,6 +103,296 @@ class VHDInfo:
         self.uuid = uuid
 
 
+class VHDFormatError(util.SMException):
+    pass
+
+
+class VHDMetadata:
+    """The footer, header and BAT of a VHD, read directly from the VHD file 
+    or (active) LV. This answers the read-only vhd-util queries without 
+    forking vhd-util. Like vhd-util, the VHD is read with O_DIRECT where 
+    possible, so that we do not see stale cached data for LVs written to from
+    other hosts"""
+
+    def __init__(self, path):
+        self.path = path
+        self._bat = None
+        self._fd = _openDirect(path)
+        try:
+            self._readFooter()
+            self.header = None
+            if self.isDynamic():
+                self._readHeader()
+                self._bat = self._readBAT()
+                self._batmapEnd = self._readBatmapEnd()
+                self._readHiddenFromBackupFooter()
+                self.parentLocations = []
+                if self.diskType == VHD_DISK_TYPE_DIFF:
+                    self.parentLocations = self._readParentLocations()
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def isDynamic(self):
+        return self.diskType in [VHD_DISK_TYPE_DYNAMIC, VHD_DISK_TYPE_DIFF]
+
+    def getSizeVirt(self):
+        """The virtual size, in whole MBs as reported by vhd-util"""
+        return (self.currSize >> 20) << 20
+
+    def getSizePhys(self):
+        """The physical utilisation (the end of data plus the footer), as
+        reported by "vhd-util query -s" """
+        return self._endOfData() + VHD_FOOTER_SIZE
+
+    def getParentPath(self):
+        """The parent path, resolved from the parent locators like vhd-util
+        does: the first location that exists, relative ones being relative
+        to the child's directory. If none exists, the first location, so that
+        the caller can tell the parent is missing; if there is no usable
+        locator, the parent name in the header. None if the VHD has no
+        parent"""
+        if self.diskType != VHD_DISK_TYPE_DIFF:
+            return None
+        paths = []
+        for location in self.parentLocations:
+            paths.append(os.path.normpath(os.path.join(
+                    os.path.dirname(self.path), location)))
+        for path in paths:
+            if os.path.exists(path):
+                return path
+        if paths:
+            return paths[0]
+        return os.path.join(os.path.dirname(self.path), self.parentName)
+
+    def getBlockBitmap(self):
+        """The allocated-block bitmap, as output by "vhd-util read -B": one 
+        bit per block, least significant bit first"""
+        if not self.isDynamic():
+            raise VHDFormatError("%s: not a dynamic VHD" % self.path)
+        numBlocks = self.currSize / self.blockSize
+        bitmap = array.array('B', '\0' * ((numBlocks + 7) >> 3))
+        bat = self._bat
+        for i in xrange(min(numBlocks, len(bat))):
+            if bat[i] != VHD_BLK_UNUSED:
+                bitmap[i >> 3] |= 1 << (i & 7)
+        return bitmap.tostring()
+
+    def getInfo(self, extractUuidFunction, includeParent = True):
+        vhdInfo = VHDInfo(extractUuidFunction(self.path))
+        vhdInfo.path = self.path
+        vhdInfo.sizeVirt = self.getSizeVirt()
+        vhdInfo.sizePhys = self.getSizePhys()
+        vhdInfo.hidden = self.hidden
+        if includeParent:
+            parentPath = self.getParentPath()
+            if parentPath:
+                vhdInfo.parentPath = parentPath
+                vhdInfo.parentUuid = extractUuidFunction(parentPath)
+        return vhdInfo
+
+    def _readFooter(self):
+        end = os.lseek(self._fd, 0, 2)
+        self.end = end
+        footer = None
+        # like vhd-util, fall back to the backup footer at the start of the 
+        # VHD if the primary one is invalid
+        for offset in [end - VHD_FOOTER_SIZE, 0]:
+            if offset < 0:
+                continue
+            footer = self._readFooterAt(offset)
+            if footer:
+                break
+        if not footer:
+            raise VHDFormatError("%s: no valid VHD footer" % self.path)
+        fields = struct.unpack(_FOOTER_FORMAT,
+                footer[:struct.calcsize(_FOOTER_FORMAT)])
+        self.dataOffset = fields[3]
+        self.creatorApp = fields[5]
+        self.creatorVersion = fields[6]
+        self.currSize = fields[9]
+        self.diskType = fields[11]
+        self.hidden = fields[15]
+
+    def _readFooterAt(self, offset):
+        """The footer at 'offset', or None if there is no valid one there"""
+        buf = _readDirect(self._fd, offset, VHD_FOOTER_SIZE)
+        if buf.startswith(VHD_COOKIE_FOOTER) and \
+                _checksumOK(buf, _FOOTER_CHECKSUM_OFFSET):
+            return buf
+        return None
+
+    def _readHiddenFromBackupFooter(self):
+        """Some blktap versions only updated the hidden flag in the backup 
+        footer at the start of the VHD, which libvhd (vhd_hidden) therefore
+        reads it from for the VHDs they created"""
+        if not self.creatorApp.startswith("tap") or \
+                self.creatorVersion not in _HIDDEN_IN_BACKUP_FOOTER_VERSIONS:
+            return
+        footer = self._readFooterAt(0)
+        if not footer:
+            raise VHDFormatError("%s: no valid backup footer" % self.path)
+        fields = struct.unpack(_FOOTER_FORMAT,
+                footer[:struct.calcsize(_FOOTER_FORMAT)])
+        self.hidden = fields[15]
+
+    def _readParentLocations(self):
+        """The parent locations stored by the parent locators that vhd-util 
+        understands, in locator order"""
+        locations = []
+        for code, dataSpace, dataLen, reserved, dataOffset in self.locators:
+            if code not in [VHD_PLAT_CODE_MACX, VHD_PLAT_CODE_W2KU,
+                    VHD_PLAT_CODE_W2RU] or not dataLen:
+                continue
+            data = _readDirect(self._fd, dataOffset, dataLen)
+            try:
+                if code == VHD_PLAT_CODE_MACX:
+                    location = data.decode("utf-8")
+                    if not location.startswith(u"file://"):
+                        continue
+                    location = location[len(u"file://"):]
+                else:
+                    location = data.decode("utf-16-le")
+                    if location[:2].lower() == u"c:":
+                        location = location[2:]
+                    location = location.replace(u"\\", u"/")
+            except UnicodeError:
+                continue
+            location = location.split(u"\0")[0].encode("utf-8")
+            if location:
+                locations.append(location)
+        return locations
+
+    def _readHeader(self):
+        header = _readDirect(self._fd, self.dataOffset, VHD_HEADER_SIZE)
+        if not header.startswith(VHD_COOKIE_HEADER) or \
+                not _checksumOK(header, _HEADER_CHECKSUM_OFFSET):
+            raise VHDFormatError("%s: invalid VHD header" % self.path)
+        hdrLen = struct.calcsize(_HEADER_FORMAT)
+        fields = struct.unpack(_HEADER_FORMAT, header[:hdrLen])
+        self.tableOffset = fields[2]
+        self.maxBatSize = fields[4]
+        self.blockSize = fields[5]
+        if not self.blockSize or self.blockSize % VHD_SECTOR_SIZE:
+            raise VHDFormatError("%s: invalid block size" % self.path)
+        self.parentName = fields[10].decode("utf-16-be").split(u"\0")[0]. \
+                encode("utf-8")
+        locLen = struct.calcsize(_LOCATOR_FORMAT)
+        self.locators = []
+        for i in range(_NUM_LOCATORS):
+            start = hdrLen + i * locLen
+            loc = struct.unpack(_LOCATOR_FORMAT, header[start:start + locLen])
+            if loc[0]:
+                self.locators.append(loc)
+
+    def _readBAT(self):
+        data = _readDirect(self._fd, self.tableOffset, self.maxBatSize * 4)
+        bat = array.array('I', data)
+        if sys.byteorder == "little":
+            bat.byteswap()
+        return bat
+
+    def _batEnd(self):
+        return self.tableOffset + util.roundup(VHD_SECTOR_SIZE,
+                self.maxBatSize * 4)
+
+    def _readBatmapEnd(self):
+        """The end of the batmap (a blktap extension following the BAT), or
+        0 if there is none"""
+        if self.creatorApp != "tap\0":
+            return 0
+        hdrLen = struct.calcsize(_BATMAP_HEADER_FORMAT)
+        buf = _readDirect(self._fd, self._batEnd(), hdrLen)
+        cookie, offset, numSectors = struct.unpack(_BATMAP_HEADER_FORMAT, buf)
+        if cookie != VHD_COOKIE_BATMAP:
+            return 0
+        return max(self._batEnd() + VHD_SECTOR_SIZE,
+                offset + numSectors * VHD_SECTOR_SIZE)
+
+    def _endOfData(self):
+        if not self.isDynamic():
+            return self.end - VHD_FOOTER_SIZE
+        end = max(self.dataOffset + VHD_HEADER_SIZE, self._batEnd(),
+                self._batmapEnd)
+        for code, dataSpace, dataLen, reserved, dataOffset in self.locators:
+            # MICROSOFT_COMPAT: data_space is supposed to be in sectors, 
+            # but is sometimes in bytes
+            if dataSpace < VHD_SECTOR_SIZE:
+                dataSpace *= VHD_SECTOR_SIZE
+            elif dataSpace % VHD_SECTOR_SIZE:
+                dataSpace = 0
+            end = max(end, dataOffset + dataSpace)
+        sectorsPerBlock = self.blockSize / VHD_SECTOR_SIZE
+        bitmapSectors = util.roundup(VHD_SECTOR_SIZE, sectorsPerBlock / 8) / \
+                VHD_SECTOR_SIZE
+        endSector = end / VHD_SECTOR_SIZE
+        lastBlock = max([-1] + [x for x in self._bat if x != VHD_BLK_UNUSED])
+        if lastBlock >= 0:
+            endSector = max(endSector,
+                    lastBlock + bitmapSectors + sectorsPerBlock)
+        return endSector * VHD_SECTOR_SIZE
+
+
+def _openDirect(path):
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError, e:
+        if e.errno != errno.EINVAL:
+            raise
+        # the file system does not support O_DIRECT
+        return os.open(path, os.O_RDONLY)
+
+def _readDirect(fd, offset, length):
+    """Read 'length' bytes at 'offset' using an aligned buffer and aligned 
+    offsets, as required for O_DIRECT"""
+    start = offset - offset % _DIRECT_IO_ALIGN
+    size = util.roundup(_DIRECT_IO_ALIGN, offset + length - start)
+    buf = mmap.mmap(-1, size)
+    try:
+        f = io.FileIO(fd, 'r', closefd = False)
+        os.lseek(fd, start, 0)
+        # O_DIRECT reads only return short at the end of the file/device
+        done = f.readinto(buf)
+        if done < offset - start + length:
+            raise VHDFormatError("short read at %d" % offset)
+        return buf[offset - start:offset - start + length]
+    finally:
+        buf.close()
+
+def _checksumOK(buf, checksumOffset):
+    """VHD checksums are the one's complement of the byte sum of the 
+    structure, excluding the checksum field itself"""
+    data = buf[:checksumOffset] + buf[checksumOffset + 4:]
+    (checksum,) = struct.unpack(">I", buf[checksumOffset:checksumOffset + 4])
+    return checksum == (~sum(array.array('B', data)) & 0xFFFFFFFF)
+
+def _readMetadata(path):
+    """Return the VHDMetadata of 'path', or None if it cannot be read here, in
+    which case the caller falls back to vhd-util"""
+    try:
+        return VHDMetadata(path)
+    except (IOError, OSError, struct.error, VHDFormatError), e:
+        util.SMlog("Cannot read VHD %s directly (%s), using %s" % \
+                (path, e, VHD_UTIL))
+        return None
+
+def readVHDInfos(paths, extractUuidFunction, includeParent = True):
+    """Get the VHD info for each path in 'paths' without forking vhd-util. 
+    Return a dict uuid -> VHDInfo, as getAllVHDs does: VHDs that could not
+    be read have their 'error' field set"""
+    vhds = dict()
+    for path in paths:
+        uuid = extractUuidFunction(path)
+        vhd = _readMetadata(path)
+        if vhd:
+            vhds[uuid] = vhd.getInfo(extractUuidFunction, includeParent)
+        else:
+            vhdInfo = VHDInfo(uuid)
+            vhdInfo.path = path
+            vhdInfo.error = "failed to read %s" % path
+            vhds[uuid] = vhdInfo
+    return vhds
+
 def calcOverheadEmpty(virtual_size):
     """Calculate the VHD space overhead (metadata size) for an empty VDI of
     size virtual_size"""
@@ -98,10 +430,92 @@ def ioretry(cmd):
     return util.ioretry(lambda: util.pread2(cmd),
             errlist = [errno.EIO, errno.EAGAIN])
 
+def _openMutationLog():
+    logDir = os.path.dirname(MUTATION_LOG)
+    if not os.path.isdir(logDir):
+        try:
+            os.makedirs(logDir)
+        except OSError:
+            pass
+    try:
+        fd = os.open(MUTATION_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT | \
+                os.O_EXCL)
+        os.write(fd, "%s\n" % util.gen_uuid())
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+        fd = os.open(MUTATION_LOG, os.O_WRONLY | os.O_APPEND)
+    return fd
+
+def _logMutation(path):
+    """Record that the metadata of the VHD at 'path' may have changed. If the
+    record cannot be written, remove the log so that readers do not trust 
+    it"""
+    try:
+        try:
+            if os.path.getsize(MUTATION_LOG) > MUTATION_LOG_MAX_SIZE:
+                os.unlink(MUTATION_LOG)
+        except OSError:
+            pass
+        fd = _openMutationLog()
+        try:
+            os.write(fd, "%s\n" % path)
+        finally:
+            os.close(fd)
+    except (IOError, OSError), e:
+        util.SMlog("Failed to log VHD mutation of %s: %s" % (path, e))
+        try:
+            os.unlink(MUTATION_LOG)
+        except OSError:
+            pass
+
+def _mutate(path, cmd):
+    """Run a vhd-util command that modifies the VHD at 'path'. The mutation is
+    logged after the command completes, even if it failed part way"""
+    try:
+        return ioretry(cmd)
+    finally:
+        _logMutation(path)
+
+def getMutations(marker):
+    """Get the paths of the VHDs modified since 'marker' was returned by a
+    previous call. Return (newMarker, paths), where paths is None if the 
+    modifications since 'marker' cannot be determined (e.g. because the log 
+    was recreated in the meantime), in which case any VHD may have changed"""
+    try:
+        f = open(MUTATION_LOG, 'r')
+    except IOError:
+        return (None, None)
+    try:
+        generation = f.readline()
+        if not generation.endswith('\n'):
+            return (None, None)
+        generation = generation.strip()
+        start = len(generation) + 1
+        if marker and marker[0] == generation:
+            start = marker[1]
+        f.seek(start)
+        text = f.read()
+    finally:
+        f.close()
+    # ignore a partially-written last record
+    end = text.rfind('\n') + 1
+    newMarker = (generation, start + end)
+    if not marker or marker[0] != generation:
+        return (newMarker, None)
+    paths = set(filter(None, text[:end].split('\n')))
+    return (newMarker, paths)
+
 def getVHDInfo(path, extractUuidFunction, includeParent = True):
     """Get the VHD info. The parent info may optionally be omitted: vhd-util
     tries to verify the parent by opening it, which results in error if the VHD
     resides on an inactive LV"""
+    vhd = _readMetadata(path)
+    if vhd:
+        parentPath = vhd.getParentPath()
+        if not includeParent or not parentPath or \
+                os.path.exists(parentPath):
+            return vhd.getInfo(extractUuidFunction, includeParent)
     opts = "-vsf"
     if includeParent:
         opts += "p"
@@ -157,6 +571,13 @@ def getParentChain(lvName, extractUuidFunction, vgName):
     return chain
 
 def getParent(path, extractUuidFunction):
+    vhd = _readMetadata(path)
+    if vhd:
+        parentPath = vhd.getParentPath()
+        if not parentPath:
+            return None
+        if os.path.exists(parentPath):
+            return extractUuidFunction(parentPath)
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     if ret.find("query failed") != -1 or ret.find("Failed opening") != -1:
@@ -169,6 +590,9 @@ def hasParent(path):
     """Check if the VHD has a parent. A VHD has a parent iff its type is
     'Differencing'. This function does not need the parent to actually
     be present (e.g. the parent LV to be activated)."""
+    vhd = _readMetadata(path)
+    if vhd and vhd.isDynamic():
+        return vhd.diskType == VHD_DISK_TYPE_DIFF
     cmd = [VHD_UTIL, "read", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     m = re.match(".*Disk type\s+: (\S+) hard disk.*", ret, flags = re.S)
@@ -181,9 +605,12 @@ def setParent(path, parentPath, parentRaw):
     cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-p", normpath, "-n", path]
     if parentRaw:
         cmd.append("-m")
-    ioretry(cmd)
+    _mutate(path, cmd)
 
 def getHidden(path):
+    vhd = _readMetadata(path)
+    if vhd:
+        return vhd.hidden
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-f", "-n", path]
     ret = ioretry(cmd)
     hidden = int(ret.split(':')[-1].strip())
@@ -194,9 +621,12 @@ def setHidden(path, hidden = True):
     if not hidden:
         opt = "0"
     cmd = [VHD_UTIL, "set", OPT_LOG_ERR, "-n", path, "-f", "hidden", "-v", opt]
-    ret = ioretry(cmd)
+    _mutate(path, cmd)
 
 def getSizeVirt(path):
+    vhd = _readMetadata(path)
+    if vhd:
+        return vhd.getSizeVirt()
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-v", "-n", path]
     ret = ioretry(cmd)
     size = long(ret) * 1024 * 1024
@@ -207,13 +637,13 @@ def setSizeVirt(path, size, jFile):
     size_mb = size / 1024 /1024
     cmd = [VHD_UTIL, "resize", OPT_LOG_ERR, "-s", str(size_mb), "-n", path,
             "-j", jFile]
-    ioretry(cmd)
+    _mutate(path, cmd)
 
 def setSizeVirtFast(path, size):
     "resize VHD online"
     size_mb = size / 1024 /1024
     cmd = [VHD_UTIL, "resize", OPT_LOG_ERR, "-s", str(size_mb), "-n", path, "-f"]
-    ioretry(cmd)
+    _mutate(path, cmd)
 
 def getMaxResizeSize(path):
     """get the max virtual size for fast resize"""
@@ -222,6 +652,9 @@ def getMaxResizeSize(path):
     return int(ret)
 
 def getSizePhys(path):
+    vhd = _readMetadata(path)
+    if vhd:
+        return vhd.getSizePhys()
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-s", "-n", path]
     ret = ioretry(cmd)
     return int(ret)
@@ -232,15 +665,18 @@ def setSizePhys(path, size, debug = True):
         cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-s", str(size), "-n", path]
     else:
         cmd = [VHD_UTIL, "modify", "-s", str(size), "-n", path]
-    ioretry(cmd)
+    _mutate(path, cmd)
 
 def killData(path):
     "zero out the disk (kill all data inside the VHD file)"
     cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-z", "-n", path]
-    ioretry(cmd)
+    _mutate(path, cmd)
 
 def getDepth(path):
     "get the VHD parent chain depth"
+    depth = _getDepth(path)
+    if depth:
+        return depth
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-d", "-n", path]
     text = ioretry(cmd)
     depth = -1
@@ -248,14 +684,31 @@ def getDepth(path):
         depth = int(text.split(':')[1].strip())
     return depth
 
+def _getDepth(path):
+    """Walk the parent chain without vhd-util. Return None if any VHD in the 
+    chain cannot be read here"""
+    depth = 0
+    while path:
+        if not os.path.exists(path):
+            return None
+        vhd = _readMetadata(path)
+        if not vhd:
+            return None
+        depth += 1
+        path = vhd.getParentPath()
+    return depth
+
 def getBlockBitmap(path):
+    vhd = _readMetadata(path)
+    if vhd and vhd.isDynamic():
+        return zlib.compress(vhd.getBlockBitmap())
     cmd = [VHD_UTIL, "read", OPT_LOG_ERR, "-B", "-n", path]
     text = ioretry(cmd)
     return zlib.compress(text)
 
 def coalesce(path):
     cmd = [VHD_UTIL, "coalesce", OPT_LOG_ERR, "-n", path]
-    ioretry(cmd)
+    _mutate(path, cmd)
 
 def create(path, size, static, msize = 0):
     size_mb = size / 1024 /1024
@@ -265,7 +718,7 @@ def create(path, size, static, msize = 0):
     if msize:
         cmd.append("-S")
         cmd.append(str(msize))
-    ioretry(cmd)
+    _mutate(path, cmd)
 
 def snapshot(path, parent, parentRaw, msize = 0, checkEmpty = True):
     cmd = [VHD_UTIL, "snapshot", OPT_LOG_ERR, "-n", path, "-p", parent]
@@ -276,7 +729,7 @@ def snapshot(path, parent, parentRaw, msize = 0, checkEmpty = True):
         cmd.append(str(msize))
     if not checkEmpty:
         cmd.append("-e")
-    text = ioretry(cmd)
+    _mutate(path, cmd)
 
 def check(path, ignoreMissingFooter = False, fast = False):
     cmd = [VHD_UTIL, "check", OPT_LOG_ERR, "-n", path]
@@ -292,7 +745,7 @@ def check(path, ignoreMissingFooter = False, fast = False):
 
 def revert(path, jFile):
     cmd = [VHD_UTIL, "revert", OPT_LOG_ERR, "-n", path, "-j", jFile]
-    ioretry(cmd)
+    _mutate(path, cmd)
 
 def _parseVHDInfo(line, extractUuidFunction):
     vhdInfo = None
@@ -337,5 +790,5 @@ def _getVHDParentNoCheck(path):
     return None
 def repair(path):
     """Repairs the VHD."""
-    ioretry([VHD_UTIL, 'repair', '-n', path])
+    _mutate(path, [VHD_UTIL, 'repair', '-n', path])
 
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Compare the VHD block bitmap operations of cleanup.Bitmap with the
+# byte-by-byte implementation they replaced, on bitmaps of realistic VHD
+# sizes. Run from the top of the tree:
+#
+#   PYTHONPATH=drivers python tests/bitmap_benchmark.py [iterations]
+
+import sys
+import random
+import time
+
+import cleanup
+import vhdutil
+
+GiB = 1024 * 1024 * 1024
+SIZES = [10 * GiB, 100 * GiB, 500 * GiB, 2048 * GiB]
+FILL = [0.1, 0.5, 0.9]
+
+
+def numBitsOld(val):
+    count = 0
+    while val:
+        count += val & 1
+        val = val >> 1
+    return count
+
+
+def countBitsOld(bitmap1, bitmap2):
+    len1 = len(bitmap1)
+    len2 = len(bitmap2)
+    lenLong = len1
+    lenShort = len2
+    bitmapLong = bitmap1
+    if len2 > len1:
+        lenLong = len2
+        lenShort = len1
+        bitmapLong = bitmap2
+
+    count = 0
+    for i in range(lenShort):
+        val = ord(bitmap1[i]) | ord(bitmap2[i])
+        count += numBitsOld(val)
+
+    for i in range(i + 1, lenLong):
+        val = ord(bitmapLong[i])
+        count += numBitsOld(val)
+    return count
+
+
+def countBitsNew(bitmap1, bitmap2):
+    return (cleanup.Bitmap(bitmap1) | bitmap2).count()
+
+
+def makeBitmap(size, fill):
+    numBlocks = size / vhdutil.VHD_BLOCK_SIZE
+    bits = bytearray(numBlocks / 8)
+    for i in random.sample(xrange(numBlocks), int(numBlocks * fill)):
+        bits[i / 8] |= 1 << (i % 8)
+    return str(bits)
+
+
+def timeIt(func, iterations):
+    start = time.time()
+    for i in range(iterations):
+        result = func()
+    return result, (time.time() - start) / iterations
+
+
+def main():
+    iterations = 3
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    random.seed(0)
+    print "%8s %5s %12s %12s %8s" % ("size", "fill", "old (s)", "new (s)",
+            "speedup")
+    for size in SIZES:
+        for fill in FILL:
+            child = makeBitmap(size, fill)
+            parent = makeBitmap(size, fill)
+            old, tOld = timeIt(lambda: countBitsOld(child, parent),
+                    iterations)
+            new, tNew = timeIt(lambda: countBitsNew(child, parent),
+                    iterations)
+            if old != new:
+                print "MISMATCH: %d != %d" % (old, new)
+                sys.exit(1)
+            print "%7dG %5.1f %12.6f %12.6f %7.0fx" % (size / GiB, fill,
+                    tOld, tNew, tOld / max(tNew, 1e-9))
+
+
+if __name__ == "__main__":
+    main()
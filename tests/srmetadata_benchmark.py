@@ -0,0 +1,81 @@
+#!/usr/bin/python
+#
+# Compare the time to read the SR metadata (the VDI slots of the metadata
+# volume) with decodeVdiSlot against the DOM parser it replaced, for SRs of
+# increasing size. Run from the top of the tree:
+#
+#   PYTHONPATH=drivers python tests/srmetadata_benchmark.py [iterations]
+
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+import util
+import srmetadata
+
+COUNTS = [100, 1000, 5000]
+
+
+def vdiInfo(i):
+    return {srmetadata.UUID_TAG: 'c0f8a6e2-8a5f-4b8d-9e6a-%012d' % i,
+            srmetadata.NAME_LABEL_TAG: 'VM %d disk & data' % i,
+            srmetadata.NAME_DESCRIPTION_TAG: 'created by <benchmark>',
+            srmetadata.IS_A_SNAPSHOT_TAG: '0',
+            srmetadata.SNAPSHOT_OF_TAG: '',
+            srmetadata.SNAPSHOT_TIME_TAG: '',
+            srmetadata.TYPE_TAG: 'user',
+            srmetadata.VDI_TYPE_TAG: 'vhd',
+            srmetadata.READ_ONLY_TAG: '0',
+            srmetadata.MANAGED_TAG: '1',
+            srmetadata.METADATA_OF_POOL_TAG: ''}
+
+
+def writeMetadata(path, count):
+    open(path, 'w').close()
+    srInfo = {srmetadata.UUID_TAG: 'sr-uuid',
+              srmetadata.NAME_LABEL_TAG: 'sr',
+              srmetadata.NAME_DESCRIPTION_TAG: ''}
+    vdis = {}
+    for i in range(count):
+        vdis[i] = vdiInfo(i)
+    srmetadata.SLMetadataHandler(path).writeMetadata(srInfo, vdis)
+
+
+def timeIt(path, iterations):
+    start = time.time()
+    for i in range(iterations):
+        result = srmetadata.SLMetadataHandler(path, False).getMetadata()[1]
+    return result, (time.time() - start) / iterations
+
+
+def main():
+    iterations = 3
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    util.SMlog = lambda *args, **kwargs: None
+    decode = srmetadata.decodeVdiSlot
+    tmpDir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpDir, 'MGT')
+        print "%6s %16s %16s %8s" % ("VDIs", "DOM (ms/1000)",
+                "decode (ms/1000)", "speedup")
+        for count in COUNTS:
+            writeMetadata(path, count)
+            srmetadata.decodeVdiSlot = lambda vdi_info: None
+            old, tOld = timeIt(path, iterations)
+            srmetadata.decodeVdiSlot = decode
+            new, tNew = timeIt(path, iterations)
+            if old != new:
+                print "MISMATCH for %d VDIs" % count
+                sys.exit(1)
+            print "%6d %16.1f %16.1f %7.1fx" % (count,
+                    tOld * 1000 * 1000 / count, tNew * 1000 * 1000 / count,
+                    tOld / max(tNew, 1e-9))
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ import ISCSISR
 import mock
 import xs_errors
 import os
+import tempfile
+import shutil
 
 
 class TestBase(unittest.TestCase):
@@ -219,3 +221,107 @@ class TestISCSISR(TestBase):
         self.assertEqual(len(iscsi_sr.chappassword), s2_size)
         self.assertEqual(len(iscsi_sr.incoming_chapuser), s3_size)
         self.assertEqual(len(iscsi_sr.incoming_chappassword), s4_size)
+
+
+class NonInitingAttachISCSISR(ISCSISR.ISCSISR):
+    def __init__(self):
+        self.dconf = {}
+        self.attached = False
+        self.target = '10.0.0.1'
+        self.port = 3260
+        self.targetIQN = 'iqn.target'
+        self.localIQN = 'iqn.local'
+        self.chapuser = ''
+        self.chappassword = ''
+        self.incoming_chapuser = ''
+        self.incoming_chappassword = ''
+        self.multihomed = True
+        self.mpath = 'false'
+        self.session = None
+        self.host_ref = None
+        self.sr_ref = None
+
+    def _mpathHandle(self):
+        pass
+
+    def _initPaths(self):
+        pass
+
+
+class TestAttach(TestBase):
+    def setUp(self):
+        super(TestAttach, self).setUp()
+        self.portals = ['10.0.0.%d:3260' % i for i in range(1, 5)]
+        self.login = mock.Mock()
+        patches = [
+            ('ISCSISR.iscsilib.login', self.login),
+            ('ISCSISR.iscsilib.get_node_records', mock.Mock(return_value=[
+                (portal, '1', 'iqn.target') for portal in self.portals])),
+            ('ISCSISR.iscsilib._checkTGT', mock.Mock(side_effect=[False,
+                                                                 True])),
+            ('ISCSISR.iscsilib.ensure_daemon_running_ok', mock.Mock()),
+            ('ISCSISR.iscsilib.get_IQN_paths', mock.Mock(return_value=[])),
+            ('ISCSISR.util._testHost', mock.Mock()),
+            ('ISCSISR.util._incr_iscsiSR_refcount', mock.Mock()),
+            ('ISCSISR.util.find_my_pbd', mock.Mock(return_value=None)),
+            ('ISCSISR.util.SMlog', mock.Mock()),
+            ('ISCSISR.scsiutil.settle', mock.Mock())]
+        self.mocks = {}
+        for name, new in patches:
+            patcher = mock.patch(name, new)
+            self.mocks[name.split('.')[-1]] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @mock.patch('ISCSISR.iscsilib.wait_for_luns', autospec=True)
+    def test_logs_in_to_all_portals_and_waits_for_their_luns(self,
+                                                             wait_for_luns):
+        def login(portal, *args):
+            if portal == self.portals[2]:
+                raise Exception('unreachable')
+        self.login.side_effect = login
+        wait_for_luns.return_value = []
+
+        NonInitingAttachISCSISR().attach('sr-uuid')
+
+        self.assertEquals(sorted(self.portals),
+                          sorted(args[0][0] for args in
+                                 self.login.call_args_list))
+        wait_for_luns.assert_called_once_with(
+            ['/dev/iscsi/iqn.target/%s' % portal for portal in
+             self.portals if portal != self.portals[2]],
+            ISCSISR.ISCSISR.SETTLE_TIMEOUT)
+        self.assertEquals(1, self.mocks['settle'].call_count)
+
+    def test_chap_failure_is_raised(self):
+        self.login.side_effect = ISCSISR.SR.SROSError(
+            68, 'ISCSI login failed, verify CHAP credentials')
+
+        self.assertRaises(ISCSISR.SR.SROSError,
+                          NonInitingAttachISCSISR().attach, 'sr-uuid')
+
+
+class TestWaitForLUNs(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    @mock.patch('iscsilib.time.sleep', autospec=True)
+    def test_returns_once_luns_show_up(self, sleep):
+        path = os.path.join(self.dir, '10.0.0.1:3260')
+
+        def show_up(interval):
+            if not os.path.exists(path):
+                os.mkdir(path)
+            else:
+                open(os.path.join(path, 'LUN0'), 'w').close()
+        sleep.side_effect = show_up
+
+        self.assertEquals([], ISCSISR.iscsilib.wait_for_luns([path], 5))
+        self.assertEquals(2, sleep.call_count)
+
+    def test_gives_up_at_deadline(self):
+        path = os.path.join(self.dir, '10.0.0.1:3260')
+        os.mkdir(path)
+
+        self.assertEquals([path],
+                          ISCSISR.iscsilib.wait_for_luns([path], 0))
@@ -3,6 +3,8 @@ import mock
 import LVHDSR
 import journaler
 import lvhdutil
+import os
+import collections
 
 
 class SMLog(object):
@@ -76,3 +78,172 @@ class TestLVHDSR(unittest.TestCase, Stubs):
 
         sr._undoAllInflateJournals()
         self.assertEquals(0, mock_lvhdutil_lvRefreshOnAllSlaves.call_count)
+
+
+class TestCreate(unittest.TestCase, Stubs):
+
+    def setUp(self):
+        self.init_stubs()
+        self.stubout('util.SMlog', new_callable=SMLog)
+        self.stubout('lvmcache.LVMCache')
+        self.stubout('xs_errors.XML_DEFS', os.path.join(
+            os.path.dirname(__file__), '..', 'drivers',
+            'XE_SR_ERRORCODES.xml'))
+        self.stubout('lvutil._checkVG', return_value=False)
+        self.stubout('util.get_this_host_ref', return_value='host-1')
+        self.stubout('util.test_scsiserial', return_value=False)
+        self.createVG = mock.Mock(side_effect=Exception('createVG'))
+        self.stubout('lvutil.createVG', self.createVG)
+        srcmd = mock.Mock()
+        srcmd.dconf = {'device': '/dev/bar'}
+        srcmd.params = {'command': 'foo', 'session_ref': 'some session ref'}
+        self.sr = LVHDSR.LVHDSR(srcmd, "some SR UUID")
+        self.sr.isMaster = True
+        self.sr.session = mock.Mock()
+        self.sr.session.xenapi.SR.get_by_uuid.return_value = 'sr-new'
+        self.sr.session.xenapi.SR.get_all_records.return_value = {}
+
+    def tearDown(self):
+        self.remove_stubs()
+
+    def set_pbds(self, *pbds):
+        # the PBD of the new SR comes first
+        records = [('pbd-new', {'SR': 'sr-new', 'host': 'host-1',
+                                'device_config': {'device': '/dev/bar'}})]
+        for i, (sr, host, device) in enumerate(pbds):
+            records.append(('pbd-%d' % i, {'SR': sr, 'host': host,
+                                           'device_config':
+                                               {'device': device}}))
+        self.sr.session.xenapi.PBD.get_all_records.return_value = \
+            collections.OrderedDict(records)
+
+    def test_device_used_by_another_sr_on_host(self):
+        self.set_pbds(('sr-old', 'host-1', '/dev/baz,/dev/bar'))
+
+        try:
+            self.sr.create('some SR UUID', 0)
+        except LVHDSR.SR.SROSError, e:
+            # SRInUse
+            self.assertEquals(16, e.errno)
+        else:
+            self.fail('no exception raised')
+        self.assertEquals(0, self.createVG.call_count)
+
+    def test_device_used_on_another_host(self):
+        self.set_pbds(('sr-old', 'host-2', '/dev/bar'))
+
+        self.assertRaises(Exception, self.sr.create, 'some SR UUID', 0)
+
+        # got past the in-use checks
+        self.assertEquals(1, self.createVG.call_count)
+
+
+class TestSnapshotVDIs(unittest.TestCase, Stubs):
+
+    def setUp(self):
+        self.init_stubs()
+        self.stubout('util.SMlog', new_callable=SMLog)
+        self.stubout('lvmcache.LVMCache')
+        self.stubout('vhdutil.setHidden')
+        self.stubout('xs_errors.XML_DEFS', os.path.join(
+            os.path.dirname(__file__), '..', 'drivers',
+            'XE_SR_ERRORCODES.xml'))
+        srcmd = mock.Mock()
+        srcmd.dconf = {'device': '/dev/bar'}
+        srcmd.params = {'command': 'foo', 'session_ref': 'some session ref'}
+        self.sr = LVHDSR.LVHDSR(srcmd, "some SR UUID")
+        self.sr.session = mock.Mock()
+        self.sr.session.xenapi.VDI.get_by_uuid.side_effect = \
+            lambda uuid: 'ref-' + uuid
+        self.sr._ensureSpaceAvailable = mock.Mock()
+        self.sr.journaler = mock.Mock()
+        self.calls = []
+        self.failing = None
+        self.sr.vdi = self.create_vdi
+
+    def tearDown(self):
+        self.remove_stubs()
+
+    def create_vdi(self, uuid):
+        vdi = mock.Mock()
+        vdi.uuid = uuid
+        vdi.vdi_type = 'vhd'
+        if uuid.startswith('raw'):
+            vdi.vdi_type = 'aio'
+        vdi.lvname = 'LV-' + uuid
+        vdi._prepareSnapshot.return_value = {'sizeReq': 10}
+
+        def start(snap):
+            self.calls.append(('start', uuid))
+            snap['origUuid'] = uuid
+            snap['jval'] = 'base_clon'
+            snap['snapVDI'] = snap['snapVDI2'] = None
+        vdi._startSnapshot.side_effect = start
+
+        def snapshotLVs(snap):
+            self.calls.append(('lvs', uuid))
+            if uuid == self.failing:
+                raise LVHDSR.util.SMException('lvcreate failed')
+        vdi._snapshotLVs.side_effect = snapshotLVs
+        vdi._finishSnapshot.side_effect = \
+            lambda *args: self.sr.srcmd.params['vdi_ref']
+        return vdi
+
+    def test_lvm_changes_are_batched(self):
+        uuids = ['vdi-1', 'raw-2', 'vdi-3']
+
+        snaps = self.sr._snapshotVDIs(uuids, LVHDSR.LVHDVDI.SNAPSHOT_DOUBLE)
+
+        self.assertEquals([('start', u) for u in uuids] +
+                          [('lvs', u) for u in uuids], self.calls)
+        self.sr._ensureSpaceAvailable.assert_called_once_with(30)
+        self.sr.lvmCache.setHiddenMulti.assert_called_once_with(['LV-raw-2'])
+        self.sr.lvmCache.setReadonlyMulti.assert_called_once_with(
+            ['LV-vdi-1', 'LV-raw-2', 'LV-vdi-3'], True)
+        self.sr.journaler.removeMulti.assert_called_once_with(
+            LVHDSR.LVHDVDI.JRN_CLONE, uuids)
+        # each VDI is finished with its own ref in the SR params
+        self.assertEquals(dict((u, 'ref-' + u) for u in uuids), snaps)
+        self.assertFalse('vdi_ref' in self.sr.srcmd.params)
+
+    def test_failure_rolls_back_started_vdis(self):
+        self.sr._handleInterruptedCloneOp = mock.Mock()
+        self.failing = 'vdi-2'
+
+        self.assertRaises(LVHDSR.SR.SROSError,
+                          self.sr._snapshotVDIs, ['vdi-1', 'vdi-2'],
+                          LVHDSR.LVHDVDI.SNAPSHOT_DOUBLE)
+
+        self.assertEquals(
+            [mock.call('vdi-1', 'base_clon', True),
+             mock.call('vdi-2', 'base_clon', True)],
+            self.sr._handleInterruptedCloneOp.call_args_list)
+        self.assertEquals(0, self.sr.journaler.removeMulti.call_count)
+
+    @mock.patch('LVHDSR.blktap2.VDI', autospec=True)
+    def test_group_snapshot_runs_under_sr_lock(self, tapdisk):
+        self.sr.lock = mock.Mock()
+        self.sr.lock.held.return_value = False
+
+        def pause(*args):
+            self.assertEquals(1, self.sr.lock.acquire.call_count)
+            return True
+        tapdisk.tap_pause.side_effect = pause
+
+        self.sr.snapshotVDIs(['vdi-1', 'vdi-2'])
+
+        self.assertEquals(2, tapdisk.tap_unpause.call_count)
+        self.sr.lock.acquire.assert_called_once_with()
+        self.sr.lock.release.assert_called_once_with()
+
+    @mock.patch('LVHDSR.blktap2.VDI', autospec=True)
+    def test_group_snapshot_keeps_lock_held_by_caller(self, tapdisk):
+        self.sr.lock = mock.Mock()
+        self.sr.lock.held.return_value = True
+        tapdisk.tap_pause.return_value = False
+
+        self.assertRaises(LVHDSR.util.SMException, self.sr.snapshotVDIs,
+                          ['vdi-1'])
+
+        self.assertEquals(0, self.sr.lock.acquire.call_count)
+        self.assertEquals(0, self.sr.lock.release.call_count)
@@ -0,0 +1,118 @@
+import unittest
+import mock
+
+import SR
+import VDI
+
+
+class FakeVDI(VDI.VDI):
+    def __init__(self, sr, uuid, location, size):
+        self.sr = sr
+        self.uuid = uuid
+        self.location = location
+        self.label = uuid
+        self.description = ''
+        self.size = size
+        self.utilisation = size
+        self.read_only = False
+        self.shareable = False
+        self.managed = True
+        self.sm_config_override = {}
+        self.sm_config_keep = []
+
+
+def xenapi_record(uuid, location, size, sm_config=None):
+    return {'uuid': uuid,
+            'location': location,
+            'virtual_size': str(size),
+            'physical_utilisation': str(size),
+            'read_only': False,
+            'sm_config': sm_config or {}}
+
+
+class TestScanRecord(unittest.TestCase):
+    def setUp(self):
+        self.sr = mock.Mock()
+        self.sr.srcmd.params = {}
+        self.sr.vdis = {}
+        self.records = {}
+
+        list_patcher = mock.patch('util.list_VDI_records_in_sr')
+        list_patcher.start().side_effect = lambda sr: self.records
+        self.addCleanup(list_patcher.stop)
+
+        session_patcher = mock.patch('util.get_localAPI_session')
+        self.get_session = session_patcher.start()
+        self.get_session.side_effect = lambda: mock.Mock()
+        self.addCleanup(session_patcher.stop)
+
+    def add_vdi(self, n, size, record_size=None):
+        uuid = 'uuid-%d' % n
+        self.sr.vdis[uuid] = FakeVDI(self.sr, uuid, 'loc-%d' % n, size)
+        if record_size is not None:
+            self.records['ref-%d' % n] = \
+                xenapi_record(uuid, 'loc-%d' % n, record_size)
+
+    def test_update_sets_only_changed_fields(self):
+        self.add_vdi(1, 200, record_size=100)
+        self.sr.vdis['uuid-1'].utilisation = 100
+
+        SR.ScanRecord(self.sr).synchronise_existing()
+
+        xenapi = self.sr.session.xenapi
+        xenapi.VDI.set_virtual_size.assert_called_once_with('ref-1', '200')
+        self.assertEquals(0, xenapi.VDI.set_physical_utilisation.call_count)
+        self.assertEquals(0, xenapi.VDI.set_read_only.call_count)
+        self.assertEquals(0, xenapi.VDI.get_by_uuid.call_count)
+        self.assertEquals(0, xenapi.VDI.get_sm_config.call_count)
+
+    def test_small_batches_use_sr_session_only(self):
+        for i in range(SR.ScanRecord.PARALLEL_SYNC_MIN - 1):
+            self.add_vdi(i, 100)
+
+        SR.ScanRecord(self.sr).synchronise_new()
+
+        self.assertEquals(0, self.get_session.call_count)
+        self.assertEquals(SR.ScanRecord.PARALLEL_SYNC_MIN - 1,
+                          self.sr.session.xenapi.VDI.db_introduce.call_count)
+
+    def test_large_batches_spread_over_sessions(self):
+        sessions = []
+
+        def new_session():
+            session = mock.Mock()
+            sessions.append(session)
+            return session
+        self.get_session.side_effect = new_session
+        num = SR.ScanRecord.PARALLEL_SYNC_MIN * 4
+        for i in range(num):
+            self.add_vdi(i, 200, record_size=100)
+
+        SR.ScanRecord(self.sr).synchronise_existing()
+
+        self.assertEquals(SR.ScanRecord.SYNC_SESSIONS - 1, len(sessions))
+        calls = self.sr.session.xenapi.VDI.set_virtual_size.call_count
+        for session in sessions:
+            calls += session.xenapi.VDI.set_virtual_size.call_count
+            session.xenapi.session.logout.assert_called_once_with()
+        self.assertEquals(num, calls)
+
+    def test_falls_back_to_sr_session(self):
+        self.get_session.side_effect = Exception('no session')
+        for i in range(SR.ScanRecord.PARALLEL_SYNC_MIN):
+            self.add_vdi(i, 100)
+
+        SR.ScanRecord(self.sr).synchronise_new()
+
+        self.assertEquals(SR.ScanRecord.PARALLEL_SYNC_MIN,
+                          self.sr.session.xenapi.VDI.db_introduce.call_count)
+
+    def test_errors_are_raised(self):
+        for i in range(SR.ScanRecord.PARALLEL_SYNC_MIN):
+            self.add_vdi(i, 100)
+        self.get_session.side_effect = lambda: self.sr.session
+        self.sr.session.xenapi.VDI.db_introduce.side_effect = \
+            Exception('failed')
+
+        self.assertRaises(Exception,
+                          SR.ScanRecord(self.sr).synchronise_new)
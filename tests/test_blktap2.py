@@ -25,3 +25,124 @@ class TestVDI(unittest.TestCase):
         result = self.vdi.get_tap_type()
 
         self.assertEquals('aio', result)
+
+
+def tapctl_row(pid, minor, path, state=0):
+    return {'pid': pid, 'minor': minor, 'state': state,
+            'args': 'vhd:%s' % path}
+
+
+class TestTapdiskRegistry(unittest.TestCase):
+    def setUp(self):
+        blktap2.TapdiskRegistry.invalidate()
+        list_patcher = mock.patch('blktap2.TapCtl.list')
+        self.tapctl_list = list_patcher.start()
+        self.addCleanup(list_patcher.stop)
+        self.tapctl_list.return_value = [
+            tapctl_row(10, 0, '/dev/VG/a'),
+            tapctl_row(11, 1, '/dev/VG/b'),
+            {'minor': 2}]
+
+    def test_lookups_share_one_listing(self):
+        a = blktap2.Tapdisk.find_by_path('/dev/VG/a')
+        b = blktap2.Tapdisk.find_by_minor(1)
+        c = blktap2.Tapdisk.find(pid=11, minor=1)
+
+        self.assertEquals(0, a.minor)
+        self.assertEquals('/dev/VG/b', b.path)
+        self.assertEquals(11, c.pid)
+        self.assertEquals(1, self.tapctl_list.call_count)
+
+    def test_filters_like_tapctl_list(self):
+        self.assertEquals(None, blktap2.Tapdisk.find(pid=10, minor=1))
+        self.assertEquals(None, blktap2.Tapdisk.find_by_minor(2))
+        self.assertEquals(
+            [0], [t.minor for t in blktap2.Tapdisk.list(pid='10')])
+        self.assertEquals(
+            2, len(list(blktap2.Tapdisk.list(_type='vhd'))))
+
+    @mock.patch('blktap2.TapCtl._call')
+    def test_own_pause_invalidates_listing(self, tapctl_call):
+        tapctl_call.return_value.stdout.readline.return_value = ''
+        tapdisk = blktap2.Tapdisk.find_by_minor(0)
+        self.tapctl_list.return_value = [
+            tapctl_row(10, 0, '/dev/VG/a', blktap2.Tapdisk.Flags.PAUSED)]
+
+        tapdisk.pause()
+
+        self.assertTrue(tapdisk.is_paused())
+        self.assertEquals(2, self.tapctl_list.call_count)
+
+    @mock.patch('blktap2.TapCtl._call')
+    def test_read_only_commands_keep_listing(self, tapctl_call):
+        tapctl_call.return_value.stdout.readline.return_value = '{}'
+        blktap2.Tapdisk.find_by_minor(0)
+
+        blktap2.TapCtl.stats(10, 0)
+        blktap2.Tapdisk.find_by_minor(0)
+
+        self.assertEquals(1, self.tapctl_list.call_count)
+
+    @mock.patch('time.time')
+    def test_listing_expires(self, time):
+        time.return_value = 100.0
+        blktap2.Tapdisk.find_by_minor(0)
+        time.return_value += blktap2.TapdiskRegistry.MAX_AGE
+
+        blktap2.Tapdisk.find_by_minor(0)
+
+        self.assertEquals(2, self.tapctl_list.call_count)
+
+
+class TestTapPause(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.Mock()
+        self.session.xenapi.VDI.get_sm_config.return_value = {
+            'host_a': 'RW', 'host_b': 'RO', 'vdi_type': 'vhd'}
+        for name, new in [('util._thread_session', lambda session: session),
+                          ('util.SMlog', mock.Mock())]:
+            patcher = mock.patch(name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_pause_calls_all_hosts(self):
+        self.session.xenapi.host.call_plugin.return_value = 'True'
+
+        self.assertTrue(blktap2.VDI.tap_pause(self.session, 'sr', 'vdi'))
+
+        hosts = sorted(args[0] for args, _ in
+                       self.session.xenapi.host.call_plugin.call_args_list)
+        self.assertEquals(['a', 'b'], hosts)
+        self.assertEquals(0, self.session.xenapi.VDI.remove_from_sm_config
+                          .call_count)
+
+    def test_failed_pause_on_one_host(self):
+        self.session.xenapi.host.call_plugin.side_effect = \
+            lambda host, plugin, action, args: str(host == 'a')
+
+        self.assertFalse(blktap2.VDI.tap_pause(self.session, 'sr', 'vdi'))
+
+        self.session.xenapi.VDI.remove_from_sm_config.assert_called_once_with(
+            self.session.xenapi.VDI.get_by_uuid.return_value, 'paused')
+        # the host that did pause is unpaused again
+        calls = [(args[0], args[2]) for args, _ in
+                 self.session.xenapi.host.call_plugin.call_args_list]
+        self.assertEquals([('a', 'pause'), ('a', 'unpause'), ('b', 'pause')],
+                          sorted(calls))
+
+    @mock.patch('util.call_on_hosts')
+    def test_pause_does_not_time_out(self, call_on_hosts):
+        call_on_hosts.return_value = {'a': (True, True), 'b': (True, True)}
+
+        self.assertTrue(blktap2.VDI.tap_pause(self.session, 'sr', 'vdi'))
+
+        self.assertEquals(None, call_on_hosts.call_args[0][3])
+
+    @mock.patch('util.logException')
+    def test_unpause_keeps_paused_flag_on_error(self, logException):
+        self.session.xenapi.host.call_plugin.side_effect = Exception('down')
+
+        self.assertFalse(blktap2.VDI.tap_unpause(self.session, 'sr', 'vdi'))
+
+        self.assertEquals(0, self.session.xenapi.VDI.remove_from_sm_config
+                          .call_count)
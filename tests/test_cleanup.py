@@ -1,5 +1,10 @@
 import unittest
 import mock
+import base64
+import zlib
+import tempfile
+import shutil
+import os
 
 import cleanup
 
@@ -139,3 +144,709 @@ class TestSR(unittest.TestCase):
             pass
 
         self.assertEquals(0, sr._locked)
+
+
+def create_vhd_info(uuid, parentUuid=""):
+    vhdInfo = cleanup.vhdutil.VHDInfo(uuid)
+    vhdInfo.path = '/somepath/%s.vhd' % uuid
+    vhdInfo.sizeVirt = 1024
+    vhdInfo.parentUuid = parentUuid
+    return vhdInfo
+
+
+class TestVHDInfoCache(unittest.TestCase):
+    def create_cache(self):
+        with mock.patch('util.pathexists', return_value=False):
+            return cleanup.VHDInfoCache('sr-uuid')
+
+    def test_lookup_returns_entries_with_matching_key(self):
+        cache = self.create_cache()
+        cache.update({'a': create_vhd_info('a', 'b')}, {'a': ['key1']})
+
+        vhds, stale = cache.lookup({'a': ['key1']})
+
+        self.assertEquals([], stale)
+        self.assertEquals('b', vhds['a'].parentUuid)
+
+    def test_lookup_reports_changed_key_as_stale(self):
+        cache = self.create_cache()
+        cache.update({'a': create_vhd_info('a')}, {'a': ['key1']})
+
+        vhds, stale = cache.lookup({'a': ['key2'], 'c': ['key3']})
+
+        self.assertEquals({}, vhds)
+        self.assertEquals(['a', 'c'], sorted(stale))
+
+    def test_update_does_not_cache_scan_errors(self):
+        cache = self.create_cache()
+        vhdInfo = create_vhd_info('a')
+        vhdInfo.error = 'scan-error'
+        cache.update({'a': vhdInfo}, {'a': ['key1']})
+
+        vhds, stale = cache.lookup({'a': ['key1']})
+
+        self.assertEquals(['a'], stale)
+
+    def test_invalidate_drops_entries(self):
+        cache = self.create_cache()
+        cache.update({'a': create_vhd_info('a'), 'b': create_vhd_info('b')},
+                     {'a': ['key1'], 'b': ['key2']})
+
+        cache.invalidate(['a'])
+        vhds, stale = cache.lookup({'a': ['key1'], 'b': ['key2']})
+
+        self.assertEquals(['a'], stale)
+        self.assertEquals(['b'], vhds.keys())
+
+
+class TestGetVHDsCached(unittest.TestCase):
+    def create_sr(self):
+        sr = create_cleanup_sr()
+        with mock.patch('util.pathexists', return_value=False):
+            sr.vhdCache = cleanup.VHDInfoCache('sr-uuid')
+        sr.vhdCache.save = mock.Mock()
+        return sr
+
+    def test_only_changed_vhds_are_queried(self):
+        sr = self.create_sr()
+        sr.vhdCache.update({'a': create_vhd_info('a')}, {'a': ['key1']})
+        queryAll = mock.Mock()
+        queryOne = mock.Mock(side_effect=create_vhd_info)
+
+        vhds = sr._getVHDsCached({'a': ['key1'], 'b': ['key2']}, queryAll,
+                                 queryOne)
+
+        self.assertEquals(['a', 'b'], sorted(vhds.keys()))
+        queryOne.assert_called_once_with('b')
+        self.assertEquals(0, queryAll.call_count)
+
+    def test_all_vhds_scanned_if_many_changed(self):
+        sr = self.create_sr()
+        keys = dict()
+        for i in range(cleanup.VHDInfoCache.MAX_SINGLE_QUERIES + 1):
+            keys[str(i)] = [i]
+        queryAll = mock.Mock(return_value=dict(
+            (uuid, create_vhd_info(uuid)) for uuid in keys))
+        queryOne = mock.Mock()
+
+        vhds = sr._getVHDsCached(keys, queryAll, queryOne)
+
+        self.assertEquals(sorted(keys.keys()), sorted(vhds.keys()))
+        self.assertEquals(1, queryAll.call_count)
+        self.assertEquals(0, queryOne.call_count)
+        self.assertEquals([], sr.vhdCache.lookup(keys)[1])
+
+
+class TestLVHDGetVHDs(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.lvs = {}
+        self.mutated = set()
+        for name, new in [
+                ('cleanup.VHDInfoCache.BASE_DIR', self.dir),
+                ('lvmcache.LVMCache', mock.Mock()),
+                ('cleanup.journaler.Journaler', mock.Mock()),
+                ('cleanup.LVActivator', mock.Mock()),
+                ('lvhdutil.getLVInfo', lambda lvmCache: self.lvs),
+                ('vhdutil.getMutations', self.get_mutations)]:
+            patcher = mock.patch(name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.vgId = 'vg-uuid 1'
+        for uuid in ['a', 'b']:
+            self.add_lv(uuid)
+
+    def get_mutations(self, marker):
+        mutated, self.mutated = self.mutated, set()
+        return ('marker', mutated)
+
+    def add_lv(self, uuid):
+        lvInfo = cleanup.lvutil.LVInfo(
+            cleanup.lvhdutil.LV_PREFIX[cleanup.vhdutil.VDI_TYPE_VHD] + uuid)
+        lvInfo.vdiType = cleanup.vhdutil.VDI_TYPE_VHD
+        lvInfo.size = 8 * 1024 * 1024
+        lvInfo.readonly = True
+        self.lvs[uuid] = lvInfo
+
+    def create_sr(self):
+        sr = cleanup.LVHDSR('sr-uuid', FakeXapi(), False, False)
+        sr.lvmCache.vgId = self.vgId
+        sr._queryVHD = mock.Mock(side_effect=lambda lvName:
+                                 create_vhd_info(lvName[-1]))
+        return sr
+
+    def queried(self, sr):
+        return sorted(args[0][-1] for args, _ in sr._queryVHD.call_args_list)
+
+    def test_unchanged_vhds_are_not_reread(self):
+        sr = self.create_sr()
+        sr._getVHDs()
+        sr._queryVHD.reset_mock()
+
+        vhds = sr._getVHDs()
+
+        self.assertEquals(['a', 'b'], sorted(vhds.keys()))
+        self.assertEquals([], self.queried(sr))
+
+    def test_logged_mutation_is_reread(self):
+        sr = self.create_sr()
+        sr._getVHDs()
+        sr._queryVHD.reset_mock()
+        self.mutated = set(['/dev/VG_XenStorage-sr-uuid/VHD-a'])
+
+        sr._getVHDs()
+
+        self.assertEquals(['a'], self.queried(sr))
+
+    def test_lv_changes_are_reread(self):
+        sr = self.create_sr()
+        sr._getVHDs()
+        sr._queryVHD.reset_mock()
+        self.lvs['a'].hidden = True
+        self.lvs['b'].readonly = False
+
+        sr._getVHDs()
+
+        self.assertEquals(['a', 'b'], self.queried(sr))
+
+    def test_saved_cache_used_if_vg_unchanged(self):
+        self.create_sr()._getVHDs()
+        sr = self.create_sr()
+
+        sr._getVHDs()
+
+        self.assertEquals([], self.queried(sr))
+
+    def test_saved_cache_dropped_if_vg_changed(self):
+        self.create_sr()._getVHDs()
+        # e.g. another host coalesced as the pool master meanwhile
+        self.vgId = 'vg-uuid 2'
+        sr = self.create_sr()
+
+        sr._getVHDs()
+
+        self.assertEquals(['a', 'b'], self.queried(sr))
+
+
+def create_coalesceable(root, height, spaceNeeded, sizePhys=100,
+                        ioSize=cleanup.vhdutil.VHD_BLOCK_SIZE):
+    vdi = mock.Mock()
+    vdi.isCoalesceable.return_value = True
+    vdi.getTreeRoot.return_value = root
+    root.getTreeHeight.return_value = height
+    vdi._calcExtraSpaceForCoalescing.return_value = spaceNeeded
+    vdi.getSizePhys.return_value = sizePhys
+    vdi._estimateCoalesce.return_value = (spaceNeeded, ioSize)
+    return vdi
+
+
+class TestFindCoalesceables(unittest.TestCase):
+    def create_sr(self, vdis, freeSpace, workers=None):
+        sr = create_cleanup_sr()
+        sr.xapi.srRecord['other_config'] = {}
+        if workers is not None:
+            sr.xapi.srRecord['other_config'][
+                cleanup.COALESCE_WORKERS_TAG] = workers
+        sr.journaler = mock.Mock()
+        sr.journaler.getAll.return_value = {}
+        sr.getFreeSpace = mock.Mock(return_value=freeSpace)
+        for i, vdi in enumerate(vdis):
+            sr.vdis[str(i)] = vdi
+        return sr
+
+    def test_candidates_are_in_different_trees(self):
+        root1 = mock.Mock()
+        root2 = mock.Mock()
+        vdi1 = create_coalesceable(root1, 3, 10)
+        vdi2 = create_coalesceable(root1, 3, 10)
+        vdi3 = create_coalesceable(root2, 2, 10)
+        sr = self.create_sr([vdi1, vdi2, vdi3], 100)
+
+        candidates = sr.findCoalesceables(3)
+
+        self.assertEquals(2, len(candidates))
+        self.assertEquals(vdi3, candidates[1])
+
+    def test_candidates_fit_in_free_space_together(self):
+        vdi1 = create_coalesceable(mock.Mock(), 3, 60)
+        vdi2 = create_coalesceable(mock.Mock(), 2, 60)
+        sr = self.create_sr([vdi1, vdi2], 100)
+
+        candidates = sr.findCoalesceables(2)
+
+        self.assertEquals([vdi1], candidates)
+
+    def test_find_coalesceable_returns_single_candidate(self):
+        vdi1 = create_coalesceable(mock.Mock(), 3, 10)
+        vdi2 = create_coalesceable(mock.Mock(), 2, 10)
+        sr = self.create_sr([vdi1, vdi2], 100)
+
+        self.assertEquals(vdi1, sr.findCoalesceable())
+
+    def test_cheapest_reclaim_comes_first(self):
+        block = cleanup.vhdutil.VHD_BLOCK_SIZE
+        expensive = create_coalesceable(mock.Mock(), 5, 10, sizePhys=1000,
+                                        ioSize=100 * block)
+        cheap = create_coalesceable(mock.Mock(), 2, 10, sizePhys=200,
+                                    ioSize=block)
+        sr = self.create_sr([expensive, cheap], 1000)
+
+        self.assertEquals([cheap, expensive], sr.findCoalesceables(2))
+
+    def test_nothing_to_reclaim_comes_last(self):
+        useless = create_coalesceable(mock.Mock(), 3, 100, sizePhys=100)
+        useful = create_coalesceable(mock.Mock(), 2, 10, sizePhys=100)
+        sr = self.create_sr([useless, useful], 1000)
+
+        self.assertEquals(useful, sr.findCoalesceable())
+
+    def test_tall_trees_are_urgent(self):
+        height = cleanup.SR.COALESCE_URGENT_HEIGHT
+        block = cleanup.vhdutil.VHD_BLOCK_SIZE
+        cheap = create_coalesceable(mock.Mock(), 2, 10, sizePhys=200)
+        tall = create_coalesceable(mock.Mock(), height, 10, sizePhys=20,
+                                   ioSize=100 * block)
+        taller = create_coalesceable(mock.Mock(), height + 1, 10,
+                                     sizePhys=20, ioSize=100 * block)
+        sr = self.create_sr([cheap, tall, taller], 1000)
+
+        self.assertEquals([taller, tall, cheap], sr.findCoalesceables(3))
+
+    def test_exact_space_only_computed_for_chosen(self):
+        cheap = create_coalesceable(mock.Mock(), 2, 10, sizePhys=200)
+        dear = create_coalesceable(mock.Mock(), 2, 10, sizePhys=20)
+        sr = self.create_sr([dear, cheap], 1000)
+
+        self.assertEquals(cheap, sr.findCoalesceable())
+        self.assertEquals(1, cheap._calcExtraSpaceForCoalescing.call_count)
+        self.assertEquals(0, dear._calcExtraSpaceForCoalescing.call_count)
+        self.assertEquals(0, dear.getVHDBlocks.call_count)
+
+    def test_next_candidate_if_exact_space_too_big(self):
+        cheap = create_coalesceable(mock.Mock(), 2, 10, sizePhys=200)
+        dear = create_coalesceable(mock.Mock(), 2, 10, sizePhys=20)
+        cheap._calcExtraSpaceForCoalescing.return_value = 2000
+        sr = self.create_sr([dear, cheap], 1000)
+
+        self.assertEquals(dear, sr.findCoalesceable())
+
+    def test_coalesce_workers_default(self):
+        sr = self.create_sr([], 0)
+
+        self.assertEquals(cleanup.DEFAULT_COALESCE_WORKERS,
+                          sr.getCoalesceWorkers())
+
+    def test_coalesce_workers_from_other_config(self):
+        sr = self.create_sr([], 0, workers='4')
+
+        self.assertEquals(4, sr.getCoalesceWorkers())
+
+    def test_coalesce_workers_invalid_value(self):
+        sr = self.create_sr([], 0, workers='lots')
+
+        self.assertEquals(cleanup.DEFAULT_COALESCE_WORKERS,
+                          sr.getCoalesceWorkers())
+
+
+class TestBitmap(unittest.TestCase):
+    def test_count(self):
+        self.assertEquals(0, cleanup.Bitmap().count())
+        self.assertEquals(10, cleanup.Bitmap("\xff\x00\x81").count())
+
+    def test_or_aligns_at_first_byte(self):
+        bitmap = cleanup.Bitmap("\x01\x02") | "\x10\x20\x03"
+
+        self.assertEquals("\x11\x22\x03", str(bitmap))
+
+    def test_and_not(self):
+        bitmap = cleanup.Bitmap("\x0f\xff\x01") - "\x03\x0f"
+
+        self.assertEquals("\x0c\xf0\x01", str(bitmap))
+        self.assertEquals("\x00",
+                          str(cleanup.Bitmap("\x0f") - "\xff\xff"))
+
+    def test_count_bits_of_union(self):
+        self.assertEquals(0, cleanup.Util.countBits("", ""))
+        self.assertEquals(3, cleanup.Util.countBits("\x03", "\x06"))
+        self.assertEquals(9, cleanup.Util.countBits("\x01", "\x00\xff"))
+
+    def test_merge_block_info(self):
+        parent = cleanup.VDI(mock.Mock(), 'parent', False)
+        child = cleanup.VDI(mock.Mock(), 'child', False)
+        config = {parent: {}, child: {}}
+        for vdi in [parent, child]:
+            vdi.getConfig = lambda key, vdi=vdi: config[vdi].get(key)
+            vdi.setConfig = \
+                lambda key, val, vdi=vdi: config[vdi].__setitem__(key, val)
+        encode = lambda bitmap: base64.b64encode(zlib.compress(bitmap))
+        parent.setConfig(cleanup.VDI.DB_VHD_BLOCKS, encode("\x01"))
+        child.setConfig(cleanup.VDI.DB_VHD_BLOCKS, encode("\x80\x01"))
+
+        parent.mergeBlockInfo(child)
+
+        self.assertEquals("\x81\x01", str(parent.getVHDBlocks()))
+
+
+class TestEstimateCoalesce(unittest.TestCase):
+    def setUp(self):
+        self.parent = cleanup.VDI(mock.Mock(), 'parent', False)
+        self.child = cleanup.VDI(mock.Mock(), 'child', False)
+        self.child.parent = self.parent
+        self.child._sizeVHD = 100 * cleanup.vhdutil.VHD_BLOCK_SIZE
+        self.config = {self.parent: {}, self.child: {}}
+        for vdi in [self.parent, self.child]:
+            vdi.getConfig = lambda key, vdi=vdi: self.config[vdi].get(key)
+            vdi._queryVHDBlocks = mock.Mock()
+
+    def set_blocks(self, vdi, bitmap):
+        self.config[vdi][cleanup.VDI.DB_VHD_BLOCKS] = \
+                base64.b64encode(zlib.compress(bitmap))
+
+    def test_from_cached_bitmaps(self):
+        block = cleanup.vhdutil.VHD_BLOCK_SIZE
+        self.set_blocks(self.parent, "\x0f")
+        self.set_blocks(self.child, "\x03\x01")
+
+        self.assertEquals((block, 6 * block), self.child._estimateCoalesce())
+
+    def test_parent_bitmap_not_cached(self):
+        block = cleanup.vhdutil.VHD_BLOCK_SIZE
+        self.set_blocks(self.child, "\x03\x01")
+
+        self.assertEquals((3 * block, 6 * block),
+                          self.child._estimateCoalesce())
+
+    def test_nothing_cached_never_reads_vhd(self):
+        size = self.child.getSizePhys()
+
+        self.assertEquals((size, 2 * size), self.child._estimateCoalesce())
+        self.assertEquals(0, self.child._queryVHDBlocks.call_count)
+        self.assertEquals(0, self.parent._queryVHDBlocks.call_count)
+
+
+class TestLeafCoalesceRounds(unittest.TestCase):
+    def setUp(self):
+        self.sr = create_cleanup_sr()
+        self.sr.xapi.srRecord['other_config'] = {}
+        self.sr._liveLeafCoalesce = mock.Mock(return_value=True)
+        self.vdi = cleanup.VDI(self.sr, 'leaf', False)
+        self.vdi.config = {}
+        self.vdi.getConfig = lambda key: self.vdi.config.get(key)
+        self.vdi.setConfig = \
+            lambda key, val: self.vdi.config.__setitem__(key, val)
+        time_patcher = mock.patch('cleanup.time.time')
+        self.time = time_patcher.start()
+        self.time.return_value = 0
+        self.addCleanup(time_patcher.stop)
+
+    def snapshot_coalesce(self, sizes, speed):
+        """Each round copies the leaf at 'speed' bytes/s and leaves the next
+        size in 'sizes' in the leaf"""
+        sizes = list(sizes)
+
+        def snapshotCoalesce(vdi):
+            self.time.return_value += vdi._sizeVHD / float(speed)
+            vdi._sizeVHD = sizes.pop(0)
+            return True
+        self.sr._snapshotCoalesce = mock.Mock(side_effect=snapshotCoalesce)
+
+    def test_max_pause_from_other_config(self):
+        self.assertEquals(cleanup.DEFAULT_LEAF_COALESCE_MAX_PAUSE,
+                          self.sr.getLeafCoalesceMaxPause())
+        self.sr.xapi.srRecord['other_config'][
+            cleanup.LEAF_COALESCE_MAX_PAUSE_TAG] = '2.5'
+        self.assertEquals(2.5, self.sr.getLeafCoalesceMaxPause())
+        self.sr.xapi.srRecord['other_config'][
+            cleanup.LEAF_COALESCE_MAX_PAUSE_TAG] = '-1'
+        self.assertEquals(cleanup.DEFAULT_LEAF_COALESCE_MAX_PAUSE,
+                          self.sr.getLeafCoalesceMaxPause())
+
+    def test_rounds_until_pause_is_short_enough(self):
+        # 1000 bytes per second: the leaf has to get down to 1000 bytes
+        self.vdi._sizeVHD = 100 * 1000 * 1000
+        self.snapshot_coalesce([20000, 1500, 900], 1000)
+
+        self.assertTrue(self.sr._coalesceLeaf(self.vdi))
+
+        self.assertEquals(3, self.sr._snapshotCoalesce.call_count)
+        self.sr._liveLeafCoalesce.assert_called_once_with(self.vdi)
+        self.assertEquals(None, self.vdi.config.get(cleanup.VDI.DB_LEAFCLSC))
+
+    def test_fast_rounds_allow_bigger_final_delta(self):
+        self.vdi._sizeVHD = 1000 * 1000 * 1000
+        self.snapshot_coalesce([50 * 1000 * 1000], 100 * 1000 * 1000)
+
+        self.sr._coalesceLeaf(self.vdi)
+
+        self.assertEquals(1, self.sr._snapshotCoalesce.call_count)
+
+    def test_gives_up_when_not_converging(self):
+        rounds = cleanup.VDI.LIVE_LEAF_COALESCE_MAX_ROUNDS
+        self.vdi._sizeVHD = 100 * 1000 * 1000
+        self.snapshot_coalesce(range(90 * 1000 * 1000, 0, -1000)[:rounds],
+                               1000 * 1000)
+
+        self.sr._coalesceLeaf(self.vdi)
+
+        self.assertEquals(rounds, self.sr._snapshotCoalesce.call_count)
+        self.assertEquals(cleanup.VDI.LEAFCLSC_OFFLINE,
+                          self.vdi.config[cleanup.VDI.DB_LEAFCLSC])
+
+
+class TestResidentGC(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.lockResident = mock.Mock()
+        for name, new in [('ipc.IPCFlag.BASE_DIR', self.dir),
+                          ('cleanup.lockRunning', mock.Mock()),
+                          ('cleanup.lockResident', self.lockResident),
+                          ('cleanup.time.sleep', mock.Mock()),
+                          ('util.SMlog', mock.Mock())]:
+            patcher = mock.patch(name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.flag = cleanup.IPCFlag('sr-uuid')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_kick_is_consumed(self):
+        self.flag.set(cleanup.FLAG_TYPE_WAKEUP)
+
+        self.assertTrue(cleanup._waitForWakeup('sr-uuid', 10))
+        self.assertFalse(self.flag.test(cleanup.FLAG_TYPE_WAKEUP))
+
+    def test_wait_times_out(self):
+        self.assertFalse(cleanup._waitForWakeup('sr-uuid', 0))
+
+    def test_abort_while_waiting(self):
+        self.flag.set(cleanup.FLAG_TYPE_ABORT)
+
+        self.assertRaises(cleanup.AbortException, cleanup._waitForWakeup,
+                          'sr-uuid', 10)
+
+    def test_wake_kicks_resident_gc(self):
+        self.lockResident.acquireNoblock.return_value = False
+
+        self.assertTrue(cleanup.wake('sr-uuid'))
+        self.assertTrue(self.flag.test(cleanup.FLAG_TYPE_WAKEUP))
+
+    def test_wake_without_resident_gc(self):
+        self.lockResident.acquireNoblock.return_value = True
+
+        self.assertFalse(cleanup.wake('sr-uuid'))
+        self.lockResident.release.assert_called_once_with()
+
+    @mock.patch('cleanup._waitForWakeup', autospec=True)
+    def test_idle_exits_on_time_out(self, waitForWakeup):
+        waitForWakeup.return_value = False
+
+        self.assertFalse(cleanup._idle('sr-uuid'))
+        self.lockResident.release.assert_called_once_with()
+
+    @mock.patch('cleanup._waitForWakeup', autospec=True)
+    def test_idle_serves_kick_racing_with_exit(self, waitForWakeup):
+        def wait(srUuid, timeOut):
+            self.flag.set(cleanup.FLAG_TYPE_WAKEUP)
+            return False
+        waitForWakeup.side_effect = wait
+        self.lockResident.acquireNoblock.return_value = True
+
+        self.assertTrue(cleanup._idle('sr-uuid'))
+        self.assertFalse(self.flag.test(cleanup.FLAG_TYPE_WAKEUP))
+
+    @mock.patch('cleanup._idle', autospec=True)
+    def test_resident_loop_rescans_on_kick(self, idle):
+        idle.side_effect = [True, False]
+        sr = mock.Mock()
+        sr.hasWork.return_value = False
+
+        cleanup._gcLoop(sr, False, resident=True)
+
+        self.assertEquals(2, sr.scanLocked.call_count)
+        self.assertEquals(2, idle.call_count)
+
+    def test_abort_stops_idle_resident_gc(self):
+        self.lockResident.acquireNoblock.side_effect = [False, True]
+        cleanup.lockRunning.acquireNoblock.return_value = True
+
+        self.assertTrue(cleanup._abort('sr-uuid'))
+
+        self.assertFalse(self.flag.test(cleanup.FLAG_TYPE_ABORT))
+        self.lockResident.release.assert_called_once_with()
+
+
+class TestIOThrottle(unittest.TestCase):
+    def setUp(self):
+        for name in ['cleanup.time.sleep', 'cleanup.os.killpg',
+                     'util.SMlog']:
+            patcher = mock.patch(name)
+            setattr(self, name.split('.')[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+        self.throttle = cleanup.IOThrottle('sr-uuid', 10 * 1024 * 1024, 0)
+        self.throttle.lastAdapt = float('inf')
+
+    def test_throttle_from_other_config(self):
+        sr = create_cleanup_sr()
+        sr.xapi.srRecord['other_config'] = {}
+        self.assertEquals(None, sr.getCoalesceThrottle())
+
+        sr.xapi.srRecord['other_config'] = {
+            cleanup.COALESCE_BANDWIDTH_TAG: '20',
+            cleanup.COALESCE_IOPS_TAG: 'bogus'}
+        self.assertEquals((20 * 1024 * 1024, 0),
+                          sr.getCoalesceThrottle().getBudget())
+
+    @mock.patch('cleanup.time.time', autospec=True)
+    @mock.patch('cleanup.IOThrottle._getIO', autospec=True)
+    def test_stops_group_while_ahead_of_budget(self, getIO, time):
+        time.side_effect = [0, 1, 2, 3]
+        getIO.side_effect = [[0, 0], [30 * 1024 * 1024, 10]] + \
+            [[30 * 1024 * 1024, 10]] * 2
+
+        signals = []
+        for i in range(4):
+            self.killpg.reset_mock()
+            self.throttle.wait([123], 1)
+            signals.append([args[1] for args, _ in
+                            self.killpg.call_args_list])
+
+        # 30MiB at 10MiB/s take 3s: stopped for the 2s after the first
+        stopCont = [cleanup.signal.SIGSTOP, cleanup.signal.SIGCONT]
+        self.assertEquals([[], stopCont, stopCont, []], signals)
+
+    def test_budget_follows_vm_load(self):
+        self.throttle._adapt((100, 0))
+        self.throttle._adapt((200, 4))
+        self.assertEquals(0.5, self.throttle.fraction)
+        self.throttle._adapt((300, 8))
+        self.assertEquals(0.25, self.throttle.fraction)
+        # busy, but the queues are not growing
+        self.throttle._adapt((400, 8))
+        self.assertEquals(0.25, self.throttle.fraction)
+        self.throttle._adapt((400, 0))
+        self.assertEquals(0.5, self.throttle.fraction)
+        for i in range(10):
+            self.throttle._adapt((400, 0))
+        self.assertEquals(1.0, self.throttle.fraction)
+        for i in range(10):
+            self.throttle._adapt((400, i + 1))
+        self.assertEquals(cleanup.IOThrottle.MIN_FRACTION,
+                          self.throttle.fraction)
+
+    @mock.patch('blktap2.Tapdisk.list', autospec=True)
+    def test_vm_load_counts_tapdisks_of_sr(self, tapdisks):
+        def tapdisk(path, stats):
+            tap = mock.Mock()
+            tap.path = path
+            tap.stats.return_value = stats
+            return tap
+        tapdisks.return_value = [
+            tapdisk('/dev/VG_XenStorage-sr-uuid/VHD-a',
+                    {'secs': [10, 20], 'reqs_outstanding': 3}),
+            tapdisk('/var/run/sr-mount/sr-uuid/b.vhd', {'secs': [5, 0]}),
+            tapdisk('/var/run/sr-mount/other/c.vhd',
+                    {'secs': [100, 100], 'reqs_outstanding': 7}),
+            tapdisk(None, {})]
+
+        self.assertEquals((35, 3), self.throttle._getVMLoad())
+
+    def test_io_of_own_process_group(self):
+        bytes, calls = cleanup.IOThrottle._getIO([os.getpgrp()])
+
+        self.assertTrue(bytes > 0)
+        self.assertTrue(calls > 0)
+
+
+class TestCoalesceThrottle(unittest.TestCase):
+    def setUp(self):
+        self.sr = create_cleanup_sr()
+        self.sr.uuid = 'sr-uuid'
+        self.sr.xapi.srRecord['other_config'] = {
+            cleanup.COALESCE_BANDWIDTH_TAG: '20'}
+        self.vdi = cleanup.VDI(self.sr, 'vdi-uuid', False)
+        self.vdi.parent = mock.Mock()
+        for name in ['validate', 'getConfig', '_prepareCoalesce',
+                     '_finishCoalesce', '_cleanupCoalesce']:
+            setattr(self.vdi, name, mock.Mock())
+        for name in ['util.SMlog', 'cleanup.Util.runAbortable']:
+            patcher = mock.patch(name)
+            setattr(self, name.split('.')[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_background_coalesce_is_throttled(self):
+        self.vdi._doCoalesce()
+
+        throttle = self.runAbortable.call_args[0][6]
+        self.assertEquals((20 * 1024 * 1024, 0), throttle.getBudget())
+
+    @mock.patch('util.fistpoint')
+    def test_leaf_coalesce_is_not_throttled(self, fistpoint):
+        class Stop(Exception):
+            pass
+
+        def activate(name, uuid):
+            if name == "LVHDRT_coaleaf_after_coalesce":
+                raise Stop()
+        fistpoint.activate.side_effect = activate
+        self.sr.journaler = mock.Mock()
+        self.sr._prepareCoalesceLeaf = mock.Mock()
+
+        self.assertRaises(Stop, self.sr._doCoalesceLeaf, self.vdi)
+
+        self.assertEquals(1, self.runAbortable.call_count)
+        self.assertEquals(None, self.runAbortable.call_args[0][6])
+
+
+class TestCoalesceParallel(unittest.TestCase):
+    def setUp(self):
+        self.sr = create_cleanup_sr()
+        self.sr.uuid = 'sr-uuid'
+        self.sr.xapi.srRecord['other_config'] = {}
+        self.sr.journaler = mock.Mock()
+        for name in ['util.SMlog', 'cleanup.Util.runAbortableParallel']:
+            patcher = mock.patch(name)
+            setattr(self, name.split('.')[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+        self.runAbortableParallel.return_value = {}
+
+    def create_vdi(self, uuid, ioSize=0):
+        vdi = mock.Mock()
+        vdi.uuid = uuid
+        vdi.JRN_COALESCE = cleanup.VDI.JRN_COALESCE
+        vdi._estimateCoalesce.return_value = (0, ioSize)
+        return vdi
+
+    def test_failed_prepare_removes_journal(self):
+        failing = self.create_vdi('failing')
+        failing._prepareCoalesce.side_effect = util.SMException('failed')
+        ok = self.create_vdi('ok')
+
+        self.sr._coalesceParallel([failing, ok])
+
+        self.sr.journaler.remove.assert_any_call(cleanup.VDI.JRN_COALESCE,
+                                                 'failing')
+        self.assertEquals(1, failing._cleanupCoalesce.call_count)
+        self.assertEquals(['ok'],
+                          self.runAbortableParallel.call_args[0][0].keys())
+
+    def test_timeout_covers_io(self):
+        vdis = [self.create_vdi('a', 100 * 1024 * 1024),
+                self.create_vdi('b', 200 * 1024 * 1024)]
+
+        self.sr._coalesceParallel(vdis)
+
+        timeOut = self.runAbortableParallel.call_args[0][5]
+        self.assertEquals(cleanup.SR.COALESCE_TIMEOUT_MARGIN + 300, timeOut)
+
+    def test_timeout_allows_for_throttle(self):
+        self.sr.xapi.srRecord['other_config'] = {
+            cleanup.COALESCE_BANDWIDTH_TAG: '1'}
+        vdis = [self.create_vdi('a', 100 * 1024 * 1024)]
+
+        self.sr._coalesceParallel(vdis)
+
+        # the throttle may go down to a 16th of its budget
+        timeOut = self.runAbortableParallel.call_args[0][5]
+        self.assertEquals(cleanup.SR.COALESCE_TIMEOUT_MARGIN + 1600, timeOut)
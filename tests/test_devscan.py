@@ -1,6 +1,11 @@
 import testlib
 import unittest
+import tempfile
+import threading
+import time
+import shutil
 import mock
+import os
 
 import SRCommand
 import HBASR
@@ -183,3 +188,66 @@ class TestUpdateDevsDict(unittest.TestCase):
         devscan.update_devs_dict(devices, dev, entry)
 
         self.assertEquals({}, devices)
+
+
+class TestAdaptersIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        paths = {}
+        for name in ['scsi_host', 'scsi_disk', 'fc_transport']:
+            paths[name] = os.path.join(self.dir, name)
+            os.mkdir(paths[name])
+        for name, new in [
+                ('devscan.SYSFS_PATH1', paths['scsi_host']),
+                ('devscan.SYSFS_PATH2', paths['scsi_disk']),
+                ('devscan.SYSFS_PATH3', paths['fc_transport']),
+                ('devscan.match_hbadevs', lambda a, filterstr: 'qla2xxx'),
+                ('devscan._extract_dev_name', lambda device_dir:
+                    'sd-' + os.path.basename(os.path.dirname(device_dir))),
+                ('scsiutil.rescan', mock.Mock())]:
+            patcher = mock.patch(name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def add(self, *paths):
+        for path in paths:
+            os.makedirs(os.path.join(self.dir, path))
+
+    def test_targets_match_whole_ids(self):
+        self.add('scsi_host/host1/device/target1:0:1',
+                 'scsi_disk/1:0:1:0', 'scsi_disk/1:0:1:1',
+                 'scsi_disk/1:0:12:0')
+
+        devs = devscan.adapters()['devs']
+
+        self.assertEquals('1:0:1:0', devs['sd-1:0:1:0']['target'])
+        self.assertEquals('1:0:1:1', devs['sd-1:0:1:1']['target'])
+        # not under target1:0:1: only found through scsi_disk
+        self.assertEquals('0', devs['sd-1:0:12:0']['target'])
+
+    def test_hosts_are_rescanned_concurrently(self):
+        hosts = ['%d' % i for i in range(4)]
+        for id in hosts:
+            self.add('scsi_host/host%s/device' % id)
+        lock = threading.Condition()
+        waiting = []
+
+        def rescan(ids):
+            lock.acquire()
+            try:
+                waiting.append(ids[0])
+                lock.notifyAll()
+                deadline = time.time() + 5
+                while len(waiting) < len(hosts):
+                    if time.time() > deadline:
+                        raise Exception('rescans not concurrent')
+                    lock.wait(1)
+            finally:
+                lock.release()
+
+        with mock.patch('scsiutil.rescan', rescan):
+            result = devscan.adapters()
+
+        self.assertEquals(sorted(hosts), sorted(waiting))
+        self.assertEquals(4, len(result['adt']))
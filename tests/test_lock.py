@@ -1,12 +1,16 @@
 import unittest
 import mock
 import os
+import sys
 import gc
 import errno
+import tempfile
+import shutil
 
 import testlib
 
 import lock
+import lockstats
 
 
 class FailingOpenContext(testlib.TestContext):
@@ -57,6 +61,103 @@ class TestLock(unittest.TestCase):
                 os.path.join(lck.BASE_DIR, 'namespace', 'somename')))
 
 
+class TestLockStats(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, path in [('lock.Lock.BASE_DIR', 'lock'),
+                           ('lockstats.STATS_DIR', 'stats')]:
+            patcher = mock.patch(name, os.path.join(self.dir, path))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('lockstats.ENABLED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def stats(self):
+        return lockstats.getStats('ns')[('ns', 'sr')]
+
+    @mock.patch('lock.time')
+    def test_blocking_acquire_records_wait_and_holder(self, time):
+        time.time.side_effect = [100.0, 100.5, 101.0]
+        lck = lock.Lock('sr', 'ns')
+
+        lck.acquire()
+
+        self.assertEquals([str(os.getpid()), '100.500',
+                           os.path.basename(sys.argv[0]) + '\n'],
+                          open(lck.lockpath).read().split(' ', 2))
+        stats = self.stats()
+        self.assertEquals(1, stats['acquired'])
+        self.assertEquals(0, stats['contended'])
+        self.assertEquals(1.0, stats['wait_max'])
+        self.assertEquals(1, stats['waits'][lockstats._bucket(1.0)])
+
+        lck.release()
+
+        self.assertEquals('', open(lck.lockpath).read())
+
+    def test_contention_records_blocker(self):
+        lck = lock.Lock('sr', 'ns')
+        lck.lockfile.write('4242 100.0 LVMSR\n')
+        lck.lockfile.flush()
+
+        with mock.patch.object(lck.lock, 'trylock', return_value=False), \
+                mock.patch.object(lck.lock, 'test', return_value=4242):
+            self.assertFalse(lck.acquireNoblock())
+            lck.acquire()
+
+        stats = self.stats()
+        self.assertEquals(1, stats['tries'])
+        self.assertEquals(1, stats['failed'])
+        self.assertEquals(1, stats['acquired'])
+        self.assertEquals(1, stats['contended'])
+        self.assertEquals({'LVMSR': 1}, stats['blockers'])
+        lck.release()
+
+    def test_stats_accumulate_and_clear(self):
+        for i in range(3):
+            lockstats.recordTry('ns', 'sr', i != 1)
+
+        stats = self.stats()
+        self.assertEquals([3, 1, 2], [stats['tries'], stats['failed'],
+                                      stats['acquired']])
+
+        lockstats.clearStats()
+
+        self.assertEquals({}, lockstats.getStats())
+
+    def test_disabled_records_nothing(self):
+        with mock.patch('lockstats.ENABLED', False):
+            lck = lock.Lock('sr', 'ns')
+            lck.acquire()
+            lck.release()
+
+        self.assertEquals({}, lockstats.getStats())
+
+    def test_cleanup_removes_stats(self):
+        for name in ['sr', 'vdi-1', 'vdi-2']:
+            lockstats.recordTry('ns', name, True)
+
+        lock.Lock.cleanup('sr', 'ns')
+
+        self.assertEquals([('ns', 'vdi-1'), ('ns', 'vdi-2')],
+                          sorted(lockstats.getStats().keys()))
+
+        lock.Lock.cleanupAll('ns')
+
+        self.assertEquals({}, lockstats.getStats())
+        self.assertFalse(os.path.exists(os.path.join(lockstats.STATS_DIR,
+                                                     'ns')))
+
+    def test_bucket(self):
+        self.assertEquals(0, lockstats._bucket(0))
+        self.assertEquals(3, lockstats._bucket(0.5))
+        self.assertEquals(len(lockstats.WAIT_BUCKETS), lockstats._bucket(61))
+
+
 def create_lock_class_that_fails_to_create_file(number_of_failures):
 
     class LockThatFailsToCreateFile(lock.Lock):
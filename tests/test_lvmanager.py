@@ -0,0 +1,50 @@
+import unittest
+import mock
+
+import lvmanager
+
+
+class TestLVActivator(unittest.TestCase):
+    def setUp(self):
+        self.cache = mock.Mock()
+        self.cache.deactivateMulti.return_value = []
+        self.activator = lvmanager.LVActivator('sr', self.cache)
+
+    def test_chain_activation_is_recorded_on_success(self):
+        chain = [('leaf', 'VHD-leaf', True), ('base', 'VHD-base', False)]
+
+        self.activator.activateMulti(chain)
+
+        self.cache.activateMulti.assert_called_once_with('lvm-sr', chain)
+        self.assertEquals('VHD-leaf', self.activator.get('leaf', True))
+        self.assertEquals('VHD-base', self.activator.get('base', False))
+
+    def test_failed_chain_activation_is_not_recorded(self):
+        self.cache.activateMulti.side_effect = Exception('failed')
+
+        self.assertRaises(Exception, self.activator.activateMulti,
+                          [('leaf', 'VHD-leaf', False)])
+
+        self.assertEquals(None, self.activator.get('leaf', False))
+        self.assertTrue(self.activator.deactivateAll())
+        self.assertEquals(0, self.cache.deactivateMulti.call_count)
+
+    def test_repeated_activation_is_skipped(self):
+        self.activator.activate('base', 'VHD-base', False)
+
+        self.activator.activateMulti([('leaf', 'VHD-leaf', False),
+                                      ('base', 'VHD-base', False)])
+
+        self.cache.activateMulti.assert_called_once_with(
+            'lvm-sr', [('leaf', 'VHD-leaf', False)])
+
+    def test_deactivate_all_keeps_failed(self):
+        self.activator.add('leaf', 'VHD-leaf', True)
+        self.activator.add('base', 'VHD-base', False)
+        self.cache.deactivateMulti.return_value = [('base', 'VHD-base', False)]
+
+        self.assertFalse(self.activator.deactivateAll())
+
+        self.assertEquals(1, self.cache.deactivateMulti.call_count)
+        self.assertEquals(None, self.activator.get('leaf', True))
+        self.assertEquals('VHD-base', self.activator.get('base', False))
@@ -0,0 +1,220 @@
+import unittest
+import tempfile
+import shutil
+import mock
+
+import lvmcache
+import lvutil
+import util
+from refcounter import RefCounter
+
+
+LVS_OUTPUT = \
+    "  VHD-a VG_XenStorage-sr -wi-ao 8388608B                 \n" \
+    "  VHD-b VG_XenStorage-sr -ri--- 4194304B hidden          \n"
+
+
+class FakeLVM(object):
+    def __init__(self):
+        self.seqno = 7
+        self.dm = "VG_XenStorage--sr-VHD--a 1\n"
+        self.calls = []
+        self.lvchangeFails = False
+
+    def pread2(self, cmd):
+        self.calls.append(cmd[0])
+        if cmd[0] == lvutil.CMD_VGS:
+            return "  uuid-1 %d\n" % self.seqno
+        if cmd[0] == lvutil.CMD_LVS:
+            return LVS_OUTPUT
+        if cmd[0] == lvutil.CMD_DMSETUP:
+            return self.dm
+        if cmd[0] == lvutil.CMD_LVCHANGE and self.lvchangeFails:
+            raise util.CommandException(5, str(cmd), "failed")
+        if cmd[0] in [lvutil.CMD_LVCHANGE, lvutil.CMD_LVREMOVE]:
+            return ""
+        raise Exception("unexpected command %s" % cmd)
+
+
+class TestLVMCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        dir_patcher = mock.patch('lvmcache.CACHE_DIR', self.dir)
+        dir_patcher.start()
+        self.addCleanup(dir_patcher.stop)
+        self.lvm = FakeLVM()
+        for pread in ['util.pread', 'util.pread2']:
+            pread_patcher = mock.patch(pread, self.lvm.pread2)
+            pread_patcher.start()
+            self.addCleanup(pread_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def refresh(self):
+        cache = lvmcache.LVMCache("VG_XenStorage-sr")
+        cache.refresh()
+        return cache
+
+    def test_first_refresh_runs_lvs(self):
+        cache = self.refresh()
+
+        self.assertEquals([lvutil.CMD_VGS, lvutil.CMD_LVS], self.lvm.calls)
+        self.assertEquals(8388608, cache.getSize("VHD-a"))
+        self.assertTrue(cache.getHidden("VHD-b"))
+
+    def test_unchanged_vg_reuses_saved_lvs(self):
+        self.refresh()
+        self.lvm.calls = []
+
+        cache = self.refresh()
+
+        self.assertEquals([lvutil.CMD_VGS, lvutil.CMD_DMSETUP], self.lvm.calls)
+        self.assertEquals(4194304, cache.getSize("VHD-b"))
+        self.assertTrue(cache.lvs["VHD-b"].readonly)
+        self.assertTrue(cache.getHidden("VHD-b"))
+
+    def test_activation_state_comes_from_device_mapper(self):
+        self.refresh()
+        self.lvm.dm = "VG_XenStorage--sr-VHD--b 0\nother-lv 2\n"
+
+        cache = self.refresh()
+
+        self.assertFalse(cache.lvs["VHD-a"].active)
+        self.assertEquals(0, cache.lvs["VHD-a"].open)
+        self.assertTrue(cache.lvs["VHD-b"].active)
+        self.assertEquals(0, cache.lvs["VHD-b"].open)
+
+    def test_seqno_change_runs_lvs(self):
+        self.refresh()
+        self.lvm.seqno += 1
+        self.lvm.calls = []
+
+        self.refresh()
+
+        self.assertEquals([lvutil.CMD_VGS, lvutil.CMD_LVS], self.lvm.calls)
+
+    def test_vgs_failure_runs_lvs(self):
+        self.refresh()
+        self.lvm.calls = []
+        real = self.lvm.pread2
+
+        def pread2(cmd):
+            if cmd[0] == lvutil.CMD_VGS:
+                self.lvm.calls.append(cmd[0])
+                raise util.CommandException(5)
+            return real(cmd)
+
+        with mock.patch('util.pread2', pread2):
+            self.refresh()
+
+        self.assertEquals([lvutil.CMD_VGS, lvutil.CMD_LVS], self.lvm.calls)
+
+    @mock.patch('lvutil._lvmBugCleanup', autospec=True)
+    def test_multi_lv_changes_use_one_command(self, lvmBugCleanup):
+        cache = self.refresh()
+        self.lvm.calls = []
+
+        cache.setReadonlyMulti(["VHD-a", "VHD-b"], True)
+        cache.setHiddenMulti(["VHD-a"])
+        cache.removeMulti(["VHD-a", "VHD-b"])
+
+        # VHD-b is read-only already
+        self.assertEquals([lvutil.CMD_LVCHANGE, lvutil.CMD_LVCHANGE,
+                           lvutil.CMD_LVREMOVE], self.lvm.calls)
+        self.assertEquals([], cache.getTagged(lvutil.LV_TAG_HIDDEN))
+        self.assertFalse(cache.checkLV("VHD-a"))
+
+
+class TestLVMCacheMulti(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, path in [('lvmcache.CACHE_DIR', 'lvmcache'),
+                           ('refcounter.RefCounter.BASE_DIR', 'refcount'),
+                           ('lock.Lock.BASE_DIR', 'lock'),
+                           ('lockstats.STATS_DIR', 'lockstats')]:
+            patcher = mock.patch(name, '%s/%s' % (self.dir, path))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.lvm = FakeLVM()
+        for name, new in [('util.pread', self.lvm.pread2),
+                          ('util.pread2', self.lvm.pread2),
+                          ('util.SMlog', mock.Mock()),
+                          ('lvutil._checkActive', mock.Mock()),
+                          ('lvutil._lvmBugCleanup', mock.Mock())]:
+            patcher = mock.patch(name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache = lvmcache.LVMCache("VG_XenStorage-sr")
+        self.cache.refresh()
+        self.cache.lvs["VHD-a"].active = False
+        self.lvm.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_activate_chain_with_one_lvchange(self):
+        RefCounter.get("b", False, "ns")
+
+        self.cache.activateMulti("ns", [("a", "VHD-a", True),
+                                        ("b", "VHD-b", False)])
+
+        # VHD-b was referenced already
+        self.assertEquals([lvutil.CMD_LVCHANGE], self.lvm.calls)
+        self.assertTrue(self.cache.lvs["VHD-a"].active)
+        self.assertEquals((0, 1), RefCounter.check("a", "ns"))
+        self.assertEquals((2, 0), RefCounter.check("b", "ns"))
+
+    def test_failed_activation_is_undone(self):
+        self.lvm.lvchangeFails = True
+
+        self.assertRaises(util.CommandException, self.cache.activateMulti,
+                          "ns", [("a", "VHD-a", False),
+                                 ("b", "VHD-b", False)])
+
+        self.assertEquals((0, 0), RefCounter.check("a", "ns"))
+        self.assertEquals((0, 0), RefCounter.check("b", "ns"))
+
+    def test_undo_keeps_lvs_active_before(self):
+        self.lvm.lvchangeFails = True
+        self.cache.lvs["VHD-a"].active = True
+        self.cache.lvs["VHD-b"].active = False
+
+        def refresh():
+            # the activation of VHD-b went through before lvchange failed
+            self.cache.lvs["VHD-b"].active = True
+        self.cache.refresh = refresh
+        self.cache.deactivateNoRefcountMulti = mock.Mock()
+
+        self.assertRaises(util.CommandException, self.cache.activateMulti,
+                          "ns", [("a", "VHD-a", False),
+                                 ("b", "VHD-b", False)])
+
+        self.cache.deactivateNoRefcountMulti.assert_called_once_with(
+                ["VHD-b"])
+
+    def test_deactivate_unreferenced_lvs(self):
+        RefCounter.set("a", 1, 0, "ns")
+        RefCounter.set("b", 2, 0, "ns")
+        self.cache.lvs["VHD-a"].active = True
+        self.cache.lvs["VHD-a"].open = 0
+
+        failed = self.cache.deactivateMulti("ns", [("a", "VHD-a", False),
+                                                   ("b", "VHD-b", False)])
+
+        self.assertEquals([], failed)
+        self.assertEquals([lvutil.CMD_LVCHANGE, lvutil.CMD_DMSETUP],
+                          self.lvm.calls)
+        self.assertFalse(self.cache.lvs["VHD-a"].active)
+        self.assertEquals((1, 0), RefCounter.check("b", "ns"))
+
+    @mock.patch('lvutil.LVM_FAIL_RETRIES', 1)
+    def test_failed_deactivation_restores_refcount(self):
+        RefCounter.set("a", 1, 0, "ns")
+        self.lvm.lvchangeFails = True
+        self.lvm.dm = "VG_XenStorage--sr-VHD--a 0\n"
+
+        failed = self.cache.deactivateMulti("ns", [("a", "VHD-a", False)])
+
+        self.assertEquals([("a", "VHD-a", False)], failed)
+        self.assertEquals((1, 0), RefCounter.check("a", "ns"))
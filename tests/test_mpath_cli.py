@@ -0,0 +1,40 @@
+import unittest
+import mock
+
+import mpath_cli
+
+
+TOPOLOGY = \
+    "multipathd> show topology\n" \
+    "3600a0b80001 dm-1 NETAPP,LUN\n" \
+    "size=10G features='0' hwhandler='0' wp=rw\n" \
+    "|-+- policy='round-robin 0' prio=1 status=active\n" \
+    "| |- 2:0:0:1 sdb 8:16 active ready running\n" \
+    "| `- 3:0:0:1 sdc 8:32 failed faulty running\n" \
+    "mpathb (3600a0b80002) dm-2 NETAPP,LUN\n" \
+    "size=20G features='0' hwhandler='0' wp=rw\n" \
+    "`-+- policy='round-robin 0' prio=1 status=active\n" \
+    "  `- 2:0:0:2 sdd 8:48 active ready running\n" \
+    "multipathd> "
+
+
+class TestTopologies(unittest.TestCase):
+    @mock.patch('util.SMlog', autospec=True)
+    @mock.patch('util.doexec', autospec=True)
+    def test_one_command_for_all_maps(self, doexec, SMlog):
+        doexec.return_value = (0, TOPOLOGY, '')
+
+        topologies = mpath_cli.get_topologies()
+
+        self.assertEquals(1, doexec.call_count)
+        self.assertEquals(['3600a0b80001', '3600a0b80002', 'mpathb'],
+                          sorted(topologies.keys()))
+        self.assertEquals(5, len(topologies['3600a0b80001']))
+        self.assertTrue(topologies['3600a0b80001'][4].endswith(
+            'failed faulty running'))
+        self.assertTrue(topologies['3600a0b80002'] is topologies['mpathb'])
+        self.assertEquals(4, len(topologies['mpathb']))
+
+    def test_lines_before_first_map_are_ignored(self):
+        self.assertEquals({}, mpath_cli.split_topologies(
+            ['show topology', 'size=10G features=0', '  `- 2:0:0:2 sdd']))
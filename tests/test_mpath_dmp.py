@@ -0,0 +1,32 @@
+import unittest
+import mock
+
+import mpath_dmp
+
+
+class TestWaitForPaths(unittest.TestCase):
+    def setUp(self):
+        for name in ['util.SMlog', 'scsiutil.settle', 'time.sleep']:
+            patcher = mock.patch('mpath_dmp.' + name)
+            setattr(self, name.split('.')[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    @mock.patch('mpath_dmp.scsiutil._genReverseSCSIidmap', autospec=True)
+    def test_returns_once_all_paths_appear(self, genReverseSCSIidmap):
+        genReverseSCSIidmap.side_effect = [['sdb'], ['sdb'], ['sdb', 'sdc']]
+
+        devices = mpath_dmp._wait_for_paths('sid', 2, 60)
+
+        self.assertEquals(['sdb', 'sdc'], devices)
+        self.assertEquals(2, self.settle.call_count)
+        self.assertEquals([mock.call(0.2), mock.call(0.4)],
+                          self.sleep.call_args_list)
+
+    @mock.patch('mpath_dmp.scsiutil._genReverseSCSIidmap', autospec=True)
+    def test_gives_up_at_timeout(self, genReverseSCSIidmap):
+        genReverseSCSIidmap.return_value = ['sdb']
+
+        devices = mpath_dmp._wait_for_paths('sid', 2, 0)
+
+        self.assertEquals(['sdb'], devices)
+        self.assertEquals(0, self.settle.call_count)
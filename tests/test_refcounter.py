@@ -1,5 +1,6 @@
 import unittest
-import testlib
+import tempfile
+import shutil
 import os
 import mock
 import errno
@@ -8,73 +9,107 @@ import refcounter
 
 
 class TestRefCounter(unittest.TestCase):
-    @testlib.with_context
-    def test_get_whencalled_creates_namespace(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
-
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        dir_patcher = mock.patch('refcounter.RefCounter.BASE_DIR',
+                                 os.path.join(self.dir, 'refcount'))
+        dir_patcher.start()
+        self.addCleanup(dir_patcher.stop)
+        log_patcher = mock.patch('util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def table(self, ns):
+        path = os.path.join(refcounter.RefCounter.BASE_DIR, ns + '.table')
+        return [line.split() for line in open(path)]
+
+    def test_get_whencalled_creates_namespace(self):
         refcounter.RefCounter.get('not-important', False, 'somenamespace')
 
         self.assertEquals(
-            ['somenamespace'],
+            ['somenamespace.table'],
             os.listdir(os.path.join(refcounter.RefCounter.BASE_DIR)))
 
-    @testlib.with_context
-    def test_get_whencalled_returns_counters(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
-
+    def test_get_whencalled_returns_counters(self):
         result = refcounter.RefCounter.get(
             'not-important', False, 'somenamespace')
 
         self.assertEquals(1, result)
 
-    @testlib.with_context
-    def test_get_whencalled_creates_refcounter_file(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
-
-        refcounter.RefCounter.get('someobject', False, 'somenamespace')
-
-        self.assertEquals(
-            ['someobject'],
-            os.listdir(os.path.join(
-                refcounter.RefCounter.BASE_DIR, 'somenamespace')))
-
-    @testlib.with_context
-    def test_get_whencalled_refcounter_file_contents(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
-
+    def test_get_whencalled_refcounter_table_contents(self):
         refcounter.RefCounter.get('someobject', False, 'somenamespace')
 
-        path_to_refcounter = os.path.join(
-            refcounter.RefCounter.BASE_DIR, 'somenamespace', 'someobject')
-
-        refcounter_file = open(path_to_refcounter, 'r')
-        contents = refcounter_file.read()
-        refcounter_file.close()
-
-        self.assertEquals('1 0\n', contents)
-
-    @testlib.with_context
-    def test_put_is_noop_if_already_zero(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
+        self.assertEquals([['someobject', '1', '0']],
+                          self.table('somenamespace'))
 
+    def test_put_is_noop_if_already_zero(self):
         result = refcounter.RefCounter.put(
             'someobject', False, 'somenamespace')
 
         self.assertEquals(0, result)
 
-    @testlib.with_context
-    def test_writeCount_returns_true_if_file_found(self, context):
-        os.makedirs('/existing')
-
-        result = refcounter.RefCounter._writeCount('/existing/file', 1, 1)
-
-        self.assertTrue(result)
-
-    @testlib.with_context
-    def test_writeCount_returns_false_if_file_not_found(self, context):
-        result = refcounter.RefCounter._writeCount('/nonexisting/file', 1, 1)
-
-        self.assertFalse(result)
+    def test_check_does_not_create_table(self):
+        self.assertEquals((0, 0),
+                          refcounter.RefCounter.check('someobject', 'ns'))
+        self.assertFalse(os.path.exists(refcounter.RefCounter.BASE_DIR))
+
+    def test_multi_updates_table_once(self):
+        chain = [('leaf', True), ('parent', False), ('base', False)]
+        refcounter.RefCounter.get('parent', False, 'ns')
+
+        with mock.patch('refcounter.RefCounter._openTable',
+                        side_effect=refcounter.RefCounter._openTable) as open:
+            self.assertEquals([1, 2, 1],
+                              refcounter.RefCounter.getMulti(chain, 'ns'))
+            self.assertEquals([0, 1, 0],
+                              refcounter.RefCounter.putMulti(chain, 'ns'))
+
+        self.assertEquals(2, open.call_count)
+        self.assertEquals((1, 0), refcounter.RefCounter.check('parent', 'ns'))
+        self.assertEquals((0, 0), refcounter.RefCounter.check('leaf', 'ns'))
+
+    def test_free_records_are_reused_and_trimmed(self):
+        for obj in ['a', 'b', 'c']:
+            refcounter.RefCounter.get(obj, False, 'ns')
+
+        refcounter.RefCounter.put('a', False, 'ns')
+        self.assertEquals([[], ['b', '1', '0'], ['c', '1', '0']],
+                          self.table('ns'))
+
+        refcounter.RefCounter.set('d', 3, 1, 'ns')
+        self.assertEquals([['d', '3', '1'], ['b', '1', '0'], ['c', '1', '0']],
+                          self.table('ns'))
+
+        refcounter.RefCounter.reset('c', 'ns')
+        refcounter.RefCounter.reset('b', 'ns')
+        self.assertEquals([['d', '3', '1']], self.table('ns'))
+
+    def test_resetAll_removes_tables(self):
+        refcounter.RefCounter.get('a', False, 'ns1')
+        refcounter.RefCounter.get('a', True, 'ns2')
+
+        refcounter.RefCounter.resetAll()
+
+        self.assertEquals([], os.listdir(refcounter.RefCounter.BASE_DIR))
+        self.assertEquals((0, 0), refcounter.RefCounter.check('a', 'ns2'))
+
+    def test_pre_table_counts_are_migrated(self):
+        nsDir = os.path.join(refcounter.RefCounter.BASE_DIR, 'ns')
+        os.makedirs(nsDir)
+        for obj, counts in [('a', '2 1\n'), ('b', '1 0\n')]:
+            f = open(os.path.join(nsDir, obj), 'w')
+            f.write(counts)
+            f.close()
+
+        self.assertEquals((2, 1), refcounter.RefCounter.check('a', 'ns'))
+        self.assertEquals(2, refcounter.RefCounter.get('b', False, 'ns'))
+
+        self.assertFalse(os.path.exists(nsDir))
+        self.assertEquals([['a', '2', '1'], ['b', '2', '0']],
+                          sorted(self.table('ns')))
 
     @mock.patch('os.rmdir')
     @mock.patch('os.unlink')
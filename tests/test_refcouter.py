@@ -1,60 +1,50 @@
 import unittest
-import testlib
+import tempfile
+import shutil
 import os
+import mock
 
 import refcounter
 
 
 class TestRefCounter(unittest.TestCase):
-    @testlib.with_context
-    def test_get_whencalled_creates_namespace(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        dir_patcher = mock.patch('refcounter.RefCounter.BASE_DIR', self.dir)
+        dir_patcher.start()
+        self.addCleanup(dir_patcher.stop)
 
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_whencalled_creates_namespace(self):
         refcounter.RefCounter.get('not-important', False, 'somenamespace')
 
         self.assertEquals(
-            ['somenamespace'],
+            ['somenamespace.table'],
             os.listdir(os.path.join(refcounter.RefCounter.BASE_DIR)))
 
-    @testlib.with_context
-    def test_get_whencalled_returns_counters(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
-
+    def test_get_whencalled_returns_counters(self):
         result = refcounter.RefCounter.get('not-important', False, 'somenamespace')
 
         self.assertEquals(1, result)
 
-    @testlib.with_context
-    def test_get_whencalled_creates_refcounter_file(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
-
+    def test_get_whencalled_creates_refcounter_record(self):
         refcounter.RefCounter.get('someobject', False, 'somenamespace')
 
         self.assertEquals(
-            ['someobject'],
-            os.listdir(os.path.join(
-                refcounter.RefCounter.BASE_DIR, 'somenamespace')))
-
-    @testlib.with_context
-    def test_get_whencalled_refcounter_file_contents(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
+            (1, 0),
+            refcounter.RefCounter.check('someobject', 'somenamespace'))
 
+    def test_get_whencalled_refcounter_table_contents(self):
         refcounter.RefCounter.get('someobject', False, 'somenamespace')
 
-        path_to_refcounter = os.path.join(
-            refcounter.RefCounter.BASE_DIR, 'somenamespace', 'someobject')
-
-        refcounter_file = open(path_to_refcounter, 'r')
-        contents = refcounter_file.read()
-        refcounter_file.close()
-
-        self.assertEquals('1 0\n', contents)
-
-    @testlib.with_context
-    def test_put_is_noop_if_already_zero(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
+        path_to_table = os.path.join(
+            refcounter.RefCounter.BASE_DIR, 'somenamespace.table')
 
-        result = refcounter.RefCounter.put(
-            'someobject', False, 'somenamespace')
+        table = open(path_to_table, 'r')
+        contents = table.read()
+        table.close()
 
-        self.assertEquals(0, result)
+        self.assertEquals(refcounter.RefCounter.RECORD_SIZE, len(contents))
+        self.assertEquals(['someobject', '1', '0'], contents.split())
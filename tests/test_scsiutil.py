@@ -1,5 +1,9 @@
 import unittest
+import tempfile
+import shutil
+import hashlib
 import mock
+import os
 
 import scsiutil
 
@@ -30,3 +34,86 @@ class Test_sg_readcap(unittest.TestCase):
                     "0x283d8e000 0x200\n")
         doexec.return_value = (0, fake_out, '')
         self.verify_sg_readcap(doexec, 5530605060096)
+
+
+def designator(code_set, assoc_type, data):
+    return chr(code_set) + chr(assoc_type) + '\0' + chr(len(data)) + data
+
+
+def vpd_page(code, data):
+    return '\0' + chr(code) + chr(len(data) >> 8) + chr(len(data) & 0xff) + \
+        data
+
+
+NAA6 = '\x60\x01\x40\x50\x12\x34\x56\x78' \
+    '\x9a\xbc\xde\xf0\x12\x34\x56\x78'
+NAA5 = '\x50\x01\x40\x50\x12\x34\x56\x78'
+
+
+class TestSysfsIdentity(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        patcher = mock.patch('scsiutil.SYSFS_BLOCK', self.dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pread2_patcher = mock.patch('util.pread2', autospec=True)
+        self.pread2 = pread2_patcher.start()
+        self.addCleanup(pread2_patcher.stop)
+        smlog_patcher = mock.patch('util.SMlog', autospec=True)
+        smlog_patcher.start()
+        self.addCleanup(smlog_patcher.stop)
+
+    def add_attr(self, dev, name, data):
+        path = os.path.join(self.dir, dev, 'device')
+        if not os.path.exists(path):
+            os.makedirs(path)
+        f = open(os.path.join(path, name), 'wb')
+        f.write(data)
+        f.close()
+
+    @mock.patch('scsiutil.rawdev', lambda path: path.split('/')[-1])
+    def test_SCSIid_from_vpd_page(self):
+        # scsi_id prefers the NAA IEEE registered extended designator
+        self.add_attr('sdb', 'vpd_pg83', vpd_page(0x83,
+            designator(2, 0x01, 'LIO-ORG disk') +
+            designator(1, 0x13, NAA6) +
+            designator(1, 0x03, NAA5) +
+            designator(1, 0x03, NAA6)))
+
+        self.assertEquals('36001405012345678' + '9abcdef012345678',
+                          scsiutil.getSCSIid('/dev/sdb'))
+        self.assertEquals(0, self.pread2.call_count)
+
+    @mock.patch('scsiutil.rawdev', lambda path: path.split('/')[-1])
+    def test_other_designators_use_scsi_id(self):
+        self.add_attr('sdb', 'vpd_pg83', vpd_page(0x83,
+            designator(2, 0x01, 'LIO-ORG disk')))
+        self.pread2.return_value = '1LIO-ORG disk\n'
+
+        self.assertEquals('1LIO-ORG_disk', scsiutil.getSCSIid('/dev/sdb'))
+        self.assertEquals(1, self.pread2.call_count)
+
+    @mock.patch('scsiutil.rawdev', lambda path: path.split('/')[-1])
+    def test_missing_vpd_page_uses_scsi_id(self):
+        self.pread2.return_value = '3600a0b80\n'
+
+        self.assertEquals('3600a0b80', scsiutil.getSCSIid('/dev/sdc'))
+
+    @mock.patch('scsiutil.rawdev', lambda path: path.split('/')[-1])
+    def test_uniqueserial_is_md5_of_SCSIid(self):
+        self.add_attr('sdb', 'vpd_pg83', vpd_page(0x83,
+            designator(1, 0x03, NAA5)))
+
+        self.assertEquals(hashlib.md5('35001405012345678').hexdigest(),
+                          scsiutil.getuniqueserial('/dev/sdb'))
+
+    @mock.patch('scsiutil.getdev', lambda path: path.split('/')[-1])
+    @mock.patch('scsiutil.rawdev', lambda path: path.split('/')[-1])
+    def test_serial_and_vendor(self):
+        self.add_attr('sdb', 'vpd_pg80', vpd_page(0x80, ' 1234 5678  '))
+        self.add_attr('sdb', 'vendor', 'NETAPP  \n')
+
+        self.assertEquals('12345678', scsiutil.getserial('/dev/sdb'))
+        self.assertEquals('NETAPP', scsiutil.getmanufacturer('/dev/sdb'))
+        self.assertEquals(0, self.pread2.call_count)
@@ -0,0 +1,113 @@
+import unittest
+import tempfile
+import shutil
+import mock
+import os
+
+import smtrace
+
+
+class TestSpans(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'SMtrace')
+        for name, new in [('smtrace.TRACE_FILE', self.path),
+                          ('smtrace.ENABLED', True)]:
+            patcher = mock.patch(name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def lines(self):
+        if not os.path.exists(self.path):
+            return []
+        return [line.split() for line in open(self.path)]
+
+    def test_nested_spans_are_written_when_root_ends(self):
+        root = smtrace.Span(smtrace.TYPE_OP, 'vdi_attach')
+        child = smtrace.Span(smtrace.TYPE_EXEC, 'lvchange')
+        child.end()
+        self.assertEquals([], self.lines())
+
+        root.end()
+
+        lines = self.lines()
+        self.assertEquals(['op', 'vdi_attach'], lines[0][4:6])
+        self.assertEquals(['exec', 'lvchange'], lines[1][4:6])
+        self.assertEquals(lines[0][2], lines[1][3])
+        self.assertEquals('0', lines[0][3])
+
+    def test_ending_root_ends_open_children(self):
+        root = smtrace.Span(smtrace.TYPE_OP, 'sr_scan')
+        smtrace.Span(smtrace.TYPE_LOCK, 'sr/x')
+
+        root.end()
+        smtrace.Span(smtrace.TYPE_OP, 'sr_scan').end()
+
+        lines = self.lines()
+        self.assertEquals(2, len(lines))
+        self.assertEquals('0', lines[1][3])
+
+    def test_forked_child_writes_its_own_spans(self):
+        root = smtrace.Span(smtrace.TYPE_OP, 'sr_scan')
+        pid = os.fork()
+        if not pid:
+            try:
+                smtrace.reset()
+                smtrace.Span(smtrace.TYPE_EXEC, 'vhd-util').end()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEquals([['exec', 'vhd-util', '0']],
+                          [line[4:6] + [line[3]] for line in self.lines()])
+        root.end()
+        self.assertEquals(2, len(self.lines()))
+
+    def test_disabled(self):
+        with mock.patch('smtrace.ENABLED', False):
+            smtrace.Span(smtrace.TYPE_OP, 'sr_scan').end()
+
+        self.assertEquals([], self.lines())
+
+    def test_trace_session(self):
+        session = mock.Mock()
+        request = session.xenapi_request
+
+        smtrace.traceSession(session)
+        session.xenapi_request('VDI.get_record', ('ref',))
+
+        request.assert_called_once_with('VDI.get_record', ('ref',))
+        self.assertEquals([['xapi', 'VDI.get_record']],
+                          [line[4:6] for line in self.lines()])
+
+    @mock.patch('time.time', autospec=True)
+    def test_read_spans_and_summarise(self, time):
+        uuid = 'c0f8a6e2-8a5f-4b8d-9e6a-0e5c7e3f2a11'
+        for start, name, duration in [(100, 'vdi_attach', 0.2),
+                                      (200, 'lvchange', 0.1),
+                                      (300, 'lvchange', 0.3),
+                                      (400, 'tap-ctl', 0.05)]:
+            time.side_effect = [start, start + duration]
+            span = smtrace.Span(smtrace.TYPE_EXEC, '%s-%s' % (name, uuid))
+            span.end()
+
+        spans = smtrace.readSpans([self.path + '.1', self.path], since=200)
+        rows = smtrace.summarise(spans)
+
+        self.assertEquals(3, len(spans))
+        self.assertEquals(('exec', 'lvchange-<uuid>', 2), rows[0][:3])
+        self.assertAlmostEquals(0.1, rows[0][3])
+        self.assertAlmostEquals(0.3, rows[0][4])
+        self.assertAlmostEquals(0.4, rows[0][6])
+        self.assertEquals([], smtrace.summarise(spans, smtrace.TYPE_LOCK))
+
+    def test_percentile(self):
+        values = range(1, 101)
+
+        self.assertEquals(50, smtrace.percentile(values, 50))
+        self.assertEquals(99, smtrace.percentile(values, 99))
+        self.assertEquals(1, smtrace.percentile(values, 0))
+        self.assertEquals(7, smtrace.percentile([7], 99))
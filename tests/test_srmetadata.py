@@ -0,0 +1,170 @@
+import unittest
+import tempfile
+import shutil
+import mock
+import os
+
+import srmetadata
+
+
+def vdi_info(uuid, label='label'):
+    return {srmetadata.UUID_TAG: uuid,
+            srmetadata.NAME_LABEL_TAG: label,
+            srmetadata.NAME_DESCRIPTION_TAG: 'description',
+            srmetadata.IS_A_SNAPSHOT_TAG: '0',
+            srmetadata.SNAPSHOT_OF_TAG: '',
+            srmetadata.SNAPSHOT_TIME_TAG: '',
+            srmetadata.TYPE_TAG: 'user',
+            srmetadata.VDI_TYPE_TAG: 'vhd',
+            srmetadata.READ_ONLY_TAG: '0',
+            srmetadata.MANAGED_TAG: '1',
+            srmetadata.METADATA_OF_POOL_TAG: ''}
+
+
+class TestMetadataSlotIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'MGT')
+        open(self.path, 'w').close()
+        srmetadata.MetadataHandler.slotIndexes.clear()
+        sr_info = {srmetadata.UUID_TAG: 'sr-uuid',
+                   srmetadata.NAME_LABEL_TAG: 'sr',
+                   srmetadata.NAME_DESCRIPTION_TAG: ''}
+        vdis = {}
+        for i in range(5):
+            vdis[i] = vdi_info('vdi-%d' % i)
+        self.handler().writeMetadata(sr_info, vdis)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def handler(self):
+        return srmetadata.SLMetadataHandler(self.path)
+
+    def vdis(self):
+        vdis = self.handler().getMetadata()[1]
+        return dict((v[srmetadata.UUID_TAG], v) for v in vdis.values())
+
+    def test_update_delete_add(self):
+        self.handler().updateMetadata({
+            srmetadata.METADATA_UPDATE_OBJECT_TYPE_TAG: 'vdi',
+            srmetadata.UUID_TAG: 'vdi-2',
+            srmetadata.NAME_LABEL_TAG: 'renamed'})
+        self.handler().deleteVdiFromMetadata('vdi-1')
+        self.handler().addVdi(vdi_info('vdi-new'))
+        self.handler().addVdi(vdi_info('vdi-last'))
+
+        vdis = self.vdis()
+        self.assertEquals(['vdi-0', 'vdi-2', 'vdi-3', 'vdi-4', 'vdi-last',
+                           'vdi-new'], sorted(vdis.keys()))
+        self.assertEquals('renamed',
+                          vdis['vdi-2'][srmetadata.NAME_LABEL_TAG])
+        # the deleted slot is reused before the metadata grows
+        self.assertEquals(vdis['vdi-0'][srmetadata.OFFSET_TAG] + 1024,
+                          vdis['vdi-new'][srmetadata.OFFSET_TAG])
+
+    def test_deleting_last_vdi_shrinks_metadata(self):
+        handler = self.handler()
+        length = srmetadata.getMetadataLength(handler.fd)
+
+        handler.deleteVdiFromMetadata('vdi-4')
+
+        self.assertEquals(length - 1024,
+                          srmetadata.getMetadataLength(handler.fd))
+        self.assertEquals(4, len(self.vdis()))
+
+    @mock.patch('util.gen_uuid', autospec=True)
+    def test_single_vdi_operations_read_metadata_once(self, gen_uuid):
+        gen_uuid.return_value = 'dummy-uuid'
+        real = srmetadata.MetadataHandler.getMetadataInternal
+        with mock.patch('srmetadata.MetadataHandler.getMetadataInternal',
+                        autospec=True, side_effect=real) as full_read:
+            for i in range(5):
+                self.handler().updateMetadata({
+                    srmetadata.METADATA_UPDATE_OBJECT_TYPE_TAG: 'vdi',
+                    srmetadata.UUID_TAG: 'vdi-%d' % i,
+                    srmetadata.NAME_LABEL_TAG: 'new-%d' % i})
+            self.handler().deleteVdiFromMetadata('vdi-3')
+            self.handler().ensureSpaceIsAvailableForVdis(1)
+            self.handler().addVdi(vdi_info('vdi-new'))
+
+        self.assertEquals(1, full_read.call_count)
+        self.assertEquals('new-4',
+                          self.vdis()['vdi-4'][srmetadata.NAME_LABEL_TAG])
+
+    def test_stale_index_is_rebuilt(self):
+        self.handler().updateMetadata({
+            srmetadata.METADATA_UPDATE_OBJECT_TYPE_TAG: 'vdi',
+            srmetadata.UUID_TAG: 'vdi-0',
+            srmetadata.NAME_LABEL_TAG: 'x'})
+        # another process swaps two VDIs behind our index
+        vdis = self.handler().getMetadata()[1]
+        offsets = sorted(vdis.keys())
+        handler = self.handler()
+        handler.writeVdiSlot(offsets[0], vdi_info('vdi-1'))
+        handler.writeVdiSlot(offsets[1], vdi_info('vdi-0'))
+
+        self.handler().updateMetadata({
+            srmetadata.METADATA_UPDATE_OBJECT_TYPE_TAG: 'vdi',
+            srmetadata.UUID_TAG: 'vdi-0',
+            srmetadata.NAME_LABEL_TAG: 'moved'})
+
+        vdis = self.vdis()
+        self.assertEquals('moved', vdis['vdi-0'][srmetadata.NAME_LABEL_TAG])
+        self.assertEquals('label', vdis['vdi-1'][srmetadata.NAME_LABEL_TAG])
+
+    def test_update_of_missing_vdi_fails(self):
+        self.assertRaises(Exception, self.handler().updateMetadata, {
+            srmetadata.METADATA_UPDATE_OBJECT_TYPE_TAG: 'vdi',
+            srmetadata.UUID_TAG: 'no-such-vdi',
+            srmetadata.NAME_LABEL_TAG: 'x'})
+
+
+class TestDecodeVdiSlot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'MGT')
+        open(path, 'w').close()
+        self.handler = srmetadata.SLMetadataHandler(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def slot(self, label, description='description', **extra):
+        info = vdi_info('vdi-uuid', label)
+        info[srmetadata.NAME_DESCRIPTION_TAG] = description
+        info.update(extra)
+        return self.handler.getVdiInfo(info)
+
+    def dom(self, slot):
+        return srmetadata.metadata._parseXML('%s<%s>%s</%s>' % (
+            srmetadata.XML_HEADER, srmetadata.metadata.XML_TAG, slot,
+            srmetadata.metadata.XML_TAG))[srmetadata.VDI_TAG]
+
+    @mock.patch('util.SMlog')
+    def test_matches_dom_parser(self, SMlog):
+        for slot in [self.slot('plain'),
+                     self.slot('a & b <c> "d" \'e\'', ''),
+                     self.slot(u'caf\xe9 \u2603'.encode('utf-8'), '   '),
+                     self.slot('  padded  ', snapshot_time='')]:
+            self.assertEquals(self.dom(slot), srmetadata.decodeVdiSlot(slot))
+
+    def test_unsupported_slots_are_left_to_dom_parser(self):
+        for slot in ['<vdi><name_label>caf&#233;</name_label></vdi>',
+                     '<vdi><name_label><b>x</b></name_label></vdi>',
+                     '<vdi>text<uuid>x</uuid></vdi>',
+                     '<vdi><uuid>x</uuid>',
+                     '<vdi><uuid>\xff</uuid></vdi>']:
+            self.assertEquals(None, srmetadata.decodeVdiSlot(slot))
+
+    @mock.patch('srmetadata.metadata._parseXML', autospec=True)
+    @mock.patch('util.SMlog')
+    def test_parse_does_not_build_dom(self, SMlog, parseXML):
+        slot = self.slot('label').ljust(1024, '\x00')
+
+        info = self.handler.parseVdiInfo(slot, 2048)
+
+        self.assertEquals(0, parseXML.call_count)
+        self.assertEquals('label', info[srmetadata.NAME_LABEL_TAG])
+        self.assertEquals('0', info[srmetadata.VDI_DELETED_TAG])
+        self.assertEquals(2048, info[srmetadata.OFFSET_TAG])
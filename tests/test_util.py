@@ -0,0 +1,214 @@
+import unittest
+import threading
+import errno
+import collections
+import mock
+
+import util
+
+
+class TestCallOnHosts(unittest.TestCase):
+    def setUp(self):
+        for name, new in [('util._thread_session', lambda session: session),
+                          ('util.SMlog', mock.Mock())]:
+            patcher = mock.patch(name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_calls_run_concurrently(self):
+        hosts = ['host-%d' % i for i in range(4)]
+        started = threading.Semaphore(0)
+        release = threading.Event()
+
+        def call(session, host):
+            started.release()
+            release.wait(5)
+            return host.upper()
+
+        def releaser():
+            for host in hosts:
+                started.acquire()
+            release.set()
+        threading.Thread(target=releaser).start()
+
+        results = util.call_on_hosts(mock.Mock(), hosts, call)
+
+        self.assertTrue(release.is_set())
+        self.assertEquals(dict((host, (True, host.upper()))
+                               for host in hosts), results)
+
+    def test_workers_are_bounded(self):
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def call(session, host):
+            lock.acquire()
+            running.append(host)
+            most.append(len(running))
+            lock.release()
+            threading.Event().wait(0.01)
+            lock.acquire()
+            running.remove(host)
+            lock.release()
+
+        util.call_on_hosts(mock.Mock(), range(10), call, workers=3)
+
+        self.assertEquals(10, len(most))
+        self.assertTrue(max(most) <= 3)
+
+    def test_slow_host_times_out(self):
+        release = threading.Event()
+        finished = threading.Event()
+        self.addCleanup(finished.wait, 5)
+        self.addCleanup(release.set)
+
+        def call(session, host):
+            if host == 'slow':
+                release.wait(5)
+                finished.set()
+            return host
+
+        results = util.call_on_hosts(mock.Mock(), ['slow', 'fast'], call,
+                                     timeout=0.05)
+
+        self.assertEquals((True, 'fast'), results['fast'])
+        ok, e = results['slow']
+        self.assertFalse(ok)
+        self.assertEquals(errno.ETIMEDOUT, e.code)
+
+    def test_single_host_uses_session(self):
+        session = mock.Mock()
+        call = mock.Mock(return_value='ok')
+
+        results = util.call_on_hosts(session, ['host'], call)
+
+        call.assert_called_once_with(session, 'host')
+        self.assertEquals({'host': (True, 'ok')}, results)
+
+    def test_check_host_results(self):
+        failure = Exception('failed')
+        results = {'a': (True, None), 'b': (False, failure)}
+
+        util.check_host_results(results, ['b'])
+        try:
+            util.check_host_results(results)
+        except Exception, e:
+            self.assertEquals(failure, e)
+        else:
+            self.fail('no exception raised')
+
+
+class TestRunParallelFirst(unittest.TestCase):
+    def test_returns_without_waiting_for_later_items(self):
+        release = threading.Event()
+        finished = threading.Event()
+        self.addCleanup(finished.wait, 5)
+        self.addCleanup(release.set)
+
+        def func(item):
+            if item == 'slow':
+                release.wait(5)
+                finished.set()
+
+        self.assertEquals('fast', util.run_parallel_first(
+            func, ['fast', 'slow'], 2))
+        self.assertFalse(release.is_set())
+
+    def test_first_in_order_wins(self):
+        started = threading.Semaphore(0)
+        release = threading.Event()
+
+        def func(item):
+            started.release()
+            if item == 'a':
+                release.wait(5)
+                raise Exception('down')
+            if item == 'b':
+                release.wait(5)
+
+        def releaser():
+            for i in range(3):
+                started.acquire()
+            release.set()
+        threading.Thread(target=releaser).start()
+
+        # c answers first, but b comes before it
+        self.assertEquals('b', util.run_parallel_first(
+            func, ['a', 'b', 'c'], 3))
+
+    def test_all_fail(self):
+        def func(item):
+            raise Exception('down')
+
+        self.assertEquals(None, util.run_parallel_first(func, ['a', 'b'], 1))
+        self.assertEquals(None, util.run_parallel_first(func, [], 1))
+
+
+class TestPBDIndex(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.Mock()
+        xenapi = self.session.xenapi
+        # PBD-1 comes first, to check that the search goes on past it
+        xenapi.PBD.get_all_records.return_value = collections.OrderedDict([
+            ('pbd-1', {'SR': 'sr-1', 'host': 'host-1',
+                       'device_config': {'SCSIid': 'id-1'}}),
+            ('pbd-2', {'SR': 'sr-2', 'host': 'host-1',
+                       'device_config': {'device': '/dev/sdb,/dev/sdc'}}),
+            ('pbd-3', {'SR': 'sr-3', 'host': 'host-2',
+                       'device_config': {'targetIQN': 'iqn', 'LUNid': '0'}})])
+        xenapi.SR.get_all_records.return_value = {
+            'sr-1': {'sm_config': {}},
+            'sr-2': {'sm_config': {'SCSIid': 'id-2'}},
+            'sr-3': {'sm_config': {'scsi-id-3': 'sdd'}},
+            'sr-4': {'sm_config': {'SCSIid': 'id-4'}}}
+        xenapi.SR.get_by_uuid.side_effect = lambda uuid: 'sr-' + uuid
+
+    def test_SCSIids_from_device_and_sm_config(self):
+        index = util.PBDIndex(self.session)
+
+        for SCSIid in ['id-1', 'id-2', 'id-3']:
+            self.assertTrue(util.test_SCSIid(self.session, None, SCSIid,
+                                             index))
+        # SRs without a PBD do not count
+        self.assertFalse(util.test_SCSIid(self.session, None, 'id-4', index))
+        self.assertFalse(util.test_SCSIid(self.session, '1', 'id-1', index))
+        self.assertTrue(util.test_SCSIid(self.session, '3', 'id-1', index))
+
+    def test_SCSIid_search_skips_own_pbd(self):
+        index = util.PBDIndex(self.session)
+
+        self.assertTrue(util.test_SCSIid(self.session, '1', 'id-2', index))
+        self.assertFalse(util.test_SCSIid(self.session, '2', 'id-2', index))
+
+    def test_records_are_fetched_once(self):
+        index = util.PBDIndex(self.session)
+
+        for i in range(100):
+            util.test_SCSIid(self.session, None, 'id-%d' % i, index)
+
+        xenapi = self.session.xenapi
+        self.assertEquals(1, xenapi.PBD.get_all_records.call_count)
+        self.assertEquals(1, xenapi.SR.get_all_records.call_count)
+        self.assertEquals(0, xenapi.SR.get_sm_config.call_count)
+
+    def test_nothing_is_fetched_until_needed(self):
+        util.PBDIndex(self.session)
+
+        self.assertEquals(0, self.session.xenapi.PBD.get_all_records.call_count)
+
+    @mock.patch('util.get_this_host_ref', autospec=True)
+    def test_host_devices_and_luns(self, get_this_host_ref):
+        get_this_host_ref.return_value = 'host-1'
+
+        self.assertTrue(util.test_hostPBD_devs(self.session, '3', '/dev/sdc'))
+        self.assertFalse(util.test_hostPBD_devs(self.session, '2',
+                                                '/dev/sdc'))
+        self.assertFalse(util.test_hostPBD_devs(self.session, '3',
+                                                '/dev/sdd'))
+        # the search goes on past the PBD of SR 1
+        self.assertTrue(util.test_hostPBD_devs(self.session, '1',
+                                               '/dev/sdc'))
+        self.assertFalse(util.test_hostPBD_lun(self.session, 'iqn', '0'))
+        get_this_host_ref.return_value = 'host-2'
+        self.assertTrue(util.test_hostPBD_lun(self.session, 'iqn', '0'))
@@ -0,0 +1,278 @@
+import unittest
+import tempfile
+import shutil
+import struct
+import array
+import zlib
+import os
+import mock
+
+import vhdutil
+
+
+MB = 1024 * 1024
+
+
+def checksum(buf, offset):
+    data = buf[:offset] + buf[offset + 4:]
+    csum = ~sum(array.array('B', data)) & 0xFFFFFFFF
+    return buf[:offset] + struct.pack(">I", csum) + buf[offset + 4:]
+
+
+def make_footer(size, diskType, hidden=0, dataOffset=512,
+                creatorVersion=0x10003):
+    footer = struct.pack(vhdutil._FOOTER_FORMAT, "conectix", 2, 0x10000,
+            dataOffset, 0, "tap\0", creatorVersion, 0, size, size, 0,
+            diskType, 0, "\0" * 16, 0, hidden)
+    footer += "\0" * (vhdutil.VHD_FOOTER_SIZE - len(footer))
+    return checksum(footer, vhdutil._FOOTER_CHECKSUM_OFFSET)
+
+
+def make_header(maxBatSize, parentName="", locators=()):
+    header = struct.pack(vhdutil._HEADER_FORMAT, "cxsparse",
+            0xFFFFFFFFFFFFFFFF, 1536, 0x10000, maxBatSize,
+            vhdutil.VHD_BLOCK_SIZE, 0, "\0" * 16, 0, "\0" * 4,
+            parentName.encode("utf-16-be").ljust(512, "\0"))
+    for code, data, offset in locators:
+        header += struct.pack(vhdutil._LOCATOR_FORMAT, code, 1, len(data),
+                0, offset)
+    header += "\0" * (vhdutil.VHD_HEADER_SIZE - len(header))
+    return checksum(header, vhdutil._HEADER_CHECKSUM_OFFSET)
+
+
+def write_vhd(path, sizeMB, allocated=(), parentName="", hidden=0,
+              locators=(), creatorVersion=0x10003, backupHidden=None):
+    """Write a dynamic (or differencing) VHD with the blocks in 'allocated'
+    allocated, laid out the way vhd-util lays them out. 'locators' are 
+    (code, data) parent locators, each stored in a sector after the BAT"""
+    numBlocks = sizeMB / 2
+    diskType = vhdutil.VHD_DISK_TYPE_DYNAMIC
+    if parentName:
+        diskType = vhdutil.VHD_DISK_TYPE_DIFF
+    footer = make_footer(sizeMB * MB, diskType, hidden,
+            creatorVersion=creatorVersion)
+    backupFooter = footer
+    if backupHidden is not None:
+        backupFooter = make_footer(sizeMB * MB, diskType, backupHidden,
+                creatorVersion=creatorVersion)
+    batBytes = vhdutil.util.roundup(512, numBlocks * 4)
+    locStart = 1536 + batBytes
+    locators = [(code, data, locStart + i * 512) for i, (code, data) in
+            enumerate(locators)]
+    dataStart = locStart + len(locators) * 512
+    bat = [vhdutil.VHD_BLK_UNUSED] * numBlocks
+    sector = dataStart / 512
+    for i in allocated:
+        bat[i] = sector
+        sector += 1 + vhdutil.VHD_BLOCK_SIZE / 512
+    f = open(path, "wb")
+    f.write(backupFooter)
+    f.write(make_header(numBlocks, parentName, locators))
+    f.write(struct.pack(">%dI" % numBlocks, *bat).ljust(batBytes, "\xFF"))
+    for code, data, offset in locators:
+        f.write(data.ljust(512, "\0"))
+    f.seek(sector * 512)
+    f.write(footer)
+    f.close()
+    return sector * 512 + 512
+
+
+class TestVHDMetadata(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_reads_empty_vhd(self):
+        size = write_vhd(self.path("a.vhd"), 100)
+
+        vhd = vhdutil.VHDMetadata(self.path("a.vhd"))
+
+        self.assertEquals(100 * MB, vhd.getSizeVirt())
+        self.assertEquals(size, vhd.getSizePhys())
+        self.assertEquals(0, vhd.hidden)
+        self.assertEquals(None, vhd.getParentPath())
+
+    def test_phys_size_covers_allocated_blocks(self):
+        size = write_vhd(self.path("a.vhd"), 100, allocated=[3, 7])
+
+        vhd = vhdutil.VHDMetadata(self.path("a.vhd"))
+
+        self.assertEquals(size, vhd.getSizePhys())
+        self.assertEquals(1536 + 512 + 2 * (512 + vhdutil.VHD_BLOCK_SIZE) +
+                512, vhd.getSizePhys())
+
+    def test_reads_parent_and_hidden(self):
+        write_vhd(self.path("b.vhd"), 10, parentName="a.vhd", hidden=1)
+
+        vhd = vhdutil.VHDMetadata(self.path("b.vhd"))
+
+        self.assertEquals(self.path("a.vhd"), vhd.getParentPath())
+        self.assertEquals(1, vhd.hidden)
+
+    def test_parent_from_locators(self):
+        os.mkdir(self.path("sub"))
+        write_vhd(self.path("sub/a.vhd"), 10)
+        write_vhd(self.path("b.vhd"), 10, parentName="a.vhd", locators=[
+                (vhdutil.VHD_PLAT_CODE_MACX, "file://./gone.vhd"),
+                (vhdutil.VHD_PLAT_CODE_W2RU,
+                    ".\\sub\\a.vhd".encode("utf-16-le"))])
+
+        vhd = vhdutil.VHDMetadata(self.path("b.vhd"))
+
+        self.assertEquals(self.path("sub/a.vhd"), vhd.getParentPath())
+
+    def test_missing_parent_from_first_locator(self):
+        write_vhd(self.path("b.vhd"), 10, parentName="a.vhd", locators=[
+                (vhdutil.VHD_PLAT_CODE_MACX, "file://./c.vhd")])
+
+        vhd = vhdutil.VHDMetadata(self.path("b.vhd"))
+
+        self.assertEquals(self.path("c.vhd"), vhd.getParentPath())
+
+    def test_hidden_from_backup_footer_for_old_tapdisk(self):
+        for version in [0x00000001, 0x00010001]:
+            write_vhd(self.path("a.vhd"), 10, hidden=0, backupHidden=1,
+                    creatorVersion=version)
+
+            vhd = vhdutil.VHDMetadata(self.path("a.vhd"))
+            self.assertEquals(1, vhd.hidden)
+
+    def test_hidden_from_primary_footer(self):
+        write_vhd(self.path("a.vhd"), 10, hidden=0, backupHidden=1)
+
+        self.assertEquals(0, vhdutil.VHDMetadata(self.path("a.vhd")).hidden)
+
+    def test_block_bitmap(self):
+        write_vhd(self.path("a.vhd"), 40, allocated=[0, 9, 19])
+
+        vhd = vhdutil.VHDMetadata(self.path("a.vhd"))
+
+        self.assertEquals("\x01\x02\x08", vhd.getBlockBitmap())
+
+    def test_falls_back_to_backup_footer(self):
+        write_vhd(self.path("a.vhd"), 10)
+        f = open(self.path("a.vhd"), "r+b")
+        f.seek(-512, 2)
+        f.write("\0" * 512)
+        f.close()
+
+        vhd = vhdutil.VHDMetadata(self.path("a.vhd"))
+
+        self.assertEquals(10 * MB, vhd.getSizeVirt())
+
+    def test_corrupt_footer_raises(self):
+        f = open(self.path("a.vhd"), "wb")
+        f.write("x" * 4096)
+        f.close()
+
+        self.assertRaises(vhdutil.VHDFormatError, vhdutil.VHDMetadata,
+                self.path("a.vhd"))
+
+    @mock.patch('vhdutil.ioretry', autospec=True)
+    def test_getters_do_not_fork_vhd_util(self, ioretry):
+        write_vhd(self.path("a.vhd"), 10, allocated=[1])
+        write_vhd(self.path("b.vhd"), 10, parentName="a.vhd")
+        uuid = lambda path: os.path.basename(path)[:-4]
+
+        self.assertEquals(10 * MB, vhdutil.getSizeVirt(self.path("b.vhd")))
+        self.assertEquals("a", vhdutil.getParent(self.path("b.vhd"), uuid))
+        self.assertEquals(2, vhdutil.getDepth(self.path("b.vhd")))
+        self.assertTrue(vhdutil.hasParent(self.path("b.vhd")))
+        self.assertEquals("\x02",
+                zlib.decompress(vhdutil.getBlockBitmap(self.path("a.vhd"))))
+        info = vhdutil.getVHDInfo(self.path("b.vhd"), uuid)
+        self.assertEquals("a", info.parentUuid)
+        self.assertEquals(0, ioretry.call_count)
+
+    @mock.patch('vhdutil.ioretry', autospec=True)
+    def test_missing_parent_falls_back_to_vhd_util(self, ioretry):
+        write_vhd(self.path("b.vhd"), 10, parentName="a.vhd")
+        ioretry.return_value = "query failed"
+
+        self.assertRaises(vhdutil.util.SMException, vhdutil.getParent,
+                self.path("b.vhd"), lambda path: path)
+        self.assertEquals(1, ioretry.call_count)
+
+    def test_read_vhd_infos(self):
+        write_vhd(self.path("a.vhd"), 10)
+        write_vhd(self.path("b.vhd"), 10, parentName="a.vhd", hidden=1)
+        open(self.path("c.vhd"), "wb").close()
+        uuid = lambda path: os.path.basename(path)[:-4]
+
+        vhds = vhdutil.readVHDInfos([self.path(x) for x in
+                ["a.vhd", "b.vhd", "c.vhd"]], uuid)
+
+        self.assertEquals(["a", "b", "c"], sorted(vhds.keys()))
+        self.assertEquals("a", vhds["b"].parentUuid)
+        self.assertEquals(1, vhds["b"].hidden)
+        self.assertFalse(vhds["a"].error)
+        self.assertTrue(vhds["c"].error)
+
+
+class TestMutationLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        uuids = iter(['gen-%d' % i for i in range(10)])
+        for name, new in [('vhdutil.MUTATION_LOG',
+                           os.path.join(self.dir, 'vhd-mutations')),
+                          ('util.gen_uuid', lambda: uuids.next())]:
+            patcher = mock.patch(name, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def append(self, text):
+        f = open(vhdutil.MUTATION_LOG, 'a')
+        f.write(text)
+        f.close()
+
+    def test_no_log(self):
+        self.assertEquals((None, None), vhdutil.getMutations(None))
+
+    def test_mutations_since_marker(self):
+        vhdutil._logMutation('/a.vhd')
+        marker, paths = vhdutil.getMutations(None)
+        self.assertEquals(None, paths)
+
+        vhdutil._logMutation('/b.vhd')
+        vhdutil._logMutation('/c.vhd')
+        vhdutil._logMutation('/b.vhd')
+        marker, paths = vhdutil.getMutations(marker)
+
+        self.assertEquals(set(['/b.vhd', '/c.vhd']), paths)
+        self.assertEquals(set(), vhdutil.getMutations(marker)[1])
+
+    def test_recreated_log_means_unknown(self):
+        vhdutil._logMutation('/a.vhd')
+        marker, paths = vhdutil.getMutations(None)
+        os.unlink(vhdutil.MUTATION_LOG)
+        vhdutil._logMutation('/b.vhd')
+
+        self.assertEquals(None, vhdutil.getMutations(marker)[1])
+
+    def test_partial_record_is_read_once_complete(self):
+        vhdutil._logMutation('/a.vhd')
+        marker, paths = vhdutil.getMutations(None)
+        self.append('/b.v')
+
+        marker, paths = vhdutil.getMutations(marker)
+        self.assertEquals(set(), paths)
+        self.append('hd\n')
+
+        self.assertEquals(set(['/b.vhd']), vhdutil.getMutations(marker)[1])
+
+    @mock.patch('vhdutil.ioretry', autospec=True)
+    def test_failed_command_is_logged(self, ioretry):
+        vhdutil._logMutation('/b.vhd')
+        marker, paths = vhdutil.getMutations(None)
+        ioretry.side_effect = vhdutil.util.CommandException(1)
+
+        self.assertRaises(vhdutil.util.CommandException, vhdutil.setHidden,
+                          '/a.vhd')
+
+        self.assertEquals(set(['/a.vhd']), vhdutil.getMutations(marker)[1])
@@ -202,7 +202,7 @@ class TestContext(object):
             if fpath == fname:
                 return StringIO.StringIO(contents)
 
-        if 'w' in mode:
+        if 'w' in mode or 'a' in mode:
             if os.path.dirname(fname) in self.get_created_directories():
                 self._path_content[fname] = ''
                 return WriteableFile(self, fname, self._get_inc_fileno())